@@ -10,19 +10,27 @@ from collections import OrderedDict  # 有序字典，用於保持 JSON 資料
 import requests  # HTTP 請求模組
 import socketio  # WebSocket 客戶端模組
 import threading # 多執行緒模組
+import heapq # 搜尋結果排序用
+import bisect # 病人名冊的排序索引
+import functools # 樣板編譯快取
+import hashlib # OCR 快取的像素雜湊
+import io # 上傳 Gemini 前的影像編碼
+import base64 # 錨點樣板以 PNG 存進 JSON
+import random # Gemini 重試退避的抖動
+import importlib.util # 檢查選用套件是否存在 (不實際載入)
+from concurrent.futures import ThreadPoolExecutor # OCR 背景執行緒池
+from datetime import datetime # 民國年日期換算
 
 import re # 引入正規表示式模組
 
 # --- 新增功能：整合 Gemini AI ---
-try:
-    import google.generativeai as genai
-    # 從環境變數中讀取 API 金鑰，這是最安全的方式
-    # 您需要在執行腳本前，先在系統中設定好 'GEMINI_API_KEY' 這個環境變數
-    GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-    if GEMINI_API_KEY:
-        genai.configure(api_key=GEMINI_API_KEY)
-except ImportError:
-    genai = None
+# 從環境變數中讀取 API 金鑰，這是最安全的方式
+# 您需要在執行腳本前，先在系統中設定好 'GEMINI_API_KEY' 這個環境變數
+# google.generativeai 載入很慢，改為第一次呼叫時才由 GeminiClient 載入
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+# 請將模型名稱替換為您執行 check_models.py 後，實際在您可用列表中的那個視覺模型名稱。
+# 'flash' 模型速度更快且免費額度更高。
+GEMINI_MODEL_NAME = 'models/gemini-2.5-flash'
 
 # --- 新功能：OCR 相關設定 ---
 try:
@@ -36,6 +44,26 @@ except ImportError:
     print("警告：缺少 OCR 功能所需的套件 (Pillow, pytesseract)。螢幕偵測功能將無法使用。")
     OCR_ENABLED = False
 
+# --- 新功能：較快的螢幕擷取後端 (選用) ---
+# 有安裝 numpy 時，裁切各欄位只會產生陣列視圖，不會複製像素；
+# 有安裝 mss 時，以 mss 取代 ImageGrab 進行擷取。
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import mss
+except ImportError:
+    mss = None
+
+# --- 新功能：常駐的 Tesseract 函式庫綁定 (選用) ---
+# 有安裝 tesserocr 時，辨識器載入一次 traineddata 後重複使用，
+# 不必每次呼叫都啟動新的 tesseract.exe；沒有安裝時退回 pytesseract 子程序。
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 # --- 新功能：日曆選擇器 ---
 try:
     from tkcalendar import Calendar
@@ -55,16 +83,19 @@ DATA_FILE = "buttons.json"  # 資料檔名
 CAPTURE_SETTINGS_FILE = "capture_settings.json" # 新增：螢幕偵測範圍設定檔
 SERVER_URL = "https://taipei-hospital-autopaste.onrender.com" # <--- 請換成您自己的 Render 網址
 PATIENT_LIST_CAPTURE_FILE = "patient_list_capture.json" # 新增：住院病人清單掃描範圍設定檔
+CAPTURE_ANCHORS_FILE = "capture_anchors.json" # 新增：各偵測範圍旁的錨點樣板 (HIS 視窗移動後自動找回範圍)
 
 CHECKLIST_FILE = "checklist.json" # Checklist 資料檔名
 DOCTORS_FILE = "doctors.json" # 醫師資料檔名
+USAGE_STATS_FILE = "usage_stats.json" # 新增：片語使用頻率統計檔
+USAGE_HALF_LIFE_DAYS = 3 # 使用頻率分數的半衰期 (天)
+# 設定環境變數 AUTOPASTE_SYNC_USAGE=1 即可透過伺服器在多台電腦間同步使用統計
+USAGE_SYNC_ENABLED = os.environ.get('AUTOPASTE_SYNC_USAGE') == '1'
 
 def open_calendar_for_entry(parent, entry_widget):
     """一個通用的函式，為指定的 Entry 控件彈出日曆選擇器。"""
     if not CALENDAR_ENABLED:
         return
-    
-    from datetime import datetime
 
     def set_date():
         # --- 最終解決方案：獲取日期物件，並手動格式化為民國年 ---
@@ -100,10 +131,1352 @@ def open_calendar_for_entry(parent, entry_widget):
     top.bind("<Escape>", lambda e: top.destroy())
 
 
+class ScreenFrame:
+    """
+    --- 新功能：單次擷取的螢幕畫面 ---
+    一次擷取所有偵測範圍的聯集，各欄位再從同一張畫面裁切，
+    避免多次擷取的延遲，也確保各欄位來自同一個瞬間的畫面。
+    """
+    def __init__(self, pixels, left, top):
+        self.pixels = pixels  # numpy 陣列 (高, 寬, RGB) 或 PIL Image
+        self.left = left
+        self.top = top
+
+    @staticmethod
+    def union_bbox(bboxes):
+        bboxes = [tuple(map(int, map(round, b))) for b in bboxes]
+        return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+                max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+    @classmethod
+    def grab(cls, bboxes):
+        """擷取涵蓋所有 bbox 的最小矩形。"""
+        left, top, right, bottom = cls.union_bbox(bboxes)
+        if mss and np is not None:
+            with mss.mss() as sct:
+                shot = sct.grab({'left': left, 'top': top, 'width': right - left, 'height': bottom - top})
+            # BGRA 原始緩衝區直接轉成 RGB 視圖，不複製
+            bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+            return cls(bgra[:, :, 2::-1], left, top)
+        image = ImageGrab.grab(bbox=(left, top, right, bottom))
+        if np is not None:
+            return cls(np.asarray(image.convert('RGB')), left, top)
+        return cls(image, left, top)
+
+    def _local_box(self, bbox):
+        x1, y1, x2, y2 = (int(round(v)) for v in bbox)
+        return x1 - self.left, y1 - self.top, x2 - self.left, y2 - self.top
+
+    def crop(self, bbox):
+        """回傳 bbox 範圍的陣列視圖 (沒有 numpy 時回傳 PIL 裁切結果)。"""
+        x1, y1, x2, y2 = self._local_box(bbox)
+        if np is not None and isinstance(self.pixels, np.ndarray):
+            return self.pixels[y1:y2, x1:x2]
+        return self.pixels.crop((x1, y1, x2, y2))
+
+    def crop_image(self, bbox):
+        """回傳 bbox 範圍的 PIL Image，交給 Tesseract 或 Gemini 使用。"""
+        return as_pil_image(self.crop(bbox))
+
+    @classmethod
+    def grab_screen(cls):
+        """擷取整個畫面 (mss 為所有螢幕組成的虛擬畫面，ImageGrab 為主螢幕)。"""
+        if mss and np is not None:
+            with mss.mss() as sct:
+                monitor = sct.monitors[0]
+                return cls.grab([(monitor['left'], monitor['top'],
+                                  monitor['left'] + monitor['width'], monitor['top'] + monitor['height'])])
+        image = ImageGrab.grab()
+        if np is not None:
+            return cls(np.asarray(image.convert('RGB')), 0, 0)
+        return cls(image, 0, 0)
+
+
+# --- 新功能：以錨點樣板自動找回偵測範圍 ---
+# 選取範圍時，順便把範圍左邊 (或上方) 的固定標籤 (例如「病歷號:」) 存成小張灰階樣板。
+# 之後偵測前先在新的畫面中以 FFT 正規化互相關找到樣板，再套用原本的相對位移，
+# HIS 視窗移動或解析度改變後不必重新選取。
+
+def _window_sums(values, h, w):
+    """每個 h x w 視窗 (只取完全在圖內的位置) 的總和。"""
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    integral[1:, 1:] = values.cumsum(0).cumsum(1)
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+def ncc_map(image, template):
+    """
+    正規化互相關 (NCC) 樣板比對，互相關以 FFT 計算。
+    回傳每個有效位置的相關係數 (-1 ~ 1)；圖比樣板小或樣板沒有變化時回傳 None。
+    """
+    image = image.astype(np.float64)
+    template = template.astype(np.float64)
+    h, w = template.shape
+    H, W = image.shape
+    if h > H or w > W:
+        return None
+    template = template - template.mean()
+    template_norm = np.sqrt((template * template).sum())
+    if template_norm == 0:
+        return None
+    # 只取有效位移，循環相關不會繞回，所以補零到原圖大小即可
+    spectrum = np.fft.rfft2(image) * np.conj(np.fft.rfft2(template, s=(H, W)))
+    correlation = np.fft.irfft2(spectrum, s=(H, W))[:H - h + 1, :W - w + 1]
+    sums = _window_sums(image, h, w)
+    variance = _window_sums(image * image, h, w) - sums * sums / (h * w)
+    return correlation / (np.sqrt(np.maximum(variance, 1e-6)) * template_norm)
+
+
+def match_template(image, template):
+    """回傳最佳位置 (x, y, score)，無法比對時回傳 None。"""
+    score = ncc_map(image, template)
+    if score is None:
+        return None
+    y, x = np.unravel_index(int(np.argmax(score)), score.shape)
+    return int(x), int(y), float(score[y, x])
+
+
+def top_peaks(score, count, radius):
+    """相關係數圖中最高的幾個峰值位置 [(x, y), ...]，每找到一個就把附近 radius 內清掉。"""
+    score = score.copy()
+    peaks = []
+    for _ in range(count):
+        y, x = np.unravel_index(int(np.argmax(score)), score.shape)
+        if not np.isfinite(score[y, x]):
+            break
+        peaks.append((int(x), int(y)))
+        score[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1] = -np.inf
+    return peaks
+
+
+def _downsample(gray, factor):
+    """以 factor x factor 區塊的總和縮小 (比例一致即可，NCC 不受整體亮度縮放影響)。"""
+    h, w = gray.shape[0] // factor * factor, gray.shape[1] // factor * factor
+    total = np.zeros((h // factor, w // factor), dtype=np.float32)
+    for dy in range(factor):
+        for dx in range(factor):
+            total += gray[dy:h:factor, dx:w:factor]
+    return total
+
+
+class AnchorLocator:
+    """
+    管理每個偵測範圍的錨點樣板，並在新的畫面中找回範圍。
+    每筆錨點記錄樣板 (灰階 PNG)、錨點的螢幕座標，範圍則依錨點的位移一起平移。
+    """
+    MIN_SCORE = 0.85 # 低於此相關係數視為找不到
+    LOCAL_SEARCH = 48 # 先在原位置附近搜尋的半徑 (像素)
+    MIN_FOUND_RATIO = 0.5 # 至少要找到一半的錨點才平移
+
+    def __init__(self, path=CAPTURE_ANCHORS_FILE):
+        self.path = path
+        self.enabled = True
+        self.anchors = {} # key -> {'template': 灰階陣列, 'origin': (x, y)}
+
+    def load(self):
+        if np is None or not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.enabled = data.get('enabled', True)
+            for key, entry in data.get('anchors', {}).items():
+                image = Image.open(io.BytesIO(base64.b64decode(entry['template'])))
+                self.anchors[key] = {'template': np.asarray(image.convert('L')), 'origin': tuple(entry['origin'])}
+        except (json.JSONDecodeError, IOError, KeyError, ValueError) as e:
+            print(f"Error loading capture anchors: {e}")
+            self.anchors = {}
+        return self
+
+    def save(self):
+        anchors = {}
+        for key, entry in self.anchors.items():
+            buffer = io.BytesIO()
+            Image.fromarray(entry['template']).save(buffer, 'PNG', optimize=True)
+            anchors[key] = {'template': base64.b64encode(buffer.getvalue()).decode('ascii'), 'origin': list(entry['origin'])}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({'enabled': self.enabled, 'anchors': anchors}, f, ensure_ascii=False, indent=2)
+        except IOError as e:
+            print(f"Error saving capture anchors: {e}")
+
+    @staticmethod
+    def _candidate_boxes(bbox):
+        """範圍左邊的標籤優先，其次是上方。"""
+        x1, y1, x2, y2 = (int(round(v)) for v in bbox)
+        height = max(y2 - y1, 12)
+        width = min(max(2 * height, 48), 160)
+        return [(x1 - width - 2, y1, x1 - 2, y1 + height),
+                (x1, y1 - height - 2, x1 + min(x2 - x1, 160), y1 - 2)]
+
+    def learn(self, bboxes):
+        """為每個範圍擷取錨點樣板並儲存；找不到有內容的標籤時，該範圍不使用錨點。"""
+        if np is None:
+            return
+        for key, bbox in bboxes.items():
+            self.anchors.pop(key, None)
+            for box in self._candidate_boxes(bbox):
+                if box[0] < 0 or box[1] < 0:
+                    continue
+                template = to_grayscale(ScreenFrame.grab([box]).crop(box)).copy()
+                if template.size and template.std() >= 12: # 太單調的區域 (純背景) 比對不可靠
+                    self.anchors[key] = {'template': template, 'origin': (box[0], box[1])}
+                    break
+        self.save()
+
+    def _locate(self, gray, frame, anchor, hint):
+        """在整張畫面的灰階陣列中找錨點，回傳螢幕座標 (x, y) 或 None。"""
+        template = anchor['template']
+        h, w = template.shape
+        # 1. 先在預期位置附近找 (視窗沒動時只要幾毫秒)
+        ex, ey = hint[0] - frame.left, hint[1] - frame.top
+        r = self.LOCAL_SEARCH
+        x0, y0 = max(ex - r, 0), max(ey - r, 0)
+        found = match_template(gray[y0:ey + h + r, x0:ex + w + r], template)
+        if found and found[2] >= self.MIN_SCORE:
+            return found[0] + x0 + frame.left, found[1] + y0 + frame.top
+        # 2. 整張畫面縮小一半後粗找，再回原解析度的小範圍內細找。
+        #    縮小後細字的相位會影響分數，最高分不一定是正確位置，所以細找前幾名候選。
+        #    (縮小 4 倍時一般字級的標籤已經糊掉，實測會找錯位置)
+        factor = 2 if min(h, w) >= 8 else 1
+        coarse = ncc_map(_downsample(gray, factor), _downsample(template, factor)) if factor > 1 else ncc_map(gray, template)
+        if coarse is None:
+            return None
+        pad = 2 * factor
+        best = None
+        for px, py in top_peaks(coarse, 5, max(w, h) // (2 * factor) + 1):
+            cx, cy = px * factor, py * factor
+            x0, y0 = max(cx - pad, 0), max(cy - pad, 0)
+            found = match_template(gray[y0:cy + h + pad, x0:cx + w + pad], template)
+            if found and (best is None or found[2] > best[2]):
+                best = (found[0] + x0, found[1] + y0, found[2])
+        if best and best[2] >= self.MIN_SCORE:
+            return best[0] + frame.left, best[1] + frame.top
+        return None
+
+    def relocate(self, bboxes):
+        """
+        回傳 (新的範圍 dict, 是否有範圍移動)。
+        第一個錨點找到的位移會當作其他錨點的預期位置，整個視窗移動時其餘錨點只需局部搜尋。
+        找不到錨點 (或沒有錨點) 的範圍以已找到錨點位移的中位數一起平移，避免範圍彼此錯開；
+        找到的錨點不到 MIN_FOUND_RATIO 時視為比對不可靠，所有範圍維持原座標。
+        """
+        keys = [key for key in bboxes if key in self.anchors]
+        if not self.enabled or np is None or not keys:
+            return bboxes, False
+        start = time.perf_counter()
+        frame = ScreenFrame.grab_screen()
+        gray = to_grayscale(np.asarray(frame.pixels))
+        grab_ms = (time.perf_counter() - start) * 1000
+
+        shift = (0, 0)
+        found = {} # key -> 錨點的新位置
+        for key in keys:
+            anchor = self.anchors[key]
+            ox, oy = anchor['origin']
+            position = self._locate(gray, frame, anchor, (ox + shift[0], oy + shift[1]))
+            if position is not None:
+                found[key] = position
+                shift = (position[0] - ox, position[1] - oy)
+        missing = [key for key in keys if key not in found]
+
+        relocated = dict(bboxes)
+        moved = False
+        if len(found) < self.MIN_FOUND_RATIO * len(keys):
+            status = "找到的錨點太少，範圍未移動"
+        else:
+            shifts = [(found[key][0] - self.anchors[key]['origin'][0], found[key][1] - self.anchors[key]['origin'][1]) for key in found]
+            fallback = (int(np.median([dx for dx, _ in shifts])), int(np.median([dy for _, dy in shifts])))
+            for key, (x1, y1, x2, y2) in bboxes.items():
+                if key in found:
+                    dx, dy = found[key][0] - self.anchors[key]['origin'][0], found[key][1] - self.anchors[key]['origin'][1]
+                else:
+                    dx, dy = fallback
+                if (dx, dy) == (0, 0):
+                    continue
+                relocated[key] = (x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+                if key in self.anchors:
+                    ox, oy = self.anchors[key]['origin']
+                    self.anchors[key]['origin'] = (ox + dx, oy + dy)
+                moved = True
+            status = "已平移範圍" if moved else "範圍未移動"
+        if moved:
+            self.save()
+        total_ms = (time.perf_counter() - start) * 1000
+        print(f"[錨點] 擷取 {grab_ms:.1f} ms，比對 {total_ms - grab_ms:.1f} ms，{status}"
+              + (f"，找不到：{', '.join(missing)}" if missing else ""))
+        return relocated, moved
+
+
+class ScreenWatcher:
+    """
+    --- 新功能：螢幕監看模式 ---
+    背景執行緒以低頻率擷取記憶的範圍，縮小後與上一張比較，只有內容真的改變
+    (而且畫面已經穩定下來，例如另一位病人的病歷開好了) 才呼叫 on_change。
+    每一輪都量測本執行緒的 CPU 時間，必要時拉長取樣間隔，讓監看本身的 CPU 用量不超過 cpu_budget。
+    on_change 在背景執行緒中被呼叫，不可直接操作 Tk 元件。
+    """
+    def __init__(self, get_bboxes, on_change, fps=2.0, cpu_budget=0.05, threshold=8.0, factor=4):
+        self.get_bboxes = get_bboxes
+        self.on_change = on_change
+        self.fps = fps
+        self.cpu_budget = cpu_budget
+        self.threshold = threshold # 縮小後平均每像素的灰階差異
+        self.factor = factor
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.frames = 0
+        self.skipped = 0
+        self.triggers = 0
+        self.errors = 0
+        self.cpu_seconds = 0.0
+        self.started_at = time.perf_counter()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        # 每個執行緒有自己的停止旗標：舊執行緒還沒結束時重新啟動，也不會把舊的旗標清掉
+        self._stop = threading.Event()
+        with self._lock:
+            self._reset_stats()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="screen-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """停止監看並等待執行緒結束 (最多 timeout 秒)，之後再 start 不會同時有兩個執行緒。"""
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _signature(self, frame, bboxes):
+        """每個範圍縮小 factor 倍的灰階圖 (平均值)，作為比較用的指紋。"""
+        factor = self.factor
+        return {key: _downsample(to_grayscale(np.asarray(frame.crop(bbox))), factor) / (factor * factor)
+                for key, bbox in bboxes.items()}
+
+    def _changed(self, previous, current):
+        if previous.keys() != current.keys():
+            return True
+        for key, signature in current.items():
+            old = previous[key]
+            if old.shape != signature.shape or (signature.size and np.abs(signature - old).mean() > self.threshold):
+                return True
+        return False
+
+    def _run(self, stop):
+        previous = None
+        pending = False
+        delay = 0.0
+        while not stop.wait(delay):
+            cpu_start = time.thread_time()
+            start = time.perf_counter()
+            bboxes = dict(self.get_bboxes() or {})
+            triggered = False
+            try:
+                if bboxes:
+                    current = self._signature(ScreenFrame.grab(bboxes.values()), bboxes)
+                    if previous is None:
+                        pass # 第一張只當作基準
+                    elif self._changed(previous, current):
+                        pending = True # 畫面還在變，等穩定後再辨識
+                    elif pending:
+                        pending = False
+                        triggered = True
+                    previous = current
+            except Exception as e:
+                print(f"監看畫面擷取失敗: {e}")
+                with self._lock:
+                    self.errors += 1
+
+            if triggered:
+                self.on_change()
+            cpu = time.thread_time() - cpu_start
+            with self._lock:
+                self.frames += 1
+                self.cpu_seconds += cpu
+                if triggered:
+                    self.triggers += 1
+                else:
+                    self.skipped += 1
+            elapsed = time.perf_counter() - start
+            # 取樣間隔至少 1/fps；單輪太耗 CPU 時再拉長，讓 CPU 用量 = cpu / 間隔 <= cpu_budget
+            delay = max(1.0 / self.fps, cpu / self.cpu_budget) - elapsed
+
+    def stats(self):
+        with self._lock:
+            duration = max(time.perf_counter() - self.started_at, 1e-6)
+            return {
+                'fps': self.frames / duration,
+                'frames': self.frames,
+                'skip_rate': self.skipped / self.frames if self.frames else 0.0,
+                'triggers': self.triggers,
+                'errors': self.errors,
+                'cpu_usage': self.cpu_seconds / duration,
+            }
+
+
+_ocr_executor = None
+
+def get_ocr_executor():
+    """共用的 OCR 背景執行緒池，第一次使用時才建立。"""
+    global _ocr_executor
+    if _ocr_executor is None:
+        _ocr_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ocr")
+    return _ocr_executor
+
+
+_network_executor = None
+
+def get_network_executor():
+    """伺服器請求用的背景執行緒池，與 OCR 分開，慢的請求不會佔住 OCR 的執行緒。"""
+    global _network_executor
+    if _network_executor is None:
+        _network_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="net")
+    return _network_executor
+
+
+def normalize_bed_number(bed_text):
+    """
+    --- 最終解決方案：根據使用者提供的精確規則，對床號進行後處理 ---
+    """
+    # 1. 清理文字，移除所有非字母和數字的符號
+    cleaned_bed_text = re.sub(r'[^A-Za-z0-9]', '', bed_text).upper()
+
+    # 2. 嘗試匹配 ICU 格式 (ICUA/ICUB + 2位數字，例如 ICUA-12)
+    icu_match = re.match(r'^(ICUA|ICUB)(\d{2})$', cleaned_bed_text)
+    if icu_match:
+        return f"{icu_match.group(1)}-{icu_match.group(2)}"
+    # 3. 嘗試匹配新的特定床號格式 (例如 7B26402 -> 7B26-02)
+    new_specific_match = re.match(r'^(\d[A-Z]\d{2})\d(\d{2})$', cleaned_bed_text)
+    if new_specific_match:
+        return f"{new_specific_match.group(1)}-{new_specific_match.group(2)}" # 組合第一組和第二組
+    # 4. 嘗試匹配舊的普通床號格式 (1位數字 + 1位字母 + 4位數字，例如 1A1234 -> 1A12-34)
+    normal_match = re.match(r'^(\d[A-Z])(\d{4})$', cleaned_bed_text)
+    if normal_match:
+        return f"{normal_match.group(1)}{normal_match.group(2)[:2]}-{normal_match.group(2)[2:]}"
+    # 5. 作為備用，檢查 1A1 -> 1A-1 格式
+    if len(cleaned_bed_text) == 3 and cleaned_bed_text[0].isdigit() and cleaned_bed_text[1].isalpha() and cleaned_bed_text[2].isdigit():
+        return f"{cleaned_bed_text[:2]}-{cleaned_bed_text[2]}"
+    return bed_text
+
+
+class OcrEngine:
+    """
+    --- 新功能：OCR 引擎抽象層 ---
+    以 (語言, PSM, OEM, 參數) 作為辨識設定檔，每個設定檔保留一組已載入 traineddata 的辨識器，
+    用完放回池中給下一次呼叫使用。tesserocr 的辨識器不可跨執行緒共用，所以每次呼叫獨佔一個。
+    """
+    def __init__(self, tessdata_dir=None, max_per_profile=4):
+        self.backend = 'tesserocr' if tesserocr else 'pytesseract'
+        self.tessdata_dir = tessdata_dir
+        self.max_per_profile = max_per_profile
+        self._pools = {}  # profile -> list of 閒置的 PyTessBaseAPI
+        self._created = {}  # profile -> 已建立的數量
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def make_profile(lang='chi_tra+eng', psm=7, oem=None, variables=None):
+        return (lang, psm, oem, tuple(sorted((variables or {}).items())))
+
+    def _create_api(self, profile):
+        lang, psm, oem, variables = profile
+        kwargs = {'lang': lang, 'psm': psm}
+        if self.tessdata_dir:
+            kwargs['path'] = self.tessdata_dir
+        if oem is not None:
+            kwargs['oem'] = oem
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        for name, value in variables:
+            api.SetVariable(name, str(value))
+        return api
+
+    def _acquire(self, profile):
+        with self._cond:
+            while True:
+                pool = self._pools.setdefault(profile, [])
+                if pool:
+                    return pool.pop()
+                if self._created.get(profile, 0) < self.max_per_profile:
+                    self._created[profile] = self._created.get(profile, 0) + 1
+                    break
+                self._cond.wait()
+        try:
+            return self._create_api(profile) # 在鎖外載入 traineddata，避免阻塞其他設定檔
+        except Exception:
+            with self._cond:
+                self._created[profile] -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, profile, api):
+        with self._cond:
+            self._pools.setdefault(profile, []).append(api)
+            self._cond.notify()
+
+    @staticmethod
+    def _config_string(profile):
+        _, psm, oem, variables = profile
+        config = f'--psm {psm}'
+        if oem is not None:
+            config = f'--oem {oem} ' + config
+        for name, value in variables:
+            config += f' -c {name}={value}'
+        return config
+
+    def recognize(self, image, lang='chi_tra+eng', psm=7, oem=None, variables=None):
+        """辨識一張 PIL 圖片並回傳去除前後空白的文字。"""
+        profile = self.make_profile(lang, psm, oem, variables)
+        if self.backend == 'pytesseract':
+            return pytesseract.image_to_string(image, lang=lang, config=self._config_string(profile)).strip()
+
+        api = self._acquire(profile)
+        try:
+            api.SetImage(image)
+            return api.GetUTF8Text().strip()
+        finally:
+            api.Clear() # 釋放圖片，但保留已載入的語言模型
+            self._release(profile, api)
+
+    def recognize_with_confidence(self, image, lang='chi_tra+eng', psm=7, oem=None, variables=None):
+        """辨識並回傳 (文字, 每個字詞的信心分數列表 0~100)。"""
+        profile = self.make_profile(lang, psm, oem, variables)
+        if self.backend == 'pytesseract':
+            # 只呼叫一次 tesseract：文字與信心分數都取自 image_to_data，字詞依中英文規則重組
+            data = pytesseract.image_to_data(image, lang=lang, config=self._config_string(profile),
+                                             output_type=pytesseract.Output.DICT)
+            return join_ocr_words(data), [float(conf) for word, conf in zip(data['text'], data['conf']) if word.strip()]
+
+        api = self._acquire(profile)
+        try:
+            api.SetImage(image)
+            text = api.GetUTF8Text().strip()
+            return text, [float(c) for c in api.AllWordConfidences()]
+        finally:
+            api.Clear()
+            self._release(profile, api)
+
+    def warm_up(self, profiles):
+        """預先為每個設定檔建立一個辨識器 (載入 traineddata)。"""
+        if self.backend != 'tesserocr':
+            return
+        for profile in profiles:
+            try:
+                self._release(profile, self._acquire(profile))
+            except Exception as e:
+                print(f"OCR 引擎預熱失敗 {profile}: {e}")
+
+    def warm_up_async(self, profiles):
+        threading.Thread(target=self.warm_up, args=(list(profiles),), daemon=True).start()
+
+
+_CJK_CHAR_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+def join_ocr_words(data):
+    """
+    把 image_to_data 的字詞重組成與 image_to_string 相同的文字：同一行的字詞以空白連接，
+    但兩個中文 (全形) 字詞之間不加空白；不同行以換行分隔。
+    """
+    lines = {}
+    for index, word in enumerate(data['text']):
+        word = word.strip()
+        if word:
+            line_key = (data['block_num'][index], data['par_num'][index], data['line_num'][index])
+            lines.setdefault(line_key, []).append(word)
+    text_lines = []
+    for words in lines.values():
+        line = words[0]
+        for word in words[1:]:
+            cjk_pair = _CJK_CHAR_PATTERN.match(line[-1]) and _CJK_CHAR_PATTERN.match(word[0])
+            line += word if cjk_pair else ' ' + word
+        text_lines.append(line)
+    return '\n'.join(text_lines)
+
+
+_tessdata_dir = None
+if OCR_ENABLED:
+    _tessdata_dir = os.path.join(os.path.dirname(pytesseract.pytesseract.tesseract_cmd), 'tessdata')
+    if not os.path.isdir(_tessdata_dir):
+        _tessdata_dir = None # 交給 tesserocr 使用預設路徑
+ocr_engine = OcrEngine(tessdata_dir=_tessdata_dir)
+
+
+def normalize_alnum_id(text):
+    """病歷號只保留英數字並轉大寫。"""
+    return re.sub(r'[^A-Za-z0-9]', '', text).upper()
+
+
+def normalize_cjk_name(text):
+    """移除中文字之間被 OCR 插入的空白，英文名字保留單一空白。"""
+    text = re.sub(r'(?<=[\u4e00-\u9fff])\s+(?=[\u4e00-\u9fff])', '', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def normalize_multiline(text):
+    """移除空行。"""
+    return '\n'.join(line for line in text.split('\n') if line.strip())
+
+
+# --- 新功能：以 NumPy 向量化的 OCR 影像前處理 ---
+# 所有步驟都直接在擷取畫面的陣列 (視圖) 上運算，不再逐像素呼叫 Python 函式。
+# AddPatientDialog 與 ChecklistWindow 的批次掃描共用同一套流程。
+
+def as_pil_image(region):
+    """把陣列 (或原本就是 PIL 的圖片) 轉成 PIL Image，交給 Gemini 等只吃 PIL 的介面。"""
+    if np is not None and isinstance(region, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(region))
+    return region
+
+
+def to_grayscale(pixels):
+    """RGB -> 灰階 (ITU-R 601 權重的整數近似)。"""
+    if pixels.ndim == 2:
+        return pixels
+    rgb = pixels[..., :3].astype(np.uint16)
+    return ((rgb[..., 0] * 77 + rgb[..., 1] * 150 + rgb[..., 2] * 29) >> 8).astype(np.uint8)
+
+
+def otsu_threshold(gray):
+    """以 Otsu 法求出讓前景/背景類間變異數最大的閾值。"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    cum_mean = np.cumsum(hist * np.arange(256))
+    mean_bg = cum_mean / np.maximum(weight_bg, 1)
+    mean_fg = (cum_mean[-1] - cum_mean) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between[:-1]))
+
+
+def _box_sum(values, radius):
+    """以積分影像計算每個像素 (2r+1)x(2r+1) 鄰域的總和，邊界以邊緣值延伸。"""
+    padded = np.pad(values, radius + 1, mode='edge').astype(np.int64)
+    integral = padded.cumsum(0).cumsum(1)
+    size = 2 * radius + 1
+    h, w = values.shape
+    return (integral[size:size + h, size:size + w] - integral[0:h, size:size + w]
+            - integral[size:size + h, 0:w] + integral[0:h, 0:w])
+
+
+def binarize(gray, method='otsu', block=31, offset=10):
+    """
+    二值化成 0/255 的 uint8 陣列，並統一為白底黑字 (Tesseract 偏好的極性)。
+    - 'fixed'：舊版的固定閾值 128
+    - 'otsu'：全域 Otsu 閾值
+    - 'adaptive'：區域平均減去 offset，適合背景深淺不一的清單畫面
+    """
+    if method == 'fixed':
+        binary = gray >= 128
+    elif method == 'adaptive':
+        radius = block // 2
+        local_mean = _box_sum(gray, radius) / float(block * block)
+        binary = gray > (local_mean - offset)
+    else:
+        binary = gray > otsu_threshold(gray)
+    if binary.mean() < 0.5: # 深色背景淺色字：反轉
+        binary = ~binary
+    return binary.astype(np.uint8) * 255
+
+
+def denoise_binary(binary):
+    """3x3 多數決濾波，去除二值化後零星的雜點。"""
+    dark = (binary == 0).astype(np.uint8)
+    return np.where(_box_sum(dark, 1) >= 5, 0, 255).astype(np.uint8)
+
+
+def deskew(binary, max_angle=3.0, step=0.5):
+    """以水平投影的變異數找出最佳旋轉角度 (文字行對齊時投影最尖銳)。"""
+    image = Image.fromarray(binary)
+    best_angle, best_score = 0.0, None
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        rotated = np.asarray(image.rotate(float(angle), resample=Image.NEAREST, fillcolor=255))
+        score = (rotated == 0).sum(axis=1).var()
+        if best_score is None or score > best_score:
+            best_angle, best_score = float(angle), score
+    if best_angle == 0.0:
+        return binary
+    return np.asarray(image.rotate(best_angle, resample=Image.NEAREST, fillcolor=255))
+
+
+def upscale(gray, scale=1.0, min_height=0):
+    """放大過小的裁切區域：至少放大 scale 倍，且高度至少 min_height。"""
+    height, width = gray.shape[:2]
+    factor = max(scale, (min_height / height) if height and min_height else 1.0)
+    if factor <= 1.0:
+        return gray
+    size = (max(1, int(round(width * factor))), max(1, int(round(height * factor))))
+    return np.asarray(Image.fromarray(gray).resize(size, Image.LANCZOS))
+
+
+PREPROCESS_STEPS = ('grayscale', 'threshold', 'otsu', 'adaptive', 'denoise', 'deskew')
+
+def preprocess_ocr_image(region, steps, scale=1.0, min_height=0):
+    """
+    依序套用前處理步驟並回傳 PIL Image：
+    'grayscale'、'threshold' (固定 128)、'otsu'、'adaptive'、'denoise'、'deskew'。
+    放大 (scale / min_height) 會在灰階之後、二值化之前進行。未知的步驟名稱會丟出 ValueError。
+    """
+    unknown = [step for step in steps if step not in PREPROCESS_STEPS]
+    if unknown:
+        raise ValueError(f"未知的前處理步驟: {unknown}")
+    if np is None:
+        # 沒有 numpy 時退回 Pillow 的簡易流程
+        image = as_pil_image(region)
+        if scale != 1.0:
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+        for step in steps:
+            if step == 'grayscale':
+                image = image.convert('L')
+            elif step in ('threshold', 'otsu', 'adaptive'):
+                image = image.convert('L').point(lambda p: 0 if p < 128 else 255, '1')
+        return image
+
+    pixels = np.asarray(region)
+    if not steps and scale == 1.0 and not min_height:
+        return as_pil_image(pixels)
+    pixels = to_grayscale(pixels) # 灰階會產生新陣列，之後的步驟都不會動到原始畫面
+    pixels = upscale(pixels, scale, min_height)
+    for step in steps:
+        if step == 'threshold':
+            pixels = binarize(pixels, 'fixed')
+        elif step in ('otsu', 'adaptive'):
+            pixels = binarize(pixels, step)
+        elif step == 'denoise':
+            pixels = denoise_binary(pixels)
+        elif step == 'deskew':
+            pixels = deskew(pixels)
+    return Image.fromarray(pixels)
+
+
+class OcrFieldProfile:
+    """
+    --- 新功能：每個偵測欄位的辨識設定 ---
+    語言、PSM、字元白名單、放大倍率、前處理步驟與後處理函式集中在一處宣告。
+    use_ai 為 True 的欄位在有 Gemini 金鑰時可升級交給 AI：本地辨識的信心分數低於 min_confidence
+    或不符合 pattern 時才會送出。
+    """
+    def __init__(self, lang='chi_tra+eng', psm=7, oem=None, whitelist=None, scale=1.0, min_height=0,
+                 preprocess=(), normalize=None, use_ai=False, variables=None, pattern=None, min_confidence=70):
+        self.lang = lang
+        self.psm = psm
+        self.oem = oem
+        self.whitelist = whitelist
+        self.scale = scale
+        self.min_height = min_height
+        self.preprocess = tuple(preprocess)
+        self.normalize = normalize
+        self.use_ai = use_ai
+        self.variables = dict(variables or {})
+        self.pattern = re.compile(pattern) if pattern else None # 欄位格式 (正規化後)
+        self.min_confidence = min_confidence
+        if whitelist:
+            self.variables['tessedit_char_whitelist'] = whitelist
+
+    @property
+    def engine_profile(self):
+        return OcrEngine.make_profile(self.lang, self.psm, self.oem, self.variables)
+
+    def cache_key(self, tier):
+        """結果快取用的設定檔鍵；tier 為 'cascade' (可能升級到 Gemini) 或 'local' (只用 Tesseract)，兩者的結果不可混用。"""
+        return (tier, self.engine_profile, self.preprocess, self.scale, self.min_height)
+
+    def postprocess(self, text):
+        text = text.strip()
+        return self.normalize(text) if self.normalize else text
+
+    def recognize_local(self, image, engine=None):
+        """以本地 Tesseract 辨識 (前處理 -> 辨識 -> 後處理)。"""
+        engine = engine or ocr_engine
+        image = preprocess_ocr_image(image, self.preprocess, self.scale, self.min_height)
+        text = engine.recognize(image, lang=self.lang, psm=self.psm, oem=self.oem, variables=self.variables)
+        return self.postprocess(text)
+
+    def recognize_local_with_confidence(self, image, engine=None):
+        """同 recognize_local，另外回傳字詞的平均信心分數 (沒有字詞時為 0)。"""
+        engine = engine or ocr_engine
+        image = preprocess_ocr_image(image, self.preprocess, self.scale, self.min_height)
+        text, confidences = engine.recognize_with_confidence(image, lang=self.lang, psm=self.psm, oem=self.oem, variables=self.variables)
+        confidence = sum(confidences) / len(confidences) if confidences else 0.0
+        return self.postprocess(text), confidence
+
+    def is_acceptable(self, text, confidence):
+        """本地結果是否可以直接採用：信心分數夠高且符合欄位格式。"""
+        if confidence < self.min_confidence:
+            return False
+        if self.pattern is not None:
+            return self.pattern.fullmatch(text) is not None
+        return bool(text)
+
+
+_ALNUM = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+OCR_FIELD_PROFILES = {
+    # 病歷號與床號只會有英數字：只載入 eng 並限制白名單，速度與正確率都比 chi_tra+eng 好
+    "病歷號": OcrFieldProfile(lang='eng', psm=7, whitelist=_ALNUM, scale=2.0, min_height=48,
+                           preprocess=('otsu',), normalize=normalize_alnum_id, use_ai=True,
+                           pattern=r'[A-Z]?\d{6,10}', min_confidence=80),
+    "姓名": OcrFieldProfile(lang='chi_tra+eng', psm=7, scale=2.0, min_height=48,
+                          preprocess=('grayscale',), normalize=normalize_cjk_name, use_ai=True,
+                          pattern=r'[\u4e00-\u9fff]{2,4}|[A-Za-z][A-Za-z .\-]{1,40}', min_confidence=75),
+    "床號": OcrFieldProfile(lang='eng', psm=7, whitelist=_ALNUM + '-', scale=2.0, min_height=48,
+                          preprocess=('otsu',), normalize=normalize_bed_number, use_ai=True,
+                          pattern=r'ICU[AB]-\d{2}|\d[A-Z]\d{2}-\d{2}|\d[A-Z]-\d', min_confidence=80),
+    # 對備註使用圖像預處理和 PSM 11
+    "住院備註": OcrFieldProfile(lang='chi_tra+eng', psm=11, oem=1, preprocess=('otsu', 'denoise', 'deskew'),
+                            normalize=normalize_multiline, use_ai=True, min_confidence=85,
+                            variables={'preserve_interword_spaces': 1}),
+    # 批次掃描：假設是一個統一的文字區塊 (PSM 6)，背景深淺不一所以用區域閾值
+    "住院清單": OcrFieldProfile(lang='chi_tra+eng', psm=6, preprocess=('adaptive', 'deskew'),
+                            normalize=normalize_multiline, use_ai=True),
+    # 批次掃描切割後的單一儲存格：單行文字 (PSM 7)
+    "住院清單儲存格": OcrFieldProfile(lang='chi_tra+eng', psm=7, scale=2.0, min_height=48,
+                               preprocess=('grayscale',), normalize=normalize_cjk_name),
+}
+DEFAULT_OCR_FIELD_PROFILE = OcrFieldProfile(lang='chi_tra+eng', psm=7)
+
+
+def get_ocr_field_profile(key):
+    return OCR_FIELD_PROFILES.get(key, DEFAULT_OCR_FIELD_PROFILE)
+
+
+class OcrResultCache:
+    """
+    --- 新功能：以裁切區域像素雜湊為鍵的 OCR 結果快取 ---
+    在同一個 HIS 畫面重複按「使用記憶範圍偵測」時，畫面沒變的欄位直接回傳上次結果，
+    不必再送 Tesseract 或 Gemini。依存活時間過期，並以筆數與文字總量限制記憶體用量 (LRU 淘汰)。
+    可在多個 OCR 背景執行緒間共用。
+    """
+    def __init__(self, max_entries=256, max_bytes=1024 * 1024, ttl_seconds=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()  # key -> (text, stored_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(region):
+        """計算裁切區域像素的快速雜湊 (含尺寸，避免不同形狀的相同位元組相撞)。"""
+        if np is not None and isinstance(region, np.ndarray):
+            data = np.ascontiguousarray(region)
+            shape = data.shape
+        else:
+            data = region.tobytes()
+            shape = (region.size, region.mode)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr(shape).encode())
+        h.update(data)
+        return h.hexdigest()
+
+    def make_key(self, field_key, profile_key, region):
+        return (field_key, profile_key, self.digest(region))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            text, stored_at, size = entry
+            if now - stored_at > self.ttl:
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key, text):
+        size = len(text.encode('utf-8')) + 64 # 64 約略為鍵與時間戳的額外負擔
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (text, time.time(), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+ocr_result_cache = OcrResultCache()
+
+
+class OcrCascadeStats:
+    """
+    --- 新功能：本地 / AI 兩層辨識的統計 ---
+    記錄每一層的呼叫次數與累計耗時，以及需要升級到 Gemini 的欄位比例。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fields = 0
+        self.escalations = 0
+        self.tiers = {'local': [0, 0.0], 'ai': [0, 0.0]}  # tier -> [次數, 累計 ms]
+
+    def record_tier(self, tier, elapsed_ms):
+        with self._lock:
+            self.tiers[tier][0] += 1
+            self.tiers[tier][1] += elapsed_ms
+
+    def record_field(self, escalated):
+        with self._lock:
+            self.fields += 1
+            if escalated:
+                self.escalations += 1
+
+    def summary(self):
+        with self._lock:
+            parts = [f"升級率 {self.escalations / self.fields:.0%} ({self.escalations}/{self.fields})" if self.fields else "升級率 -"]
+            for tier, (count, total_ms) in self.tiers.items():
+                avg = total_ms / count if count else 0.0
+                parts.append(f"{tier} {count} 次 平均 {avg:.0f} ms")
+            return "[OCR 分層] " + "，".join(parts)
+
+
+ocr_cascade_stats = OcrCascadeStats()
+
+
+class GeminiClient:
+    """
+    --- 新功能：共用的 Gemini 用戶端 ---
+    第一次呼叫時才載入 SDK 並建立模型，之後重複使用。
+    限制同時進行的請求數，遇到速率限制時以指數退避重試，每次呼叫都有期限，
+    並記錄延遲與 token 用量。generate_content 的介面與 GenerativeModel 相同，
+    測試時可用 model_factory 傳入本地的替身模型。
+    """
+    def __init__(self, api_key=None, model_name=GEMINI_MODEL_NAME, model_factory=None,
+                 max_in_flight=2, deadline_seconds=30.0, max_retries=3, backoff_base=1.0, backoff_max=16.0):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._model_factory = model_factory
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'ok': 0, 'failed': 0, 'rate_limited': 0, 'retries': 0, 'timeouts': 0,
+                       'in_flight': 0, 'peak_in_flight': 0, 'latency_ms': 0.0, 'max_latency_ms': 0.0,
+                       'prompt_tokens': 0, 'output_tokens': 0, 'bytes_sent': 0}
+
+    def available(self):
+        """是否可以使用 AI (有金鑰且有安裝 SDK)。不會載入 SDK。"""
+        if self._model_factory is not None:
+            return True
+        if not self.api_key:
+            return False
+        try:
+            # 父套件 google 不存在時 find_spec 會丟出 ModuleNotFoundError，而不是回傳 None
+            return importlib.util.find_spec('google.generativeai') is not None
+        except ImportError:
+            return False
+
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None:
+                if self._model_factory is not None:
+                    self._model = self._model_factory()
+                else:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(self.model_name)
+            return self._model
+
+    @staticmethod
+    def is_rate_limited(error):
+        code = getattr(error, 'code', None)
+        if code == 429 or getattr(code, 'value', None) == 429:
+            return True
+        message = str(error).lower()
+        return '429' in message or 'resource exhausted' in message or 'rate limit' in message or 'quota' in message
+
+    def _update(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+            self._stats['peak_in_flight'] = max(self._stats['peak_in_flight'], self._stats['in_flight'])
+
+    def generate_content(self, contents, deadline=None, **kwargs):
+        """
+        送出請求並回傳回應；超過期限或重試用盡時拋出例外 (不再把錯誤折進回傳文字)。
+        deadline 為整次呼叫 (含排隊與重試) 的秒數上限。
+        """
+        deadline_at = time.monotonic() + (deadline or self.deadline_seconds)
+        upload_bytes = sum(len(part['data']) for part in contents if isinstance(part, dict) and 'data' in part)
+        self._update(calls=1)
+        model = self._get_model()
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+                self._update(failed=1, timeouts=1)
+                raise TimeoutError("Gemini 請求逾時")
+            self._update(in_flight=1)
+            start = time.perf_counter()
+            try:
+                request_kwargs = dict(kwargs)
+                if self._model_factory is None:
+                    request_kwargs['request_options'] = {'timeout': max(deadline_at - time.monotonic(), 1.0)}
+                response = model.generate_content(contents, **request_kwargs)
+            except Exception as e:
+                if not self.is_rate_limited(e) or attempt >= self.max_retries:
+                    self._update(failed=1)
+                    raise
+                self._update(rate_limited=1)
+                error = e
+            else:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                usage = getattr(response, 'usage_metadata', None)
+                self._update(ok=1, latency_ms=elapsed_ms, bytes_sent=upload_bytes,
+                             prompt_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+                             output_tokens=getattr(usage, 'candidates_token_count', 0) or 0)
+                with self._stats_lock:
+                    self._stats['max_latency_ms'] = max(self._stats['max_latency_ms'], elapsed_ms)
+                return response
+            finally:
+                self._update(in_flight=-1)
+                self._slots.release()
+
+            # 速率限制：指數退避 (加上抖動)，但不超過期限
+            delay = min(self.backoff_base * (2 ** attempt), self.backoff_max) * random.uniform(0.5, 1.0)
+            if time.monotonic() + delay >= deadline_at:
+                self._update(failed=1, timeouts=1)
+                raise TimeoutError(f"Gemini 速率限制，重試前已超過期限：{error}")
+            attempt += 1
+            self._update(retries=1)
+            time.sleep(delay)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['avg_latency_ms'] = stats['latency_ms'] / stats['ok'] if stats['ok'] else 0.0
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        return (f"[Gemini] 呼叫 {stats['calls']} 次 (成功 {stats['ok']}，失敗 {stats['failed']}，"
+                f"速率限制 {stats['rate_limited']}，重試 {stats['retries']}，逾時 {stats['timeouts']})，"
+                f"平均 {stats['avg_latency_ms']:.0f} ms / 最長 {stats['max_latency_ms']:.0f} ms，"
+                f"token 輸入 {stats['prompt_tokens']} / 輸出 {stats['output_tokens']}，上傳 {stats['bytes_sent']} bytes")
+
+
+gemini_client = GeminiClient(api_key=GEMINI_API_KEY)
+
+
+# --- 新功能：一次請求辨識多個欄位，要求 Gemini 回傳固定格式的 JSON ---
+# 欄位名稱 -> JSON 鍵名 (結構化輸出的鍵名使用英文，避免模型改寫中文鍵名)
+GEMINI_FIELD_NAMES = {
+    "病歷號": "patient_id",
+    "姓名": "patient_name",
+    "床號": "bed_number",
+    "住院備註": "notes",
+}
+
+PATIENT_LIST_ROW_FIELDS = ('patient_id', 'patient_name', 'admission_date', 'attending_doctor')
+
+
+# --- 新功能：縮小上傳到 Gemini 的影像 ---
+# 裁掉空白邊界、轉灰階、把文字高度縮到辨識所需即可，再挑選最小的無損 / 近無損編碼。
+GEMINI_TARGET_TEXT_HEIGHT = 20 # 像素
+GEMINI_UPLOAD_MARGIN = 4 # 裁切時保留的邊界
+GEMINI_UPLOAD_FORMATS = (
+    ('PNG', {'optimize': True}, 'image/png'),
+    ('WEBP', {'lossless': True, 'method': 6}, 'image/webp'),
+    ('WEBP', {'quality': 90, 'method': 6}, 'image/webp'), # 近無損，文字邊緣幾乎不受影響
+)
+
+
+def content_bounds(ink, margin=GEMINI_UPLOAD_MARGIN):
+    """回傳包住所有文字像素的 (top, bottom, left, right)，沒有文字時回傳整張圖。"""
+    h, w = ink.shape
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0:
+        return 0, h, 0, w
+    return (max(int(rows[0]) - margin, 0), min(int(rows[-1]) + margin + 1, h),
+            max(int(cols[0]) - margin, 0), min(int(cols[-1]) + margin + 1, w))
+
+
+def estimate_text_height(ink):
+    """以水平投影中連續有字的列數 (取中位數) 估計文字高度，找不到時回傳 None。"""
+    rows = ink.any(axis=1).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], rows, [0])))
+    runs = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    runs = runs[runs >= 3] # 忽略格線與雜點
+    return float(np.median(runs)) if runs.size else None
+
+
+def encode_gemini_image(region, target_text_height=GEMINI_TARGET_TEXT_HEIGHT):
+    """
+    把截圖編碼成要上傳的影像，回傳 ({'mime_type', 'data'}, 原始像素 bytes 數)。
+    文字只會縮小不會放大；沒有 numpy 時只做灰階與編碼。
+    """
+    if np is None:
+        image = as_pil_image(region)
+        raw_bytes = image.width * image.height * len(image.getbands())
+        image = image.convert('L')
+    else:
+        pixels = np.asarray(region)
+        raw_bytes = pixels.nbytes
+        gray = to_grayscale(pixels)
+        ink = binarize(gray) == 0
+        top, bottom, left, right = content_bounds(ink)
+        gray, ink = gray[top:bottom, left:right], ink[top:bottom, left:right]
+        image = Image.fromarray(np.ascontiguousarray(gray))
+        text_height = estimate_text_height(ink)
+        if text_height and text_height > target_text_height * 1.25:
+            ratio = target_text_height / text_height
+            image = image.resize((max(1, round(image.width * ratio)), max(1, round(image.height * ratio))), Image.LANCZOS)
+
+    best = None
+    for fmt, options, mime_type in GEMINI_UPLOAD_FORMATS:
+        buffer = io.BytesIO()
+        try:
+            image.save(buffer, fmt, **options)
+        except (OSError, KeyError, ValueError): # 這個 Pillow 沒有編譯該格式
+            continue
+        if best is None or buffer.tell() < len(best['data']):
+            best = {'mime_type': mime_type, 'data': buffer.getvalue()}
+    return best, raw_bytes
+
+
+def log_gemini_upload(label, parts, raw_bytes, elapsed_ms):
+    """記錄一次請求上傳的影像大小與往返時間。"""
+    sent = sum(len(part['data']) for part in parts)
+    ratio = sent / raw_bytes if raw_bytes else 0.0
+    print(f"[Gemini 上傳] {label}：{len(parts)} 張圖 {sent} bytes (原始 {raw_bytes} bytes，{ratio:.1%})，往返 {elapsed_ms:.0f} ms")
+
+
+def parse_gemini_json(text):
+    """解析 Gemini 的 JSON 回應 (容忍外層的 ``` 程式碼區塊)。"""
+    text = text.strip()
+    if text.startswith('```'):
+        text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+    return json.loads(text)
+
+
+def gemini_recognize_fields(model, crops):
+    """
+    把所有欄位的截圖放進同一個請求，回傳 {欄位名稱: 文字}。
+    每張圖片前都附上對應的 JSON 鍵名，讓模型知道哪張圖填哪個鍵。
+    """
+    names = {key: GEMINI_FIELD_NAMES.get(key, key) for key in crops}
+    schema = {
+        'type': 'OBJECT',
+        'properties': {name: {'type': 'STRING'} for name in names.values()},
+        'required': list(names.values()),
+    }
+    contents = ["以下每張圖片各是一個欄位的截圖。請直接辨識圖片中的文字，依照欄位鍵名填入 JSON 物件，"
+                "看不清楚的欄位填空字串，不要做任何總結或解釋。"]
+    parts, raw_bytes = [], 0
+    for key, image in crops.items():
+        part, size = encode_gemini_image(image)
+        parts.append(part)
+        raw_bytes += size
+        contents.append(f"欄位 {names[key]} ({key})：")
+        contents.append(part)
+    start = time.perf_counter()
+    response = model.generate_content(contents, generation_config={
+        'response_mime_type': 'application/json',
+        'response_schema': schema,
+    })
+    log_gemini_upload("欄位", parts, raw_bytes, (time.perf_counter() - start) * 1000)
+    data = parse_gemini_json(response.text)
+    return {key: get_ocr_field_profile(key).postprocess(str(data.get(name) or '')) for key, name in names.items()}
+
+
+def normalize_patient_row(row):
+    """整理一筆病人清單資料：去除空白，住院日期只保留前 7 碼數字。"""
+    row = {field: str(row.get(field) or '').strip() for field in PATIENT_LIST_ROW_FIELDS}
+    row['admission_date'] = ''.join(re.findall(r'\d+', row['admission_date']))[:7]
+    return row
+
+
+def gemini_recognize_patient_list(model, image):
+    """辨識整張病人清單截圖，回傳每位病人一個 dict 的列表。"""
+    schema = {
+        'type': 'ARRAY',
+        'items': {
+            'type': 'OBJECT',
+            'properties': {field: {'type': 'STRING'} for field in PATIENT_LIST_ROW_FIELDS},
+            'required': list(PATIENT_LIST_ROW_FIELDS),
+        },
+    }
+    prompt = ("這是一張尚未住院的病人清單截圖。請將每一位病人整理成一個 JSON 物件，"
+              "包含病歷號 (patient_id)、姓名 (patient_name)、住院日期 (admission_date) 和主治醫師 (attending_doctor)。"
+              "不要包含標題列。")
+    part, raw_bytes = encode_gemini_image(image)
+    start = time.perf_counter()
+    response = model.generate_content([prompt, part], generation_config={
+        'response_mime_type': 'application/json',
+        'response_schema': schema,
+    })
+    log_gemini_upload("住院清單", [part], raw_bytes, (time.perf_counter() - start) * 1000)
+    data = parse_gemini_json(response.text)
+    return [normalize_patient_row(row) for row in data if isinstance(row, dict)]
+
+
+def parse_patient_list_cells(parts):
+    """
+    把一列病人清單的各段文字整理成病人資料，格式不符 (或是標題列) 時回傳 None。
+    第一段為病歷號、最後一段為主治醫師，第一個含 7 碼以上數字的段落為住院日期，
+    病歷號與日期之間的所有段落合併為姓名 (姓名中可以有空白)。
+    """
+    if len(parts) < 4 or not re.search(r'\d', parts[0]):
+        return None
+    date_index = next((i for i in range(2, len(parts) - 1) if len(re.sub(r'\D', '', parts[i])) >= 7), 2)
+    return normalize_patient_row({
+        'patient_id': normalize_alnum_id(parts[0]),
+        'patient_name': ' '.join(parts[1:date_index]),
+        'admission_date': parts[date_index],
+        'attending_doctor': parts[-1],
+    })
+
+
+def parse_patient_list_line(text):
+    """解析本地 OCR 的一行病人清單文字 (以空白分段)，格式不符時回傳 None。"""
+    return parse_patient_list_cells(text.split())
+
+
+# --- 新功能：批次掃描的列 / 欄切割 ---
+# 以二值化後的水平投影切出每一位病人的列，再以整張表的垂直投影切出欄位，
+# 每列各自交給執行緒池辨識，耗時隨列數線性成長，也不需要 Gemini 金鑰。
+
+def segment_runs(projection, min_gap, min_length):
+    """切出投影中連續非零的區段 [(start, end), ...]；間隔不超過 min_gap 的區段視為同一段。"""
+    active = np.flatnonzero(projection > 0)
+    if active.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(active) > min_gap + 1)
+    starts = np.concatenate(([active[0]], active[breaks + 1]))
+    ends = np.concatenate((active[breaks], [active[-1]])) + 1
+    return [(int(start), int(end)) for start, end in zip(starts, ends) if end - start >= min_length]
+
+
+def segment_patient_list(region, pad=2):
+    """
+    把病人清單截圖切成 [[儲存格陣列, ...], ...] (每列一個 list，由左到右)。
+    欄位間距以文字高度為準：比一個字高還寬的空白才視為欄位分隔，所以姓名中的空白不會被切開。
+    """
+    pixels = np.asarray(region)
+    ink = binarize(to_grayscale(pixels), method='adaptive') == 0
+    # 去掉橫跨幾乎整張表的格線，避免相鄰的列或欄被連在一起
+    ink[ink.mean(axis=1) > 0.8, :] = False
+    ink[:, ink.mean(axis=0) > 0.8] = False
+    text_height = estimate_text_height(ink) or 12.0
+
+    rows = segment_runs(ink.sum(axis=1), min_gap=max(1, int(text_height * 0.25)), min_length=max(3, int(text_height * 0.5)))
+    columns = segment_runs(ink.sum(axis=0), min_gap=max(4, int(text_height)), min_length=2)
+    h, w = ink.shape
+    table = []
+    for top, bottom in rows:
+        cells = []
+        for left, right in columns:
+            if not ink[top:bottom, left:right].any():
+                continue # 這一列在這一欄沒有內容
+            cells.append(pixels[max(top - pad, 0):min(bottom + pad, h), max(left - pad, 0):min(right + pad, w)])
+        if cells:
+            table.append(cells)
+    return table
+
+
+def recognize_patient_list_row(cells):
+    """(背景執行緒) 逐格辨識一列，回傳病人資料 dict；無法解析時回傳 None。"""
+    profile = get_ocr_field_profile("住院清單儲存格")
+    texts = [profile.recognize_local(cell) for cell in cells]
+    return parse_patient_list_cells([text for text in texts if text])
+
+
+def recognize_patient_list_locally(image, keep_unparsed=False):
+    """
+    以本地 Tesseract 辨識整張病人清單，回傳病人資料 dict 的列表 (依畫面順序)。
+    keep_unparsed 為 True 時，無法解析的列以 None 保留，呼叫端可以算出解析成功的比例。
+    """
+    if np is None:
+        # 沒有 numpy 無法切割，退回整個區塊一次辨識
+        full_text = get_ocr_field_profile("住院清單").recognize_local(image)
+        rows = [parse_patient_list_line(line) for line in full_text.split('\n') if line.strip()]
+    else:
+        rows = list(get_ocr_executor().map(recognize_patient_list_row, segment_patient_list(image)))
+    return rows if keep_unparsed else [row for row in rows if row is not None]
+
+
+PATIENT_LIST_MIN_PARSE_RATIO = 0.8 # 本地解析成功的列數低於這個比例時改用 Gemini
+PATIENT_LIST_DATE_PATTERN = re.compile(r'\d{7}') # 民國年 YYYMMDD
+
+def is_valid_patient_row(row):
+    """病歷號與住院日期的格式是否正確 (本地辨識看錯字時通常會在這裡露出破綻)。"""
+    id_pattern = get_ocr_field_profile("病歷號").pattern
+    return ((id_pattern is None or id_pattern.fullmatch(row.get('patient_id', '')) is not None)
+            and PATIENT_LIST_DATE_PATTERN.fullmatch(row.get('admission_date', '')) is not None)
+
+
+def patient_list_needs_ai(rows, segmented):
+    """
+    本地結果是否應該交給 Gemini 重新辨識：一列都沒有、解析成功的列數比例太低
+    (segmented 為切出的列數，其中一列視為標題列)，或任何一列的病歷號 / 住院日期格式不對。
+    """
+    if not rows:
+        return True
+    if segmented > 1 and len(rows) < PATIENT_LIST_MIN_PARSE_RATIO * (segmented - 1):
+        return True
+    return not all(is_valid_patient_row(row) for row in rows)
+
+
+def format_ocr_timings(capture_ms, field_timings):
+    """將擷取與各欄位辨識的耗時整理成一行記錄。"""
+    parts = [f"擷取 {capture_ms:.1f} ms"]
+    parts += [f"{key} 辨識 {ms:.1f} ms" for key, ms in field_timings.items()]
+    return "[OCR 計時] " + " | ".join(parts)
+
+
 class AddPatientDialog(simpledialog.Dialog):
     """自訂對話框，用於一次性輸入病人的 ID, Name 和 Bed Number。"""
     def __init__(self, parent, title, doctor_colors):
         self.doctor_colors = doctor_colors
+        self._ocr_run_id = 0 # 每一輪偵測的編號，用來丟棄已取消的結果
+        self._ocr_state = None
+        self._watcher = None # 螢幕監看模式 (勾選後才建立)
+        self._watch_pending = False # 監看偵測到變化時正在辨識，結束後再補跑一次
         super().__init__(parent, title)
 
     def body(self, master):
@@ -138,6 +1511,24 @@ class AddPatientDialog(simpledialog.Dialog):
         # --- 最終解決方案：將所有點擊事件綁定到分派器，以繞過 simpledialog 的攔截 ---
         detect_btn.bind("<Button>", self._handle_detect_button_click)
 
+        # --- 新功能：辨識進度與取消按鈕 (辨識時才顯示) ---
+        self.ocr_progress_frame = tk.Frame(master)
+        self.ocr_progress_frame.grid(row=6, columnspan=2, sticky='ew', pady=(0, 5))
+        self.ocr_progress = ttk.Progressbar(self.ocr_progress_frame, mode='determinate', length=150)
+        self.ocr_progress.pack(side='left', padx=5)
+        self.ocr_status_var = tk.StringVar()
+        tk.Label(self.ocr_progress_frame, textvariable=self.ocr_status_var, font=("Segoe UI", 9)).pack(side='left')
+        tk.Button(self.ocr_progress_frame, text="取消", command=self.cancel_ocr, font=("Segoe UI", 8)).pack(side='right', padx=5)
+        self.ocr_progress_frame.grid_remove()
+
+        # --- 新功能：螢幕監看模式 (選用)：記憶範圍的內容改變時自動偵測 ---
+        self.watch_var = tk.BooleanVar(value=False)
+        watch_state = tk.NORMAL if OCR_ENABLED and np is not None else tk.DISABLED
+        tk.Checkbutton(master, text="監看畫面，內容改變時自動偵測", variable=self.watch_var, state=watch_state,
+                       command=self.toggle_watch_mode, font=("Segoe UI", 9)).grid(row=7, columnspan=2, sticky='w')
+        self.watch_status_var = tk.StringVar()
+        tk.Label(master, textvariable=self.watch_status_var, font=("Segoe UI", 8), fg="#555555").grid(row=8, columnspan=2, sticky='w')
+
         return self.id_entry # initial focus
 
     def validate(self):
@@ -179,6 +1570,11 @@ class AddPatientDialog(simpledialog.Dialog):
         
         # 如果有記憶的範圍且不是強制重選，則直接使用
         if hasattr(self.master, 'capture_bboxes') and self.master.capture_bboxes and not force_reselect:
+            # --- 新功能：先以錨點確認 HIS 視窗是否移動，移動了就跟著平移範圍 ---
+            relocated, moved = self.master.relocate_capture_bboxes(self.master.capture_bboxes)
+            if moved:
+                self.master.capture_bboxes = relocated
+                self.master._save_capture_settings()
             self._perform_ocr_on_multiple_bboxes(self.master.capture_bboxes)
         else:
             # 否則，啟動新的多框選取流程
@@ -201,6 +1597,11 @@ class AddPatientDialog(simpledialog.Dialog):
         reselect_menu.add_command(label="全部重新選取", command=self.force_detect_from_screen)
         main_menu.add_cascade(label="重新選取偵測範圍", menu=reselect_menu)
 
+        # --- 新功能：錨點自動定位開關 ---
+        anchor_var = tk.BooleanVar(value=self.master.anchor_locator.enabled)
+        main_menu.add_checkbutton(label="錨點自動定位 (視窗移動後自動找回範圍)", variable=anchor_var,
+                                  command=lambda: self.master.set_anchor_mode(anchor_var.get()))
+
         # --- 最終解決方案：將批次掃描功能整合至此 ---
         main_menu.add_separator()
         main_menu.add_command(label="批次掃描(住院清單)", command=self.detect_new_patients_from_screen)
@@ -299,118 +1700,267 @@ class AddPatientDialog(simpledialog.Dialog):
                 else:
                     # 如果是全部重選，則完全替換
                     self.master.capture_bboxes = self.temp_bboxes
+                # --- 新功能：記下各範圍旁的標籤作為錨點 (選取視窗關閉後才擷取，避免拍到半透明遮罩) ---
+                self.update_idletasks()
+                self.master.learn_capture_anchors(self.temp_bboxes)
                 self._perform_ocr_on_multiple_bboxes(self.master.capture_bboxes)
             else:
                 # 更新提示，準備選取下一個區域
                 self.prompt_label.config(text=f"請選取第 {self.capture_step + 1} 個區域：{self.capture_prompts[self.capture_step]}")
                 self.rect = None # 重置矩形以便下次繪製
 
-    def _perform_ocr_on_multiple_bboxes(self, bboxes):
-        """在多個指定的 Bounding Box 上執行 OCR。"""
+    def toggle_watch_mode(self):
+        if not self.watch_var.get():
+            if self._watcher:
+                self._watcher.stop()
+            self.watch_status_var.set("")
+            return
+        if not getattr(self.master, 'capture_bboxes', None):
+            messagebox.showwarning("無法監看", "請先用「螢幕範圍偵測」選取要監看的範圍。", parent=self)
+            self.watch_var.set(False)
+            return
+        if self._watcher is None:
+            self._watcher = ScreenWatcher(lambda: self.master.capture_bboxes, self._post_watch_change)
+        self._watcher.start()
+        self._refresh_watch_status()
+
+    def _post_watch_change(self):
+        """(背景執行緒) 監看到畫面改變，交回 Tk 主執行緒辨識。"""
+        try:
+            self.after(0, self._on_watch_change)
+        except (RuntimeError, tk.TclError):
+            pass
+
+    def _on_watch_change(self):
+        if not self.watch_var.get():
+            return
+        if self._ocr_state is not None:
+            self._watch_pending = True # 正在辨識中，完成後再跑一次
+            return
+        self._perform_ocr_on_multiple_bboxes(self.master.capture_bboxes, silent=True)
+
+    def _refresh_watch_status(self):
+        """每秒更新一次監看的統計。"""
+        if not self.watch_var.get() or self._watcher is None:
+            return
+        stats = self._watcher.stats()
+        self.watch_status_var.set(f"監看中 {stats['fps']:.1f} fps，略過 {stats['skip_rate']:.0%}，"
+                                  f"觸發辨識 {stats['triggers']} 次，CPU {stats['cpu_usage']:.1%}")
+        self.after(1000, self._refresh_watch_status)
+
+    def _perform_ocr_on_multiple_bboxes(self, bboxes, silent=False):
+        """
+        在多個指定的 Bounding Box 上執行 OCR。
+        --- 新功能：各欄位交給背景執行緒池同時辨識，完成一個就填入一個，不再凍結對話框 ---
+        silent: 監看模式觸發時不彈出結果視窗，只填入欄位。
+        """
+        self.cancel_ocr() # 如果上一輪還沒跑完，先作廢
+
         # --- 最終解決方案：在辨識前清空所有欄位 ---
         self.id_entry.delete(0, tk.END)
         self.name_entry.delete(0, tk.END)
         self.bed_entry.delete(0, tk.END)
         self.detected_notes = ""
 
-        results = {}
-        # --- 新增功能：建立 Gemini AI 模型實例 ---
-        gemini_model = None
-        if genai and GEMINI_API_KEY:
-            try:
-                # --- 最終解決方案：更新為最新、最穩定的 Gemini 視覺模型 ---
-                # 請將下方的模型名稱，替換為您執行 check_models.py 後，
-                # 實際在您可用列表中的那個視覺模型名稱。'flash' 模型速度更快且免費額度更高。
-                gemini_model = genai.GenerativeModel('models/gemini-2.5-flash')
-            except Exception as e:
-                print(f"無法初始化 Gemini 模型: {e}")
-
-        def perform_gemini_ocr(image, model):
-            """使用 Gemini AI 進行 OCR 辨識"""
-            if not model:
-                return "Gemini AI 未配置"
-            try:
-                response = model.generate_content(["請直接辨識並輸出這張圖片中的所有文字，不要做任何總結或解釋。", image])
-                return response.text.strip()
-            except Exception as e:
-                return f"Gemini AI 辨識錯誤: {e}"
+        # --- 新功能：使用共用的 Gemini 用戶端 (第一次呼叫時才建立模型) ---
+        gemini_model = gemini_client if gemini_client.available() else None
 
-        for key, bbox in bboxes.items():
-            try:
-                screenshot = ImageGrab.grab(bbox=bbox)
-
-                # --- 最終解決方案：梳理辨識邏輯 ---
-                # 對於「姓名」和「住院備註」，優先使用 Gemini AI
-                if key in ["姓名", "住院備註"]:
-                    if gemini_model:
-                        ocr_text = perform_gemini_ocr(screenshot, gemini_model)
-                    else:
-                        # 如果 Gemini 不可用，則退回使用 Tesseract 作為備用方案
-                        if key == "住院備註":
-                            # 對備註使用圖像預處理和 PSM 11
-                            gray_image = screenshot.convert('L')
-                            binary_image = gray_image.point(lambda p: 0 if p < 128 else 255, '1')
-                            config = '--oem 1 --psm 11 -c preserve_interword_spaces=1'
-                            ocr_text = pytesseract.image_to_string(binary_image, lang='chi_tra+eng', config=config).strip()
-                            # 移除空行
-                            lines = ocr_text.split('\n')
-                            non_empty_lines = [line for line in lines if line.strip()]
-                            ocr_text = '\n'.join(non_empty_lines)
-                        else: # 姓名
-                            config = '--psm 7'
-                            ocr_text = pytesseract.image_to_string(screenshot, lang='chi_tra+eng', config=config).strip()
-                else:
-                    # 對於單行的病歷號、姓名、床號，使用 PSM 7 (視為單行文字) 更準確
-                    config = '--psm 7'
-                    ocr_text = pytesseract.image_to_string(screenshot, lang='chi_tra+eng', config=config).strip()
-
-                results[key] = ocr_text
-            except Exception as e:
-                messagebox.showerror("截圖或辨識錯誤", f"處理區域 '{key}' 時出錯：\n{e}", parent=self)
-                return
-        
-        # 將辨識結果填入對應的欄位
-        self.id_entry.insert(0, results.get("病歷號", ""))
-        self.name_entry.insert(0, results.get("姓名", ""))
-        self.detected_notes = results.get("住院備註", "")
+        # --- 新功能：一次擷取所有範圍的聯集，再從同一張畫面裁切各欄位 ---
+        try:
+            capture_start = time.perf_counter()
+            frame = ScreenFrame.grab(bboxes.values())
+            capture_ms = (time.perf_counter() - capture_start) * 1000
+            crops = {key: frame.crop(bbox) for key, bbox in bboxes.items()} # 陣列視圖，前處理在背景執行緒進行
+        except Exception as e:
+            if silent:
+                # 監看模式在背景觸發，擷取失敗只記錄，下一次畫面變化時會再試
+                print(f"監看模式擷取螢幕畫面時出錯: {e}")
+            else:
+                messagebox.showerror("截圖錯誤", f"擷取螢幕畫面時出錯：\n{e}", parent=self)
+            return
 
-        # --- 最終解決方案：根據使用者提供的精確規則，對床號進行後處理 ---
-        bed_text = results.get("床號", "")
-        
-        # 1. 清理文字，移除所有非字母和數字的符號
-        cleaned_bed_text = re.sub(r'[^A-Za-z0-9]', '', bed_text).upper()
+        self._ocr_run_id += 1
+        run_id = self._ocr_run_id
+        self._ocr_state = {'run_id': run_id, 'pending': set(crops), 'results': {}, 'errors': {},
+                           'timings': {}, 'capture_ms': capture_ms, 'start': time.perf_counter(), 'futures': [],
+                           'crops': crops, 'gemini_model': gemini_model, 'silent': silent,
+                           'escalate': {}} # escalate: key -> (截圖, 快取鍵)
+        self.ocr_progress.config(maximum=len(crops), value=0)
+        self.ocr_status_var.set(f"辨識中 0/{len(crops)}")
+        self.ocr_progress_frame.grid()
+
+        executor = get_ocr_executor()
+        for key, image in crops.items():
+            future = executor.submit(self._recognize_field, key, image, gemini_model is not None)
+            future.add_done_callback(lambda f, k=key: self._post_field_result(run_id, k, f))
+            self._ocr_state['futures'].append(future)
+
+    @staticmethod
+    def _recognize_field(key, screenshot, ai_available):
+        """
+        (背景執行緒) 以本地 Tesseract 辨識單一欄位，不可在此操作任何 Tk 元件。
+        回傳 (文字, 耗時 ms, 是否需要升級到 AI, 快取鍵)。需要升級的欄位不寫入快取，
+        等 AI 批次結果回來後再寫入。
+        """
+        field_start = time.perf_counter()
+
+        # --- 新功能：依欄位設定檔，先本地辨識，信心不足或格式不符才升級到 Gemini ---
+        profile = get_ocr_field_profile(key)
+        use_ai = profile.use_ai and ai_available
+
+        # --- 新功能：畫面沒變的欄位直接使用快取結果 ---
+        cache_key = ocr_result_cache.make_key(key, profile.cache_key('cascade' if use_ai else 'local'), screenshot)
+        cached = ocr_result_cache.get(cache_key)
+        if cached is not None:
+            return cached, (time.perf_counter() - field_start) * 1000, False, cache_key
+
+        tier_start = time.perf_counter()
+        ocr_text, confidence = profile.recognize_local_with_confidence(screenshot)
+        ocr_cascade_stats.record_tier('local', (time.perf_counter() - tier_start) * 1000)
+
+        escalate = use_ai and not profile.is_acceptable(ocr_text, confidence)
+        ocr_cascade_stats.record_field(escalate)
+        if not escalate:
+            ocr_result_cache.put(cache_key, ocr_text)
+        return ocr_text, (time.perf_counter() - field_start) * 1000, escalate, cache_key
+
+    @staticmethod
+    def _recognize_fields_with_ai(gemini_model, escalate):
+        """(背景執行緒) 把所有需要升級的欄位放進同一個 Gemini 請求，回傳 ({欄位: 文字}, 耗時 ms)。"""
+        start = time.perf_counter()
+        try:
+            results = gemini_recognize_fields(gemini_model, {key: image for key, (image, _) in escalate.items()})
+        finally:
+            ocr_cascade_stats.record_tier('ai', (time.perf_counter() - start) * 1000)
+        for key, text in results.items():
+            ocr_result_cache.put(escalate[key][1], text)
+        return results, (time.perf_counter() - start) * 1000
+
+    def _post_ai_result(self, run_id, future):
+        """(背景執行緒) 把 AI 批次結果交回 Tk 主執行緒。"""
+        if future.cancelled() or run_id != self._ocr_run_id:
+            return
+        try:
+            self.after(0, self._on_ai_recognized, run_id, future)
+        except (RuntimeError, tk.TclError):
+            pass
+
+    def _on_ai_recognized(self, run_id, future):
+        """AI 批次辨識完成：覆寫升級欄位的本地結果。失敗時保留本地結果並顯示錯誤。"""
+        state = self._ocr_state
+        if not state or state['run_id'] != run_id:
+            return
+        try:
+            results, elapsed_ms = future.result()
+            state['timings']['AI 批次'] = elapsed_ms
+            for key, text in results.items():
+                state['results'][key] = text
+                self._fill_field(key, text)
+        except Exception as e:
+            state['errors']['Gemini AI'] = e
+        self._finish_ocr(state)
 
-        # 2. 嘗試匹配 ICU 格式 (ICUA/ICUB + 2位數字，例如 ICUA-12)
-        icu_match = re.match(r'^(ICUA|ICUB)(\d{2})$', cleaned_bed_text)
-        if icu_match:
-            bed_text = f"{icu_match.group(1)}-{icu_match.group(2)}"
+    def _post_field_result(self, run_id, key, future):
+        """(背景執行緒) 把結果交回 Tk 主執行緒處理。"""
+        if future.cancelled() or run_id != self._ocr_run_id:
+            return
+        try:
+            self.after(0, self._on_field_recognized, run_id, key, future)
+        except (RuntimeError, tk.TclError):
+            pass # 對話框已關閉
+
+    def _on_field_recognized(self, run_id, key, future):
+        """單一欄位辨識完成：立即填入對應的輸入框並更新進度。"""
+        state = self._ocr_state
+        if not state or state['run_id'] != run_id or key not in state['pending']:
+            return # 已取消或是舊一輪的結果
+        state['pending'].discard(key)
+        try:
+            text, elapsed_ms, escalate, cache_key = future.result()
+            state['results'][key] = text
+            state['timings'][key] = elapsed_ms
+            if escalate:
+                state['escalate'][key] = (state['crops'][key], cache_key)
+        except Exception as e:
+            state['errors'][key] = e
+            text = ""
+        self._fill_field(key, text) # 先填入本地結果，AI 結果回來後再覆寫
+
+        done = int(self.ocr_progress.cget('maximum')) - len(state['pending'])
+        self.ocr_progress.config(value=done)
+        self.ocr_status_var.set(f"辨識中 {done}/{int(self.ocr_progress.cget('maximum'))}")
+        if state['pending']:
+            return
+        if state['escalate']:
+            # --- 新功能：所有欄位的本地辨識完成後，只發出一個 Gemini 請求 ---
+            self.ocr_status_var.set(f"AI 辨識 {len(state['escalate'])} 個欄位…")
+            future = get_ocr_executor().submit(self._recognize_fields_with_ai, state['gemini_model'], state['escalate'])
+            future.add_done_callback(lambda f: self._post_ai_result(run_id, f))
+            state['futures'].append(future)
         else:
-            # 3. 嘗試匹配新的特定床號格式 (例如 7B26402 -> 7B26-02)
-            new_specific_match = re.match(r'^(\d[A-Z]\d{2})\d(\d{2})$', cleaned_bed_text)
-            if new_specific_match:
-                bed_text = f"{new_specific_match.group(1)}-{new_specific_match.group(2)}" # 組合第一組和第二組
-            else:
-                # 4. 嘗試匹配舊的普通床號格式 (1位數字 + 1位字母 + 4位數字，例如 1A1234 -> 1A12-34)
-                normal_match = re.match(r'^(\d[A-Z])(\d{4})$', cleaned_bed_text)
-                if normal_match:
-                    bed_text = f"{normal_match.group(1)}{normal_match.group(2)[:2]}-{normal_match.group(2)[2:]}"
-                else:
-                    # 5. 作為備用，檢查 1A1 -> 1A-1 格式
-                    if len(cleaned_bed_text) == 3 and cleaned_bed_text[0].isdigit() and cleaned_bed_text[1].isalpha() and cleaned_bed_text[2].isdigit():
-                        bed_text = f"{cleaned_bed_text[:2]}-{cleaned_bed_text[2]}"
-
-        self.bed_entry.insert(0, bed_text)
+            self._finish_ocr(state)
+
+    def _fill_field(self, key, text):
+        entry = {"病歷號": self.id_entry, "姓名": self.name_entry, "床號": self.bed_entry}.get(key)
+        if entry is not None:
+            entry.delete(0, tk.END)
+            entry.insert(0, text)
+        elif key == "住院備註":
+            self.detected_notes = text
+
+    def _finish_ocr(self, state):
+        """所有欄位都完成後，顯示計時與結果。"""
+        self._ocr_state = None
+        self.ocr_progress_frame.grid_remove()
+        total_ms = (time.perf_counter() - state['start']) * 1000
+        print(format_ocr_timings(state['capture_ms'], state['timings']) + f" | 總計 {total_ms:.1f} ms")
+        cache_stats = ocr_result_cache.stats()
+        print(f"[OCR 快取] 命中率 {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})，"
+              f"{cache_stats['entries']} 筆 / {cache_stats['bytes']} bytes，過期 {cache_stats['expired']}，淘汰 {cache_stats['evictions']}")
+        print(ocr_cascade_stats.summary())
+        print(gemini_client.summary())
+
+        results = state['results']
+        if state['silent']:
+            for key, error in state['errors'].items():
+                print(f"監看模式辨識 '{key}' 時出錯: {error}")
+            if self._watch_pending:
+                self._watch_pending = False
+                self._on_watch_change()
+            return
+        for key, error in state['errors'].items():
+            messagebox.showerror("截圖或辨識錯誤", f"處理區域 '{key}' 時出錯：\n{error}", parent=self)
 
         # 顯示最終結果
         result_text = (
-            f"病歷號: {results.get('病歷號', '未偵測到')}\n"
-            f"姓名: {results.get('姓名', '未偵測到')}\n"
-            f"床號: {bed_text if bed_text else '未偵測到'}\n"
-            f"住院備註: {results.get('住院備註', '未偵測到')}"
+            f"病歷號: {results.get('病歷號') or '未偵測到'}\n"
+            f"姓名: {results.get('姓名') or '未偵測到'}\n"
+            f"床號: {results.get('床號') or '未偵測到'}\n"
+            f"住院備註: {results.get('住院備註') or '未偵測到'}"
         )
         messagebox.showinfo("螢幕偵測結果", result_text, parent=self)
         self.master.grab_set()
 
+    def cancel_ocr(self, event=None):
+        """取消進行中的辨識：尚未開始的欄位直接取消，進行中的結果會被丟棄。"""
+        state = self._ocr_state
+        if not state:
+            return
+        self._ocr_state = None
+        self._ocr_run_id += 1
+        for future in state['futures']:
+            future.cancel()
+        try:
+            self.ocr_progress_frame.grid_remove()
+        except tk.TclError:
+            pass
+
+    def destroy(self):
+        if self._watcher:
+            self._watcher.stop()
+        self.cancel_ocr()
+        super().destroy()
+
     def force_detect_from_screen(self, event=None):
         """Shift + 點擊：強制重新選取範圍。"""
         self._execute_detection(force_reselect=True)
@@ -499,9 +2049,16 @@ class EditPatientDialog(simpledialog.Dialog):
 
 class PasteOptionsDialog(simpledialog.Dialog):
     """在貼上前，提供性別和左右側選擇的對話框。"""
+    def __init__(self, parent, title, patient_label=None):
+        self.patient_label = patient_label # 片語含病人欄位時，顯示將代入的病人
+        super().__init__(parent, title)
+
     def body(self, master):
         self.result = {"gender": None, "laterality": None}
 
+        if self.patient_label:
+            tk.Label(master, text=f"代入病人: {self.patient_label}", font=("Segoe UI", 10, "bold")).pack(pady=(5, 0), padx=10, anchor='w')
+
         # --- 性別選擇 ---
         gender_frame = tk.Frame(master)
         gender_frame.pack(pady=5, padx=10, fill='x')
@@ -605,40 +2162,351 @@ class DoctorManagerWindow(tk.Toplevel):
             self.populate_list()
             self.parent.update_patient_selector() # 更新主視窗的下拉選單
 
+class PatientSimilarityIndex:
+    """
+    --- 新功能：病歷號 / 姓名的近似重複索引 ---
+    OCR 看錯一個字就會產生重複的病人，逐一比對編輯距離又太慢，所以改用「刪除一個字元」的鄰域索引：
+    每個字串連同所有少一個字元的變體都登記在索引中，查詢時只要查自己的變體，
+    就能在幾個 dict 查詢內找出編輯距離 <= 1 的候選 (取代、插入、刪除各一個字元)。
+    病歷號在索引前先把 OCR 常混淆的字元 (O/0、I/1、S/5 ...) 統一。
+    """
+    ID_CONFUSABLES = str.maketrans({'O': '0', 'D': '0', 'Q': '0', 'I': '1', 'L': '1', 'Z': '2', 'S': '5', 'B': '8', 'G': '6'})
+
+    def __init__(self):
+        self.entries = {}  # patient_id -> (folded_id, name)
+        self.id_postings = {}  # 變體 -> set(patient_id)
+        self.name_postings = {}
+
+    @classmethod
+    def fold_id(cls, patient_id):
+        return normalize_alnum_id(patient_id).translate(cls.ID_CONFUSABLES)
+
+    @staticmethod
+    def fold_name(name):
+        return normalize_cjk_name(name).replace(' ', '').lower()
+
+    @staticmethod
+    def _variants(text):
+        return {text} | {text[:i] + text[i + 1:] for i in range(len(text))}
+
+    @staticmethod
+    def within_one_edit(a, b):
+        """編輯距離是否 <= 1 (線性時間)。"""
+        if abs(len(a) - len(b)) > 1:
+            return False
+        if len(a) > len(b):
+            a, b = b, a
+        i = 0
+        while i < len(a) and a[i] == b[i]:
+            i += 1
+        if len(a) == len(b):
+            return a[i + 1:] == b[i + 1:]
+        return a[i:] == b[i + 1:]
+
+    def _index(self, postings, text, patient_id, add):
+        if not text:
+            return
+        for variant in self._variants(text):
+            if add:
+                postings.setdefault(variant, set()).add(patient_id)
+            else:
+                bucket = postings.get(variant)
+                if bucket is not None:
+                    bucket.discard(patient_id)
+                    if not bucket:
+                        del postings[variant]
+
+    def add(self, patient_id, name):
+        self.remove(patient_id)
+        entry = (self.fold_id(patient_id), self.fold_name(name or ''))
+        self.entries[patient_id] = entry
+        self._index(self.id_postings, entry[0], patient_id, True)
+        self._index(self.name_postings, entry[1], patient_id, True)
+
+    def remove(self, patient_id):
+        entry = self.entries.pop(patient_id, None)
+        if entry is not None:
+            self._index(self.id_postings, entry[0], patient_id, False)
+            self._index(self.name_postings, entry[1], patient_id, False)
+
+    def sync(self, all_patients_data):
+        """依目前的病人資料增刪索引 (只處理有變動的病人)。"""
+        current = {pid: pdata.get('patient_name', '') for pid, pdata in all_patients_data.items()
+                   if not pid.startswith("__") and isinstance(pdata, dict)}
+        for patient_id in [pid for pid in self.entries if pid not in current]:
+            self.remove(patient_id)
+        for patient_id, name in current.items():
+            entry = self.entries.get(patient_id)
+            if entry is None or entry[1] != self.fold_name(name or ''):
+                self.add(patient_id, name)
+
+    def _candidates(self, postings, text):
+        found = set()
+        for variant in self._variants(text):
+            found |= postings.get(variant, set())
+        return found
+
+    def find_similar(self, patient_id, name):
+        """
+        回傳可能重複的 [(既有病歷號, 原因), ...]。病歷號完全相同的不算 (那是「已存在」)。
+        姓名只有 3 個字以上才允許差一個字，兩個字的姓名必須完全相同，避免同姓的人都被標示。
+        """
+        folded_id, folded_name = self.fold_id(patient_id), self.fold_name(name or '')
+        matches = []
+        if folded_id:
+            for candidate in self._candidates(self.id_postings, folded_id):
+                if candidate != patient_id and self.within_one_edit(folded_id, self.entries[candidate][0]):
+                    matches.append((candidate, "病歷號相近"))
+        if folded_name:
+            seen = {candidate for candidate, _ in matches}
+            candidates = self._candidates(self.name_postings, folded_name) if len(folded_name) >= 3 else self.name_postings.get(folded_name, set())
+            for candidate in candidates:
+                if candidate == patient_id or candidate in seen:
+                    continue
+                other = self.entries[candidate][1]
+                if other == folded_name or (len(folded_name) >= 3 and self.within_one_edit(folded_name, other)):
+                    matches.append((candidate, "姓名相似"))
+        return matches
+
+
+class PatientCensus:
+    """
+    --- 新功能：病人名冊索引 ---
+    選擇器每次打開都要掃過所有病人、逐項檢查未完成的待辦事項再重新排序，病人一多就會卡頓。
+    這裡為每位病人快取顯示文字、標籤符號與未完成數量，並維護「依床號」與「依住院日期」兩個排序清單，
+    資料變動 (儲存或收到遠端更新) 時由呼叫端 sync，只重算有變動的病人；單純切換選擇時只讀取快取。
+    """
+
+    def __init__(self):
+        self.entries = {}  # patient_id -> 快取的顯示資料
+        self.by_bed = []  # 有床號的病人 [(床號, patient_id)]
+        self.by_admission = []  # 沒有床號的病人 [(住院日期, patient_id)]
+        self._version = 0 # 每次新增或移除病人時遞增，views 的快取以此判斷是否失效
+        self._views_cache = None # (today, version, 結果)
+
+    @staticmethod
+    def today_key():
+        """今天的民國年日期字串 (YYYMMDD)，與 admission_date 的格式相同。"""
+        now = datetime.now()
+        return f"{now.year - 1911}{now.month:02d}{now.day:02d}"
+
+    @staticmethod
+    def _signature(pdata):
+        # 不掃描待辦事項的勾選狀態；勾選變動由 sync 的 touched 參數指定重算
+        return (id(pdata), pdata.get('patient_name', ''), pdata.get('bed_number') or '', pdata.get('admission_date') or '',
+                pdata.get('attending_doctor', '未指派'), tuple(pdata.get('tags', [])), len(pdata.get('items', [])), pdata.get('unchecked'))
+
+    @staticmethod
+    def describe(pdata):
+        """回傳 (未完成數量, 標籤符號, 顯示文字)。只載入摘要的病人沒有 items，改用伺服器算好的 unchecked。"""
+        tags = pdata.get('tags', [])
+        tags_prefix = ("▲" if 'surgery' in tags else "") + ("★" if 'discharge' in tags else "")
+        if 'items' in pdata:
+            unchecked = sum(1 for item in pdata['items'] if not item.get('checked', False))
+        else:
+            unchecked = pdata.get('unchecked', 0)
+        display_text = f"{pdata.get('patient_id', '')} - {pdata.get('patient_name', '')}"
+        bed = pdata.get('bed_number', '')
+        if bed:
+            display_text += f" ({bed})"
+        return unchecked, tags_prefix, display_text
+
+    @staticmethod
+    def _insert(view, key):
+        bisect.insort(view, key)
+
+    @staticmethod
+    def _discard(view, key):
+        index = bisect.bisect_left(view, key)
+        if index < len(view) and view[index] == key:
+            del view[index]
+
+    def update(self, patient_id, pdata):
+        self.remove(patient_id)
+        unchecked, tags_prefix, display_text = self.describe(pdata)
+        entry = {
+            'signature': self._signature(pdata),
+            'unchecked': unchecked,
+            'tags_prefix': tags_prefix,
+            'display_text': display_text,
+            'doctor': pdata.get('attending_doctor', '未指派'),
+            'bed': pdata.get('bed_number') or '',
+            'admission_date': pdata.get('admission_date') or '',
+        }
+        self.entries[patient_id] = entry
+        self._version += 1
+        if entry['bed']:
+            self._insert(self.by_bed, (entry['bed'], patient_id))
+        else:
+            self._insert(self.by_admission, (entry['admission_date'], patient_id))
+
+    def remove(self, patient_id):
+        entry = self.entries.pop(patient_id, None)
+        if entry is None:
+            return
+        self._version += 1
+        if entry['bed']:
+            self._discard(self.by_bed, (entry['bed'], patient_id))
+        else:
+            self._discard(self.by_admission, (entry['admission_date'], patient_id))
+
+    def sync(self, all_patients_data, touched=()):
+        """依目前的病人資料更新索引；只有欄位變動或列在 touched 中的病人會重算待辦事項。"""
+        current = {pid: pdata for pid, pdata in all_patients_data.items()
+                   if not pid.startswith("__") and isinstance(pdata, dict)}
+        for patient_id in [pid for pid in self.entries if pid not in current]:
+            self.remove(patient_id)
+        for patient_id, pdata in current.items():
+            entry = self.entries.get(patient_id)
+            if entry is None or patient_id in touched or entry['signature'] != self._signature(pdata):
+                self.update(patient_id, pdata)
+
+    def label(self, patient_id):
+        """選擇器上顯示的文字 (未完成符號 + 標籤 + 病人資訊)。"""
+        entry = self.entries[patient_id]
+        prefix = "● " if entry['unchecked'] else ""
+        return f"{prefix}{entry['tags_prefix']}{entry['display_text']}"
+
+    def views(self, today=None):
+        """
+        回傳 (住院病人, 尚未住院病人) 兩個 patient_id 清單。
+        住院病人：有床號，或住院日期已到 (<= 今天)，依床號排序 (沒有床號的排最前面)；
+        尚未住院：沒有床號且住院日期在未來，依住院日期排序。
+        """
+        today = today or self.today_key()
+        if self._views_cache and self._views_cache[:2] == (today, self._version):
+            return self._views_cache[2]
+        split = bisect.bisect_right(self.by_admission, (today, chr(0x10FFFF)))
+        admitted = [pid for date, pid in self.by_admission[:split] if date]
+        upcoming = tuple(pid for _, pid in self.by_admission[split:])
+        result = tuple(admitted) + tuple(pid for _, pid in self.by_bed), upcoming
+        self._views_cache = (today, self._version, result)
+        return result
+
+
 class BatchAddConfirmDialog(simpledialog.Dialog):
-    """批次新增病人的確認對話框。"""
-    def __init__(self, parent, new_patients):
-        self.new_patients = new_patients
-        self.check_vars = []
+    """
+    批次新增病人的確認對話框。
+    --- 新功能：邊掃描邊顯示 ---
+    傳入 start_stream 時，對話框開啟後會呼叫 start_stream(self)，由呼叫端在背景辨識，
+    再於 Tk 主執行緒呼叫 add_patient / set_status / finish_stream 逐筆加入。
+    使用者可以先確認已出現的項目；按「停止掃描」或關閉對話框時會呼叫 on_stop 停止剩下的辨識。
+    已存在、本次重複或與既有病人近似 (可能是 OCR 看錯字) 的項目會即時標示，預設不勾選。
+    """
+    def __init__(self, parent, new_patients=(), existing_ids=(), start_stream=None, on_stop=None, similarity_index=None):
+        self.new_patients = list(new_patients)
+        self.rows = {} # 排序鍵 -> (勾選變數, 病人資料, Checkbutton)
+        self.row_keys = [] # 依畫面順序排列的排序鍵
+        self.existing_ids = existing_ids
+        self.similarity_index = similarity_index # 近似重複 (OCR 看錯字) 的檢查
+        self.seen_ids = set()
+        self.start_stream = start_stream
+        self.on_stop = on_stop
+        self.streaming = start_stream is not None
         super().__init__(parent, "確認批次新增")
 
     def body(self, master):
         tk.Label(master, text="偵測到以下新病人，請勾選要新增的項目：", font=("Segoe UI", 10)).pack(pady=5, padx=10, anchor='w')
-        
+        self.status_var = tk.StringVar(value="掃描中…" if self.streaming else "")
+        tk.Label(master, textvariable=self.status_var, font=("Segoe UI", 9), fg="#555555").pack(padx=10, anchor='w')
+
         # 建立一個可滾動的區域來顯示複選框
         canvas = tk.Canvas(master, borderwidth=0, background="#ffffff")
-        frame = tk.Frame(canvas, background="#ffffff")
+        self.rows_frame = tk.Frame(canvas, background="#ffffff")
         vsb = tk.Scrollbar(master, orient="vertical", command=canvas.yview)
         canvas.configure(yscrollcommand=vsb.set)
 
         vsb.pack(side="right", fill="y")
         canvas.pack(side="left", fill="both", expand=True)
-        canvas.create_window((4,4), window=frame, anchor="nw")
+        canvas.create_window((4,4), window=self.rows_frame, anchor="nw")
 
-        frame.bind("<Configure>", lambda event, canvas=canvas: canvas.configure(scrollregion=canvas.bbox("all")))
+        self.rows_frame.bind("<Configure>", lambda event, canvas=canvas: canvas.configure(scrollregion=canvas.bbox("all")))
 
         for i, patient in enumerate(self.new_patients):
-            var = tk.BooleanVar(value=True)
-            self.check_vars.append((var, patient))
-            
-            display_text = f"ID: {patient['patient_id']}, 姓名: {patient['patient_name']}, 日期: {patient['admission_date']}, 醫師: {patient['attending_doctor']}"
-            chk = tk.Checkbutton(frame, text=display_text, variable=var, background="#ffffff", anchor='w')
-            chk.pack(fill='x', padx=5, pady=2)
-        
+            self.add_patient(patient, position=(i,))
+        if self.start_stream is not None:
+            self.after(0, self.start_stream, self)
+
         return None # 不設定初始焦點
 
+    def buttonbox(self):
+        super().buttonbox()
+        if self.streaming:
+            self.stop_button = tk.Button(self, text="停止掃描", command=self.stop_stream)
+            self.stop_button.pack(pady=(0, 5))
+
+    def add_patient(self, patient, position=None):
+        """
+        加入一筆病人資料；position 為可比較大小的排序鍵 (例如 (列序, 列內順序) 的 tuple)，
+        讓晚完成的列也排在正確的位置。省略時排在最後。
+        """
+        patient_id = patient['patient_id']
+        if patient_id in self.existing_ids:
+            flag = "  (已存在)"
+        elif patient_id in self.seen_ids:
+            flag = "  (重複)"
+        else:
+            flag = ""
+        self.seen_ids.add(patient_id)
+        color = "#999999" if flag else "#000000"
+        if not flag and self.similarity_index is not None:
+            similar = self.similarity_index.find_similar(patient_id, patient['patient_name'])
+            if similar:
+                # 有近似索引時 existing_ids 為 all_patients_data，可以順便顯示既有病人的姓名
+                flag = "  (可能重複：" + "、".join(
+                    f"{reason} {pid} {self.existing_ids.get(pid, {}).get('patient_name', '')}".rstrip()
+                    for pid, reason in similar[:3]) + ")"
+                color = "#d35400"
+
+        var = tk.BooleanVar(value=not flag)
+        display_text = f"ID: {patient['patient_id']}, 姓名: {patient['patient_name']}, 日期: {patient['admission_date']}, 醫師: {patient['attending_doctor']}{flag}"
+        chk = tk.Checkbutton(self.rows_frame, text=display_text, variable=var, background="#ffffff", anchor='w', fg=color)
+        if position is None:
+            position = (self.row_keys[-1][0] + 1,) if self.row_keys else (0,)
+        index = bisect.bisect(self.row_keys, position)
+        self.row_keys.insert(index, position)
+        self.rows[position] = (var, patient, chk)
+        chk.grid(row=index, column=0, sticky='ew', padx=5, pady=2)
+        self._regrid(index + 1)
+
+    def _regrid(self, start=0):
+        """插入或移除後，把 start 之後的列往下 / 往上移一格。"""
+        for row in range(start, len(self.row_keys)):
+            self.rows[self.row_keys[row]][2].grid_configure(row=row)
+
+    def remove_patients(self, positions):
+        """移除指定排序鍵的列 (例如被 AI 結果取代的本地辨識列)。"""
+        for position in positions:
+            entry = self.rows.pop(position, None)
+            if entry is not None:
+                entry[2].destroy()
+                self.row_keys.remove(position)
+        self.seen_ids = {patient['patient_id'] for _, patient, _ in self.rows.values()}
+        self._regrid()
+
+    def set_status(self, text):
+        self.status_var.set(text)
+
+    def finish_stream(self, text):
+        """掃描結束 (完成或停止)。"""
+        self.streaming = False
+        self.status_var.set(text)
+        if getattr(self, 'stop_button', None) is not None:
+            self.stop_button.config(state='disabled')
+
+    def stop_stream(self):
+        if not self.streaming:
+            return
+        if self.on_stop is not None:
+            self.on_stop()
+        self.finish_stream(f"已停止掃描，目前 {len(self.rows)} 筆")
+
+    def destroy(self):
+        self.stop_stream() # 提早確認或取消時，停止剩下的辨識
+        super().destroy()
+
     def apply(self):
-        self.result = [patient for var, patient in self.check_vars if var.get()]
+        self.result = [self.rows[key][1] for key in self.row_keys if self.rows[key][0].get()]
 
 class DoctorManagerWindow(tk.Toplevel):
     """管理主治醫師及其顏色的視窗"""
@@ -725,14 +2593,21 @@ class ChecklistWindow(tk.Toplevel):
         # --- 最終解決方案：重構初始化流程 ---
         # 1. 在 __init__ 中，只初始化變數為安全的預設值，不執行任何網路請求。
         self.all_patients_data = {}
+        self.patient_similarity_index = PatientSimilarityIndex() # 批次新增時標示可能重複的病人
+        self.patient_census = PatientCensus() # 選擇器用的病人名冊索引
         self.doctor_colors = {"未指派": "#808080"}
         self.current_patient_id = None # 先給予一個初始值
         self.patient_info_expanded = False # 預設病人資訊是收合的
         self.tooltip_window = None # 用於備註提示        
         self.capture_bboxes = None # --- 新增功能：用於記憶上次的四個螢幕選取範圍 ---
         self.notes_save_timer = None # 用於延遲儲存備註的計時器
+        self.notes_dirty_patient_id = None # 備註已修改但尚未上傳的病人
 
         self.patient_listbox_popup = None # 用於自訂的下拉列表
+        self.checklist_rows = [] # 待辦事項的每一列 (與 items 的順序相同，以項目的 key 對應)
+        self.checklist_patient_id = None # 目前列表顯示的是哪一位病人
+        self.checklist_status_label = None # 待辦事項尚未載入時顯示「載入中…」
+        self.loading_patient_ids = set() # 正在背景取得完整資料的病人
         self.create_widgets()
 
         # 2. 在 UI 元件建立完成後，再呼叫一個安全的、統一的資料載入函式。
@@ -847,31 +2722,113 @@ class ChecklistWindow(tk.Toplevel):
         self.scrollable_frame.bind("<MouseWheel>", _on_checklist_mouse_wheel)
 
     def populate_checklist(self):
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-
-        if not self.current_patient_id or self.current_patient_id not in self.all_patients_data:
+        """
+        --- 最終解決方案：以列為單位增量更新待辦清單 ---
+        每一列以項目的 key (文字 + 同文字第幾個) 對應，而不是以位置對應：
+        中間刪除或插入項目 (或伺服器壓縮了已完成的項目) 時，其餘的列保持不動，
+        只新增、移除或移動變動的列；重用的列再比對勾選與備註。只有切換病人時才整個重建。
+        """
+        pdata = self.all_patients_data.get(self.current_patient_id)
+        items = pdata.get('items', []) if isinstance(pdata, dict) else []
+        if isinstance(pdata, dict) and 'items' not in pdata:
+            # 只有摘要：待辦事項還在背景載入 (或載入失敗)，先清空列表並顯示狀態
+            for row in self.checklist_rows:
+                row['frame'].destroy()
+            self.checklist_rows = []
+            self.checklist_patient_id = None
+            failed = self.current_patient_id not in self.loading_patient_ids
+            self._set_checklist_status("無法載入待辦事項，請重新選擇病人。" if failed else "待辦事項載入中…")
             return
-
-        current_patient = self.all_patients_data[self.current_patient_id]
-        for i, item in enumerate(current_patient.get('items', [])):
-            item_frame = tk.Frame(self.scrollable_frame, bg="white")
-            item_frame.pack(fill='x', pady=2)
-
-            var = tk.BooleanVar(value=item.get('checked', False))
+        self._set_checklist_status(None)
+
+        if self.checklist_patient_id != self.current_patient_id:
+            for row in self.checklist_rows:
+                row['frame'].destroy()
+            self.checklist_rows = []
+            self.checklist_patient_id = self.current_patient_id
+
+        old_rows = {row['key']: row for row in self.checklist_rows}
+        packed = list(self.checklist_rows) # 目前畫面上由上到下的順序
+        rows = []
+        for key, item in zip(self._checklist_item_keys(items), items):
+            row = old_rows.pop(key, None)
+            if row is None:
+                row = self._create_checklist_row(item, key)
+                packed.append(row)
+            else:
+                self._update_checklist_row(row, item)
+            rows.append(row)
+        for row in old_rows.values():
+            row['frame'].destroy()
+            packed.remove(row)
+        # 只移動位置不對的列 (例如中間新插入的列)，其他列不必重新 pack
+        for index, row in enumerate(rows):
+            if packed[index] is not row:
+                row['frame'].pack(before=packed[index]['frame'])
+                packed.remove(row)
+                packed.insert(index, row)
+        self.checklist_rows = rows
+
+    @staticmethod
+    def _checklist_item_keys(items):
+        """每個項目的穩定 key：(文字, 同樣文字的第幾個)，重複的任務 (例如每天的 Progress note) 也能分開。"""
+        seen = {}
+        keys = []
+        for item in items:
+            occurrence = seen.get(item['text'], 0)
+            seen[item['text']] = occurrence + 1
+            keys.append((item['text'], occurrence))
+        return keys
+
+    def _set_checklist_status(self, text):
+        """在待辦清單區域顯示 (或隱藏) 一行狀態文字。"""
+        if text is None:
+            if self.checklist_status_label is not None:
+                self.checklist_status_label.destroy()
+                self.checklist_status_label = None
+            return
+        if self.checklist_status_label is None:
+            self.checklist_status_label = tk.Label(self.scrollable_frame, bg="white", fg="grey", font=self.font_normal)
+            self.checklist_status_label.pack(fill='x', pady=10)
+        self.checklist_status_label.config(text=text)
+
+    def _create_checklist_row(self, item, key):
+        """建立一列待辦事項。事件回呼綁定在列物件上，刪除其他列時不必重新綁定。"""
+        item_frame = tk.Frame(self.scrollable_frame, bg="white")
+        item_frame.pack(fill='x', pady=2)
+        row = {'frame': item_frame, 'key': key, 'var': tk.BooleanVar(), 'text': None, 'checked': None, 'note': None}
+
+        chk = tk.Checkbutton(item_frame, variable=row['var'], bg="white", anchor='w', justify='left', wraplength=200)
+        chk.pack(side='left', fill='x', expand=True, padx=(5,0))
+        chk.config(command=lambda: self.toggle_item(self.checklist_rows.index(row), row['var']))
+        row['chk'] = chk
+
+        # --- 最終解決方案：綁定右鍵選單和懸停備註事件 ---
+        item_frame.bind("<Button-3>", lambda event: self.show_item_context_menu(event, self.checklist_rows.index(row)))
+        chk.bind("<Button-3>", lambda event: self.show_item_context_menu(event, self.checklist_rows.index(row)))
+
+        del_btn = tk.Button(item_frame, text="✕", command=lambda: self.delete_item(self.checklist_rows.index(row)), fg="red", relief='flat', bg='white', font=("Segoe UI", 8))
+        del_btn.pack(side='right', padx=5)
+
+        self._update_checklist_row(row, item)
+        return row
+
+    def _update_checklist_row(self, row, item):
+        """只修改有變動的部分：文字、勾選狀態 (刪除線字型) 或備註提示。"""
+        text, checked, note = item['text'], item.get('checked', False), item.get('note', '')
+        if text != row['text']:
+            row['chk'].config(text=text)
+            row['text'] = text
+        if checked != row['checked']:
+            row['var'].set(checked)
             # --- 最終解決方案：根據勾選狀態決定是否使用刪除線字型 ---
-            current_font = self.font_strikethrough if var.get() else self.font_normal
-            chk = tk.Checkbutton(item_frame, text=item['text'], variable=var, bg="white", anchor='w', justify='left', wraplength=200, font=current_font)
-            chk.pack(side='left', fill='x', expand=True, padx=(5,0))
-            chk.config(command=lambda index=i, v=var: self.toggle_item(index, v))
-
-            # --- 最終解決方案：綁定右鍵選單和懸停備註事件 ---
-            item_frame.bind("<Button-3>", lambda event, index=i: self.show_item_context_menu(event, index))
-            chk.bind("<Button-3>", lambda event, index=i: self.show_item_context_menu(event, index))
-            self.create_tooltip(item_frame, item.get('note', ''))
-
-            del_btn = tk.Button(item_frame, text="✕", command=lambda index=i: self.delete_item(index), fg="red", relief='flat', bg='white', font=("Segoe UI", 8))
-            del_btn.pack(side='right', padx=5)
+            row['chk'].config(font=self.font_strikethrough if checked else self.font_normal)
+            row['checked'] = checked
+        if note != row['note']:
+            row['frame'].unbind("<Enter>")
+            row['frame'].unbind("<Leave>")
+            self.create_tooltip(row['frame'], note)
+            row['note'] = note
 
     def add_item(self, event=None):
         text = self.new_item_entry.get().strip()
@@ -880,14 +2837,17 @@ class ChecklistWindow(tk.Toplevel):
                 messagebox.showwarning("無效操作", "請先新增或選擇一位病人。", parent=self)
                 return
             
+            if not self._require_patient_details():
+                return
+
             current_patient = self.all_patients_data[self.current_patient_id]
-            current_patient.setdefault('items', []).append({'text': text, 'checked': False})
+            current_patient['items'].append({'text': text, 'checked': False})
             self.new_item_entry.delete(0, 'end')
             self.save_checklist()
             self.populate_checklist()
 
     def delete_item(self, index):
-        if not self.current_patient_id: return
+        if not self.current_patient_id or not self._require_patient_details(): return
         current_patient = self.all_patients_data[self.current_patient_id]
         items = current_patient.get('items', [])
         if 0 <= index < len(items):
@@ -896,13 +2856,13 @@ class ChecklistWindow(tk.Toplevel):
             self.populate_checklist()
 
     def toggle_item(self, index, var):
-        if not self.current_patient_id: return
+        if not self.current_patient_id or not self._require_patient_details(): return
         current_patient = self.all_patients_data[self.current_patient_id]
         items = current_patient.get('items', [])
         if 0 <= index < len(items):
             items[index]['checked'] = var.get()
             self.save_checklist()
-            # --- 最終解決方案：儲存後立即重繪列表以更新刪除線狀態 ---
+            # --- 最終解決方案：儲存後立即更新該列的刪除線狀態 ---
             self.populate_checklist()
 
     def show_item_context_menu(self, event, index):
@@ -916,6 +2876,7 @@ class ChecklistWindow(tk.Toplevel):
 
     def edit_item_text(self, index):
         """修改待辦事項的文字"""
+        if not self._require_patient_details(): return
         current_patient = self.all_patients_data[self.current_patient_id]
         items = current_patient.get('items', [])
         if not (0 <= index < len(items)): return
@@ -930,6 +2891,7 @@ class ChecklistWindow(tk.Toplevel):
 
     def edit_item_note(self, index):
         """新增或修改待辦事項的備註"""
+        if not self._require_patient_details(): return
         current_patient = self.all_patients_data[self.current_patient_id]
         items = current_patient.get('items', [])
         if not (0 <= index < len(items)): return
@@ -941,7 +2903,7 @@ class ChecklistWindow(tk.Toplevel):
             new_note = new_note.strip()
             items[index]['note'] = new_note
             self.save_checklist()
-            self.populate_checklist() # 重新產生UI以更新tooltip
+            self.populate_checklist() # 更新該列的 tooltip
 
     def create_tooltip(self, widget, text):
         """為指定的 widget 建立懸停提示"""
@@ -974,21 +2936,30 @@ class ChecklistWindow(tk.Toplevel):
             self.patient_info_toggle_label.config(text="隱藏病人資訊 ▲")
         self.patient_info_expanded = not self.patient_info_expanded
 
-    def run_daily_task_automation(self):
-        """在每天第一次開啟時，為所有病人新增 'Progress note' 任務"""
-        today_str = time.strftime("%Y-%m-%d")
-        last_run_date = self.all_patients_data.get("__last_daily_task_date__")
-
-        if today_str != last_run_date:
-            print(f"新的一天 ({today_str})，正在為所有病人新增 'Progress note' 任務...")
-            task_to_add = "Progress note"
-            for pid, pdata in self.all_patients_data.items():
-                if isinstance(pdata, dict) and not pid.startswith("__"):
-                    # 為避免重複，可以先檢查，但直接加入更符合每日任務的性質
-                    pdata.setdefault('items', []).append({'text': task_to_add, 'checked': False, 'note': ''})
-            
-            self.all_patients_data["__last_daily_task_date__"] = today_str
-            self.save_checklist() # 立即儲存變更
+    def handle_remote_daily_tasks(self, payload):
+        """
+        處理伺服器每日任務排程廣播的新增項目 (每天的 'Progress note' 已改由伺服器加入並儲存)。
+        只把項目併入記憶體中的資料，不需要再上傳整份清單。摘要也帶有 daily_task_date，
+        同一天的廣播重複收到 (或載入時已計入) 都會略過，計數不會重複累加。
+        """
+        today_str = payload.get('date')
+        touched = False
+        for entry in payload.get('items', []):
+            pdata = self.all_patients_data.get(entry.get('patient_id'))
+            if not isinstance(pdata, dict) or pdata.get('daily_task_date') == today_str:
+                continue # 已經有今天的任務 (例如載入時伺服器已經加好了)
+            if 'items' in pdata:
+                pdata['items'].append(dict(entry['item']))
+            else: # 只有摘要的病人只更新計數
+                pdata['unchecked'] = pdata.get('unchecked', 0) + 1
+                pdata['item_count'] = pdata.get('item_count', 0) + 1
+            pdata['daily_task_date'] = today_str
+            touched = True
+        self.all_patients_data["__last_daily_task_date__"] = today_str
+        if touched:
+            self.patient_census.sync(self.all_patients_data)
+            self.update_selector_display()
+            self.populate_checklist() # 只會附加當前病人新增的那一列
 
     def add_new_patient(self):
         new_patient_info = ask_new_patient_info(self)
@@ -1015,6 +2986,7 @@ class ChecklistWindow(tk.Toplevel):
             'attending_doctor': new_patient_info["attending_doctor"], 
             'admission_date': new_patient_info["admission_date"],
             'items': default_tasks,
+            'daily_task_date': time.strftime("%Y-%m-%d"), # 今天的 Progress note 已包含在預設任務中
             'tags': [], # --- 新增功能：初始化標籤列表 ---
             'general_notes': new_patient_info.get("general_notes", "") # 新增：儲存從 OCR 偵測到的備註
         }
@@ -1026,6 +2998,8 @@ class ChecklistWindow(tk.Toplevel):
         if not self.current_patient_id:
             messagebox.showwarning("無效操作", "沒有選擇任何病人。", parent=self)
             return
+        if not self._require_patient_details():
+            return
 
         current_data = self.all_patients_data[self.current_patient_id]
         dialog = EditPatientDialog(self, "修改病人資料", current_data) # type: ignore
@@ -1053,8 +3027,8 @@ class ChecklistWindow(tk.Toplevel):
             self.all_patients_data[self.current_patient_id]['attending_doctor'] = dialog.result['attending_doctor']
             self.all_patients_data[self.current_patient_id]['admission_date'] = dialog.result['admission_date']
             
-            # 儲存並完全刷新 UI
-            self.save_checklist() # 儲存病人清單
+            # 儲存並完全刷新 UI (改了 ID 時一併刪除伺服器上的舊 ID)
+            self.save_checklist(deleted=(old_id,) if new_id != old_id else ()) # 儲存病人清單
             self.update_patient_selector()
 
     def open_doctor_manager(self):
@@ -1080,72 +3054,42 @@ class ChecklistWindow(tk.Toplevel):
         listbox.pack(fill='both', expand=True)
 
         # --- 最終解決方案：根據住院狀態、床號和住院日期進行多重排序 ---
-        patients = [pdata for pid, pdata in self.all_patients_data.items() if isinstance(pdata, dict) and not pid.startswith("__")]
-        
-        # --- 最終解決方案：重新定義分組邏輯 ---
-        # 1. 獲取今天的民國年日期字串
-        from datetime import datetime
-        now = datetime.now()
-        today_minguo_str = f"{now.year - 1911}{now.month:02d}{now.day:02d}"
-
-        # 2. 「住院病人」現在包含：有床號的，或住院日期已到(<=今天)的
-        inpatients = [p for p in patients if p.get('bed_number') or (p.get('admission_date') and p.get('admission_date') <= today_minguo_str)]
-        # 3. 「尚未住院」的病人只包含：沒有床號，且住院日期在未來的
-        outpatients = [p for p in patients if not p.get('bed_number') and (p.get('admission_date') and p.get('admission_date') > today_minguo_str)]
-        
-        # 2. 對住院病人按床號排序
-        inpatients.sort(key=lambda p: p.get('bed_number', ''))
-        # 3. 對尚未住院的病人，按住院日期升序排序 (日期近的在前)
-        outpatients.sort(key=lambda p: p.get('admission_date', ''))
-
-        # 4. 依序將病人加入列表
-        for pdata in inpatients:
-            doctor = pdata.get('attending_doctor', '未指派')
-            color = self.doctor_colors.get(doctor, self.doctor_colors.get("未指派", "#808080"))
-            has_unchecked, tags_prefix, display_text = self.get_patient_display_text(pdata)
-            prefix = "● " if has_unchecked else ""
-            listbox.insert('end', f"{prefix}{tags_prefix}{display_text}")
-            listbox.itemconfig('end', {'fg': color})
-        
-        # 5. 如果兩組都有病人，則插入分隔線
+        # 分組與排序都由 patient_census 維護，這裡只依序取出
+        inpatients, outpatients = self.patient_census.views()
+        default_color = self.doctor_colors.get("未指派", "#808080")
+        row_ids = [] # 每一列對應的病人 ID，分隔線為 None
+        rows = []
+
+        # 1. 住院病人 (依床號排序)，以主治醫師的顏色顯示
+        for pid in inpatients:
+            color = self.doctor_colors.get(self.patient_census.entries[pid]['doctor'], default_color)
+            rows.append((pid, self.patient_census.label(pid), color))
+
+        # 2. 如果兩組都有病人，則插入分隔線
         if inpatients and outpatients:
-            listbox.insert('end', "---")
-            listbox.itemconfig('end', {'fg': 'grey'})
+            rows.append((None, "---", 'grey'))
 
-        # 6. 加入尚未住院的病人，並按日期分組
+        # 3. 加入尚未住院的病人 (住院日期都在未來，顯示灰色)，並按日期分組
         last_admission_date = None
-        # --- 最終解決方案：獲取民國年的今天日期字串，以便比較 ---
-        from datetime import datetime
-        now = datetime.now()
-        today_minguo_str = f"{now.year - 1911}{now.month:02d}{now.day:02d}"
-
-        for pdata in outpatients:
-                admission_date = pdata.get('admission_date')
-                if admission_date and admission_date != last_admission_date:
-                    listbox.insert('end', f"--- {admission_date} ---")
-                    listbox.itemconfig('end', {'fg': 'blue'})
-                    last_admission_date = admission_date
-
-                # --- 最終解決方案：如果住院日期已到 (小於等於今天)，就顯示彩色 ---
-                if admission_date and admission_date <= today_minguo_str:
-                    doctor = pdata.get('attending_doctor', '未指派')
-                    color = self.doctor_colors.get(doctor, self.doctor_colors.get("未指派", "#808080"))
-                else:
-                    color = self.doctor_colors.get("未指派", "#808080") # 顯示灰色
-
-                has_unchecked, tags_prefix, display_text = self.get_patient_display_text(pdata)
-                prefix = "● " if has_unchecked else ""
-                # --- 修改：在顯示文字前加上標籤符號 ---
-                listbox.insert('end', f"{prefix}{tags_prefix}{display_text}")
-                listbox.itemconfig('end', {'fg': color})
+        for pid in outpatients:
+            admission_date = self.patient_census.entries[pid]['admission_date']
+            if admission_date != last_admission_date:
+                rows.append((None, f"--- {admission_date} ---", 'blue'))
+                last_admission_date = admission_date
+            rows.append((pid, self.patient_census.label(pid), default_color))
+
+        listbox.insert('end', *[text for _, text, _ in rows])
+        for index, (pid, _, color) in enumerate(rows):
+            row_ids.append(pid)
+            listbox.itemconfig(index, {'fg': color})
 
         def on_listbox_select(event):
             selected_indices = listbox.curselection()
             if selected_indices:
-                selected_item = listbox.get(selected_indices[0])
-                if selected_item.startswith("---"): # 如果點到任何分隔線，則不處理
+                patient_id = row_ids[selected_indices[0]]
+                if patient_id is None: # 如果點到任何分隔線，則不處理
                     return
-                self.on_patient_selected(listbox.get(selected_indices[0]))
+                self.on_patient_selected(patient_id)
             popup.destroy()
 
         listbox.bind("<<ListboxSelect>>", on_listbox_select)
@@ -1157,6 +3101,7 @@ class ChecklistWindow(tk.Toplevel):
             return
         
         if messagebox.askyesno("刪除確認", f"確定要刪除病人 {self.current_patient_id} 的所有待辦事項嗎？\n此操作無法復原。", parent=self):
+            deleted_id = self.current_patient_id
             del self.all_patients_data[self.current_patient_id]
             self.current_patient_id = None
             # 選擇列表中的第一個病人作為新的當前病人
@@ -1164,27 +3109,25 @@ class ChecklistWindow(tk.Toplevel):
             if patient_ids:
                 self.current_patient_id = patient_ids[0]
             
-            self.save_checklist() # 儲存病人清單
+            self.save_checklist(changed=(), deleted=(deleted_id,)) # 儲存病人清單
             self.update_patient_selector()
 
-    def on_patient_selected(self, selection):
-        """當從自訂 Listbox 中選擇一個病人時觸發"""
-        # --- 最終解決方案：修正從顯示文字中解析 ID 的邏輯 ---
-        # 逐步移除所有可能的前綴，包括未完成符號和所有標記
-        temp_selection = selection.lstrip("● ")
-        temp_selection = temp_selection.lstrip("▲★") # 移除所有標記
-        clean_selection = temp_selection.lstrip() # 移除剩餘的前導空格
-        self.current_patient_id = clean_selection.split(' ')[0] # 取得 ID
+    def on_patient_selected(self, patient_id):
+        """當從自訂 Listbox 中選擇一個病人時觸發 (列表的每一列都記錄了病人 ID，不必再從顯示文字解析)"""
+        self.flush_notes() # 切換前先上傳上一位病人尚未儲存的備註
+        self.current_patient_id = patient_id
+        self.load_patient_details(patient_id) # 選擇器只載入摘要，選到時才取得待辦事項
         self.update_selector_display()
         # --- 最終解決方案：切換病人後，必須立即更新詳細資訊UI ---
         self.update_patient_details()
         # 接著再刷新該病人的待辦事項列表
         self.populate_checklist()
-        self.save_checklist() # 儲存當前選擇的病人ID
+        self.save_checklist(changed=()) # 儲存當前選擇的病人ID
 
     def update_patient_selector(self):
 
         if self.current_patient_id and self.current_patient_id in self.all_patients_data:
+            self.load_patient_details(self.current_patient_id)
             self.update_selector_display() # 使用統一的函式來設定顯示
         else:
             # 如果沒有當前病人，則清空顯示
@@ -1196,16 +3139,29 @@ class ChecklistWindow(tk.Toplevel):
     def update_selector_display(self, *args):
         """僅更新主選擇按鈕的顯示文字"""
         if self.current_patient_id and self.current_patient_id in self.all_patients_data:
-            current_patient_data = self.all_patients_data[self.current_patient_id]
-            has_unchecked, tags_prefix, display_text = self.get_patient_display_text(current_patient_data)
-            prefix = "● " if has_unchecked else ""
             # --- 修改：在顯示文字前加上標籤符號 ---
-            self.patient_selector_var.set(f"{prefix}{tags_prefix}{display_text}")
+            # 名冊只在資料變動時 (儲存、遠端更新) 同步，這裡只讀取快取的顯示文字
+            if self.current_patient_id not in self.patient_census.entries:
+                self.patient_census.update(self.current_patient_id, self.all_patients_data[self.current_patient_id])
+            self.patient_selector_var.set(self.patient_census.label(self.current_patient_id))
 
     def on_notes_changed(self, event=None):
-        """當備註文字框內容改變時，更新記憶體中的資料"""
-        # 移除延遲儲存，直接更新記憶體中的資料
+        """當備註文字框內容改變時，更新記憶體中的資料，停止輸入 1 秒後再上傳該病人"""
         self._save_notes()
+        if self.current_patient_id in self.all_patients_data:
+            self.notes_dirty_patient_id = self.current_patient_id
+            if self.notes_save_timer:
+                self.after_cancel(self.notes_save_timer)
+            self.notes_save_timer = self.after(1000, self.flush_notes)
+
+    def flush_notes(self):
+        """立即上傳尚未儲存的備註 (儲存只會送出有變動的病人，所以備註必須自己觸發儲存)"""
+        if self.notes_save_timer:
+            self.after_cancel(self.notes_save_timer)
+            self.notes_save_timer = None
+        patient_id, self.notes_dirty_patient_id = self.notes_dirty_patient_id, None
+        if patient_id in self.all_patients_data:
+            self.save_checklist(changed=(patient_id,))
 
     def _save_notes(self):
         """(僅)將備註文字框的內容更新到記憶體中的 all_patients_data，不觸發雲端儲存"""
@@ -1215,30 +3171,8 @@ class ChecklistWindow(tk.Toplevel):
 
     def get_patient_display_text(self, pdata):
         """根據病人資料產生標準的顯示文字"""
-        pid = pdata.get('patient_id', '')
-        name = pdata.get('patient_name', '')
-        bed = pdata.get('bed_number', '')
-        tags = pdata.get('tags', [])
-
-        # --- 新增功能：根據標籤產生前綴符號 ---
-        tags_prefix = ""
-        if 'surgery' in tags:
-            tags_prefix += "▲"
-        if 'discharge' in tags:
-            tags_prefix += "★"
-        
-        # --- 最終解決方案：檢查是否有未完成的待辦事項 ---
-        has_unchecked_items = False
-        for item in pdata.get('items', []):
-            if not item.get('checked', False):
-                has_unchecked_items = True
-                break
-
-        display_text = f"{pid} - {name}"
-        if bed:
-            display_text += f" ({bed})"
-        
-        return has_unchecked_items, tags_prefix, display_text
+        unchecked, tags_prefix, display_text = PatientCensus.describe(pdata)
+        return unchecked > 0, tags_prefix, display_text
 
     def update_patient_details(self):
         if self.current_patient_id and self.current_patient_id in self.all_patients_data:
@@ -1247,13 +3181,17 @@ class ChecklistWindow(tk.Toplevel):
             self.patient_name_var.set(current_patient_data.get('patient_name', ''))
             self.bed_number_var.set(current_patient_data.get('bed_number', ''))
             # 注意：住院日期顯示在修改對話框中，此處不需顯示
-            # 更新備註欄
+            # 更新備註欄 (完整資料載入前備註還不在記憶體中，暫時不可編輯，避免輸入的內容被載入結果覆蓋)
+            self.notes_text.config(state='normal')
             self.notes_text.delete("1.0", "end")
             self.notes_text.insert("1.0", current_patient_data.get('general_notes', ''))
+            if 'items' not in current_patient_data:
+                self.notes_text.config(state='disabled')
         else:
             self.patient_id_var.set('')
             self.patient_name_var.set('')
             self.bed_number_var.set('')
+            self.notes_text.config(state='normal')
             self.notes_text.delete("1.0", "end")
 
     def load_doctors(self):
@@ -1283,27 +3221,109 @@ class ChecklistWindow(tk.Toplevel):
             messagebox.showerror("網路錯誤", f"無法儲存醫師資料到雲端伺服器: {e}", parent=self)
 
     def load_checklist(self):
-        """從伺服器載入待辦清單資料"""
+        """
+        從伺服器載入待辦清單資料。
+        --- 新功能：只載入每位病人的摘要 (不含待辦事項與備註)，選擇病人時才由 load_patient_details 取得完整資料 ---
+        """
         # --- 最終解決方案：重構載入邏輯，與 load_doctors 保持一致 ---
         # 任何錯誤都會被外層的 load_all_data_safely 捕獲。
-        response = requests.get(f"{SERVER_URL}/api/checklist", timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        # 允許病人清單為空字典 {}，因為使用者可能真的沒有任何病人。
-        if not isinstance(data, dict):
-            raise ValueError("從伺服器收到的病人清單資料格式不正確。")
-        return data
+        data = {}
+        params = {'fields': 'summary', 'limit': 500}
+        while True:
+            response = requests.get(f"{SERVER_URL}/api/checklist", params=params, timeout=10)
+            response.raise_for_status()
+            page = response.json()
+            # 允許病人清單為空 []，因為使用者可能真的沒有任何病人。
+            if not isinstance(page, dict) or not isinstance(page.get('patients'), list):
+                raise ValueError("從伺服器收到的病人清單資料格式不正確。")
+            data.update(page.get('meta') or {})
+            for summary in page['patients']:
+                data[summary['patient_id']] = summary
+            if not page.get('next_cursor'):
+                return data
+            params['cursor'] = page['next_cursor']
+
+    def load_patient_details(self, patient_id):
+        """
+        確保指定的病人已載入完整資料 (含待辦事項)。只有摘要時在背景執行緒向伺服器取得，
+        完成後回到 Tk 主執行緒更新畫面；載入期間待辦清單顯示「載入中…」，不會卡住介面。
+        """
+        pdata = self.all_patients_data.get(patient_id)
+        if not isinstance(pdata, dict) or 'items' in pdata or patient_id in self.loading_patient_ids:
+            return
+        self.loading_patient_ids.add(patient_id)
+
+        def fetch():
+            response = requests.get(f"{SERVER_URL}/api/checklist/{patient_id}", timeout=10)
+            response.raise_for_status()
+            return response.json()
+
+        def post_result(future):
+            try:
+                self.after(0, self._on_patient_details_loaded, patient_id, future)
+            except (RuntimeError, tk.TclError):
+                pass # 視窗已關閉
+
+        get_network_executor().submit(fetch).add_done_callback(post_result)
+
+    def _require_patient_details(self):
+        """
+        當前病人是否已載入完整資料。只有摘要時不能修改 (儲存會以不完整的資料覆蓋伺服器上的病人)，
+        提示使用者稍候並重新嘗試載入。
+        """
+        pdata = self.all_patients_data.get(self.current_patient_id)
+        if isinstance(pdata, dict) and 'items' in pdata:
+            return True
+        self.load_patient_details(self.current_patient_id) # 上次載入失敗時重新取得
+        messagebox.showinfo("資料載入中", "病人的完整資料尚未載入，請稍候再試。", parent=self)
+        return False
+
+    def _on_patient_details_loaded(self, patient_id, future):
+        """(Tk 主執行緒) 病人的完整資料取得後，替換摘要並刷新畫面。"""
+        self.loading_patient_ids.discard(patient_id)
+        try:
+            pdata = future.result()
+        except Exception as e:
+            print(f"無法從雲端伺服器載入病人 {patient_id} 的待辦事項: {e}")
+            pdata = None
+        current = self.all_patients_data.get(patient_id)
+        if isinstance(pdata, dict) and isinstance(current, dict) and 'items' not in current:
+            # 載入期間若已收到其他使用者的更新 (已經有 items)，以較新的為準
+            self.all_patients_data[patient_id] = pdata
+            self.patient_census.sync(self.all_patients_data)
+        if patient_id == self.current_patient_id:
+            self.update_selector_display()
+            self.update_patient_details()
+            self.populate_checklist()
 
-    def save_checklist(self):
-        """將待辦清單資料儲存到伺服器 (現在由 run_daily_task_automation 呼叫)"""
+    def save_checklist(self, changed=None, deleted=()):
+        """
+        將有變動的病人儲存到伺服器 (預設為當前病人)，不再上傳整份清單。
+        changed：要儲存的病人 ID；deleted：要從伺服器刪除的病人 ID。
+        """
+        if changed is None:
+            changed = (self.current_patient_id,) if self.current_patient_id else ()
         self.all_patients_data["__current_patient_id__"] = self.current_patient_id
+        self.patient_similarity_index.sync(self.all_patients_data) # 新增、刪除、改名後更新近似索引
+        self.patient_census.sync(self.all_patients_data, touched=changed) # 勾選狀態只會在儲存的病人變動
+        # 只有摘要 (尚未載入待辦事項) 的病人不能送出，否則會覆蓋伺服器上的完整資料
+        patients = {pid: self.all_patients_data[pid] for pid in changed
+                    if isinstance(self.all_patients_data.get(pid), dict) and 'items' in self.all_patients_data[pid]}
+        if len(patients) < len(changed):
+            print(f"略過尚未載入完整資料的病人: {[pid for pid in changed if pid not in patients]}")
+            # 改 ID 時舊 ID 只能和新的病人資料一起送出，否則伺服器會直接把病人刪掉
+            deleted = ()
+        payload = {'patients': patients, 'deleted': list(deleted), 'current_patient_id': self.current_patient_id}
         try:
-            # 使用 POST 請求將整個資料物件傳送到伺服器
-            requests.post(f"{SERVER_URL}/api/checklist", json=self.all_patients_data, timeout=10)
+            response = requests.post(f"{SERVER_URL}/api/checklist/patients", json=payload, timeout=10)
+            if response.status_code == 409:
+                # 病人已被伺服器封存：不寫回，改從本機移除 (需要時可從右鍵選單還原)
+                archived = response.json().get('archived', [])
+                messagebox.showwarning("病人已封存", f"下列病人已被封存，變更未儲存：\n{', '.join(archived)}\n\n如需繼續使用，請從「還原已封存的病人...」還原。", parent=self)
+                self.handle_remote_archived({'patient_ids': archived})
         except requests.exceptions.RequestException as e:
             # 顯示錯誤訊息，但不中斷程式
-            messagebox.showwarning("自動儲存失敗", f"無法將每日任務更新同步到雲端伺服器:\n{e}", parent=self)
+            messagebox.showwarning("自動儲存失敗", f"無法將病人清單更新同步到雲端伺服器:\n{e}", parent=self)
 
     def show_panel(self):
         self.handle.withdraw()
@@ -1321,6 +3341,27 @@ class ChecklistWindow(tk.Toplevel):
         else:
             self.capture_bboxes = None
 
+    def learn_capture_anchors(self, bboxes):
+        """為新選取的範圍擷取錨點樣板。"""
+        if not self.anchor_locator.enabled:
+            return
+        try:
+            self.anchor_locator.learn(bboxes)
+        except Exception as e:
+            print(f"無法擷取錨點樣板: {e}")
+
+    def relocate_capture_bboxes(self, bboxes):
+        """以錨點找回範圍，回傳 (範圍, 是否移動)；失敗時回傳原範圍。"""
+        try:
+            return self.anchor_locator.relocate(bboxes)
+        except Exception as e:
+            print(f"錨點定位失敗，使用原範圍: {e}")
+            return bboxes, False
+
+    def set_anchor_mode(self, enabled):
+        self.anchor_locator.enabled = enabled
+        self.anchor_locator.save()
+
     def _save_capture_settings(self):
         """儲存當前的螢幕偵測範圍設定。"""
         if self.capture_bboxes: # 只有在有設定時才儲存
@@ -1337,10 +3378,12 @@ class ChecklistWindow(tk.Toplevel):
     # --- 新增功能：病人標記相關函式 ---
     def show_patient_tag_menu(self, event):
         """在病人選擇器上顯示右鍵選單以進行標記"""
+        context_menu = tk.Menu(self, tearoff=0, font=("Segoe UI", 9))
         if not self.current_patient_id:
+            context_menu.add_command(label="還原已封存的病人...", command=self.restore_archived_patient)
+            context_menu.tk_popup(event.x_root, event.y_root)
             return
 
-        context_menu = tk.Menu(self, tearoff=0, font=("Segoe UI", 9))
         current_patient = self.all_patients_data[self.current_patient_id]
         tags = current_patient.get('tags', [])
 
@@ -1350,15 +3393,24 @@ class ChecklistWindow(tk.Toplevel):
 
         context_menu.add_command(label=surgery_label, command=lambda: self.toggle_patient_tag('surgery'))
         context_menu.add_command(label=discharge_label, command=lambda: self.toggle_patient_tag('discharge'))
+        context_menu.add_separator()
+        context_menu.add_command(label="還原已封存的病人...", command=self.restore_archived_patient)
         
         context_menu.tk_popup(event.x_root, event.y_root)
 
     def toggle_patient_tag(self, tag_name):
         """切換指定病人的標籤狀態"""
+        if not self._require_patient_details(): return
         current_patient = self.all_patients_data[self.current_patient_id]
         tags = current_patient.setdefault('tags', [])
         if tag_name in tags: tags.remove(tag_name)
         else: tags.append(tag_name)
+        # 伺服器依出院日期判斷何時把病人封存
+        if tag_name == 'discharge':
+            if 'discharge' in tags:
+                current_patient['discharge_date'] = time.strftime("%Y-%m-%d")
+            else:
+                current_patient.pop('discharge_date', None)
         self.save_checklist() # 儲存病人清單
         self.update_selector_display() # 更新按鈕上的顯示
 
@@ -1366,10 +3418,95 @@ class ChecklistWindow(tk.Toplevel):
         """處理從伺服器收到的待辦清單更新"""
         self.all_patients_data = new_data
         self.current_patient_id = self.all_patients_data.get("__current_patient_id__")
-        # 刷新整個UI
+        self.patient_similarity_index.sync(self.all_patients_data)
+        self.patient_census.sync(self.all_patients_data)
+        # 刷新UI：populate_checklist 只會修改有變動的待辦事項列
+        self.update_patient_selector()
+
+    def handle_remote_patients_updated(self, payload):
+        """處理其他使用者 (或自己) 儲存後廣播的病人更新：只替換有變動的病人，不重新載入整份清單。"""
+        for pid, pdata in payload.get('patients', {}).items():
+            if pid == self.current_patient_id and self.focus_get() is self.notes_text:
+                pdata['general_notes'] = self.notes_text.get("1.0", "end-1c") # 正在輸入的備註以本機為準
+            self.all_patients_data[pid] = pdata
+        for pid in payload.get('deleted', []):
+            self.all_patients_data.pop(pid, None)
+        self.patient_similarity_index.sync(self.all_patients_data)
+        self.patient_census.sync(self.all_patients_data, touched=tuple(payload.get('patients', {})))
+
+        if self.current_patient_id not in self.all_patients_data:
+            # 當前病人被刪除 (或改了 ID)，改選列表中的第一個病人
+            patient_ids = [k for k in self.all_patients_data if not k.startswith("__")]
+            self.current_patient_id = patient_ids[0] if patient_ids else None
+            self.update_patient_selector()
+        elif self.current_patient_id in payload.get('patients', {}):
+            self.update_selector_display()
+            if self.all_patients_data[self.current_patient_id].get('general_notes', '') != self.notes_text.get("1.0", "end-1c"):
+                self.update_patient_details()
+            self.populate_checklist() # 只會修改有變動的待辦事項列
+
+    def handle_remote_compacted(self, payload):
+        """伺服器壓縮已完成的重複任務後，替換受影響病人的 items 與 history。"""
+        for pid, patch in payload.get('patients', {}).items():
+            pdata = self.all_patients_data.get(pid)
+            if isinstance(pdata, dict) and 'items' in pdata:
+                pdata['items'] = patch.get('items', [])
+                pdata['history'] = patch.get('history', {})
+            elif isinstance(pdata, dict): # 只有摘要的病人只更新計數
+                pdata['item_count'] = len(patch.get('items', []))
+        self.all_patients_data["__last_compaction_date__"] = payload.get('date')
+        self.patient_census.sync(self.all_patients_data)
+        if self.current_patient_id in payload.get('patients', {}):
+            self.populate_checklist() # 只會移除被壓縮的那幾列
+
+    def handle_remote_archived(self, payload):
+        """伺服器把出院 / 過期的病人搬到封存資料表後，從本機資料中移除，避免下次儲存又把他們寫回去。"""
+        removed = [pid for pid in payload.get('patient_ids', []) if self.all_patients_data.pop(pid, None) is not None]
+        if payload.get('date'):
+            self.all_patients_data["__last_archive_date__"] = payload['date']
+        if not removed:
+            return
+        if self.current_patient_id in removed:
+            patient_ids = [k for k in self.all_patients_data if not k.startswith("__")]
+            self.current_patient_id = patient_ids[0] if patient_ids else None
+        self.patient_similarity_index.sync(self.all_patients_data)
+        self.patient_census.sync(self.all_patients_data)
         self.update_patient_selector()
-        self.update_patient_details()
-        self.populate_checklist()
+
+    def restore_archived_patient(self):
+        """以病歷號或姓名搜尋已封存的病人，並還原到待辦清單。"""
+        query = simpledialog.askstring("還原已封存的病人", "請輸入病歷號或姓名:", parent=self)
+        if not query or not query.strip():
+            return
+        try:
+            response = requests.get(f"{SERVER_URL}/api/archive", params={'q': query.strip(), 'limit': 20}, timeout=10)
+            response.raise_for_status()
+            matches = response.json().get('patients', [])
+        except requests.exceptions.RequestException as e:
+            messagebox.showwarning("查詢失敗", f"無法查詢封存的病人:\n{e}", parent=self)
+            return
+        if not matches:
+            messagebox.showinfo("查無資料", f"找不到符合「{query.strip()}」的封存病人。", parent=self)
+            return
+
+        choice = 1
+        if len(matches) > 1:
+            listing = "\n".join(f"{i}. {m['patient_id']} - {m['patient_name']} ({m['archived_on']} 封存)" for i, m in enumerate(matches, 1))
+            choice = simpledialog.askinteger("還原已封存的病人", f"{listing}\n\n請輸入要還原的編號:", minvalue=1, maxvalue=len(matches), parent=self)
+            if not choice:
+                return
+        selected = matches[choice - 1]
+        try:
+            response = requests.post(f"{SERVER_URL}/api/archive/{selected['archive_id']}/restore", timeout=10)
+            if response.status_code == 409:
+                messagebox.showerror("錯誤", "此病人 ID 已存在於待辦清單中。", parent=self)
+                return
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            messagebox.showwarning("還原失敗", f"無法還原病人:\n{e}", parent=self)
+            return
+        # 伺服器還原後只廣播這位病人 (checklist_patients_updated)，由 handle_remote_patients_updated 加入畫面
+        messagebox.showinfo("還原完成", f"已還原病人 {selected['patient_id']} - {selected['patient_name']}。", parent=self)
 
     def handle_remote_doctors_update(self, new_data):
         """處理從伺服器收到的醫師列表更新"""
@@ -1378,6 +3515,7 @@ class ChecklistWindow(tk.Toplevel):
         self.update_patient_selector() # 更新主視窗的下拉選單顏色
 
     def destroy(self):
+        self.flush_notes() # 關閉前上傳尚未儲存的備註
         self.handle.destroy()
         self._save_capture_settings() # 新增：在視窗銷毀前儲存設定
         super().destroy()
@@ -1417,13 +3555,15 @@ class ChecklistWindow(tk.Toplevel):
                     self.app.destroy()
                     sys.exit()
         
-        # 3. 在所有資料都成功載入後，才設定當前病人和執行每日任務
+        # 3. 在所有資料都成功載入後，才設定當前病人 (每日任務已由伺服器排程加入)
         self.current_patient_id = self.all_patients_data.get("__current_patient_id__")
-        self.run_daily_task_automation()
+        self.patient_similarity_index.sync(self.all_patients_data)
+        self.patient_census.sync(self.all_patients_data)
 
         # 4. 載入本地的 OCR 範圍設定
         self._load_capture_settings()
         self._load_patient_list_capture_setting() # 新增：載入批次掃描的範圍設定
+        self.anchor_locator = AnchorLocator().load() # 新增：載入錨點樣板
 
     def _load_patient_list_capture_setting(self):
         """載入住院病人清單的掃描範圍設定。"""
@@ -1455,7 +3595,11 @@ class ChecklistWindow(tk.Toplevel):
             # 如果強制重選或沒有記憶的範圍，則啟動選取流程
             self._capture_single_area("請選取單一病人列的範圍", self._on_patient_list_area_captured)
         else:
-            # 否則，直接使用記憶的範圍進行掃描
+            # 否則，直接使用記憶的範圍進行掃描 (先以錨點確認清單是否移動)
+            relocated, moved = self.relocate_capture_bboxes({"住院清單": self.patient_list_capture_bbox})
+            if moved:
+                self.patient_list_capture_bbox = tuple(relocated["住院清單"])
+                self._save_patient_list_capture_setting()
             self._scan_and_process_patient_list(self.patient_list_capture_bbox)
 
     def _capture_single_area(self, prompt_text, callback):
@@ -1505,92 +3649,172 @@ class ChecklistWindow(tk.Toplevel):
         """當病人列表的樣板範圍被捕獲後的回呼函式。"""
         self.patient_list_capture_bbox = bbox
         self._save_patient_list_capture_setting()
+        self.update_idletasks()
+        self.learn_capture_anchors({"住院清單": bbox})
         self._scan_and_process_patient_list(bbox)
     
     def _scan_and_process_patient_list(self, bbox):
         """
         --- 最終解決方案：重構為掃描一個大框框，讓 AI 進行整理 ---
-        根據給定的大範圍，截取單張圖片，並讓 AI 辨識後整理成多行文字。
+        根據給定的大範圍，截取單張圖片，整理成結構化的病人資料。
+        --- 新功能：先在本地切割成列並平行辨識，本地結果不完整或格式不對時才交給 Gemini ---
+        --- 新功能：辨識完成的列立即顯示在確認對話框中，不必等整張清單掃完 ---
         """
-        scanned_texts = []
-
-        # --- 最終解決方案：在掃描前，先建立一次 Gemini AI 模型實例 ---
-        gemini_model = None
-        if genai and GEMINI_API_KEY:
-            try:
-                gemini_model = genai.GenerativeModel('models/gemini-2.5-flash')
-            except Exception as e:
-                print(f"無法初始化 Gemini 模型: {e}")
+        gemini_model = gemini_client if gemini_client.available() else None
 
         try:
-            screenshot = ImageGrab.grab(bbox=bbox)
-            
-            if gemini_model:
-                # --- 最終解決方案：使用全新的、更精準的 AI 指令 ---
-                prompt = "這是一張尚未住院的病人清單截圖。請分析圖片內容，並將每一位病人的資訊整理成獨立的一行文字後輸出。每一行應包含病歷號、姓名、住院日期和主治醫師。請直接輸出結果，不要包含任何標題或額外解釋。"
-                response = gemini_model.generate_content([prompt, screenshot])
-                # AI 回傳的結果應該是多行文字，我們將其按行分割
-                scanned_texts = [line.strip() for line in response.text.strip().split('\n') if line.strip()]
-            else:
-                # 如果 AI 不可用，則退回本地 Tesseract OCR，對整個大圖進行辨識
-                # 這種方式效果可能不佳，但作為備用方案
-                messagebox.showwarning("AI 未配置", "未偵測到 Gemini API 金鑰，將使用本地 OCR 辨識整個區域，效果可能不佳。", parent=self)
-                config = '--psm 6' # 假設是一個統一的文字區塊
-                full_text = pytesseract.image_to_string(screenshot, lang='chi_tra+eng', config=config).strip()
-                scanned_texts = [line.strip() for line in full_text.split('\n') if line.strip()]
-
+            capture_start = time.perf_counter()
+            screenshot = ScreenFrame.grab([bbox]).crop(bbox)
+            capture_ms = (time.perf_counter() - capture_start) * 1000
+
+            # --- 新功能：清單畫面沒變時直接使用快取結果 ---
+            profile = get_ocr_field_profile("住院清單")
+            cache_key = ocr_result_cache.make_key("住院清單", profile.cache_key('cascade' if gemini_model else 'local'), screenshot)
+            cached = ocr_result_cache.get(cache_key)
+            table = segment_patient_list(screenshot) if cached is None and np is not None else None
         except Exception as e:
             messagebox.showerror("掃描錯誤", f"批次掃描時發生錯誤: {e}", parent=self)
             return
-        
-        if scanned_texts:
-            self._process_scanned_patient_texts(scanned_texts)
-        else:
-            messagebox.showinfo("掃描完成", "未偵測到任何病人資料。", parent=self)
-
-    def _process_scanned_patient_texts(self, texts):
-        """解析掃描到的病人文字列表，並彈出確認對話框。"""
-        new_patients = []
-        for text in texts:
-            # --- 最終解決方案：重構解析邏輯以應對更複雜的 AI 輸出 ---
-            # 使用 split() 將字串按空白分割成部分
-            parts = text.split()
-            if len(parts) >= 4:
-                patient_id = parts[0]
-                patient_name = parts[1]
-                
-                # 尋找可能是日期的部分 (通常是第三個)
-                date_part = parts[2]
-                # 從日期部分中提取所有數字，然後取前7碼
-                numbers_in_date = ''.join(re.findall(r'\d+', date_part))
-                admission_date = numbers_in_date[:7]
-                
-                # 最後一個部分視為主治醫師
-                attending_doctor = parts[-1]
-
-                # 檢查病人是否已存在
-                if patient_id not in self.all_patients_data:
-                    new_patients.append({
-                        'patient_id': patient_id,
-                        'patient_name': patient_name,
-                        'bed_number': "", # 批次掃描的病人，床號固定為空
-                        'admission_date': admission_date,
-                        'attending_doctor': attending_doctor
-                    })
+
+        if cached is not None:
+            scanned_rows = json.loads(cached)
+            if scanned_rows:
+                self._process_scanned_patients(scanned_rows)
             else:
-                print(f"無法解析此行，格式不符：'{text}'")
+                messagebox.showinfo("掃描完成", "未偵測到任何病人資料。", parent=self)
+            return
+
+        scan = {'screenshot': screenshot, 'table': table, 'cache_key': cache_key, 'gemini_model': gemini_model,
+                'capture_ms': capture_ms, 'futures': [], 'rows': {}, 'done': 0, 'segmented': 0, 'stopped': False, 'dialog': None}
+        dialog = BatchAddConfirmDialog(self, existing_ids=self.all_patients_data,
+                                       start_stream=lambda dlg: self._start_patient_list_stream(scan, dlg),
+                                       on_stop=lambda: self._stop_patient_list_stream(scan),
+                                       similarity_index=self.patient_similarity_index)
+        self._add_patients_from_batch_result(dialog.result)
+
+    def _start_patient_list_stream(self, scan, dialog):
+        """(Tk 主執行緒) 對話框開啟後，把每一列交給執行緒池辨識。"""
+        scan['dialog'] = dialog
+        scan['start'] = time.perf_counter()
+        executor = get_ocr_executor()
+        if scan['table'] is None:
+            # 沒有 numpy 無法切割，整張清單當作一個工作
+            jobs = [(functools.partial(recognize_patient_list_locally, keep_unparsed=True), scan['screenshot'])]
+        else:
+            jobs = [(recognize_patient_list_row, cells) for cells in scan['table']]
+        scan['total'] = len(jobs)
+        if not jobs:
+            self._finish_patient_list_stream(scan)
+            return
+        dialog.set_status(f"掃描中 0/{len(jobs)} 列")
+        for index, (func, arg) in enumerate(jobs):
+            future = executor.submit(func, arg)
+            future.add_done_callback(lambda f, i=index: self._post_scan_rows(scan, i, f))
+            scan['futures'].append(future)
+
+    def _post_scan_rows(self, scan, index, future):
+        """(背景執行緒) 把一列的結果交回 Tk 主執行緒。"""
+        if future.cancelled() or scan['stopped']:
+            return
+        try:
+            scan['dialog'].after(0, self._on_scan_rows, scan, index, future)
+        except (RuntimeError, tk.TclError):
+            pass # 對話框已關閉
+
+    def _on_scan_rows(self, scan, index, future):
+        """(Tk 主執行緒) 一個工作完成：解析出的病人立即加入對話框。"""
+        if scan['stopped']:
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"批次掃描第 {index + 1} 列辨識錯誤: {e}")
+            result = None
+        if index >= scan['total']:
+            rows = result or []
+            if rows:
+                # Gemini 的結果取代本地辨識不完整的列
+                local = [position for position in scan['rows'] if position[0] < scan['total']]
+                scan['dialog'].remove_patients(local)
+                for position in local:
+                    del scan['rows'][position]
+        elif isinstance(result, list):
+            # 整張清單一次辨識 (包含無法解析的 None，用來計算解析比例)
+            scan['segmented'] += len(result)
+            rows = [row for row in result if row]
+        else:
+            scan['segmented'] += 1
+            rows = [result] if result else []
+        for offset, row in enumerate(rows):
+            position = (index, offset) # 以 (工作序號, 工作內順序) 排序，一個工作回傳幾列都不會互相重疊
+            scan['rows'][position] = row
+            patient = self._scanned_row_to_patient(row)
+            if patient:
+                scan['dialog'].add_patient(patient, position=position)
+
+        if index >= scan['total']:
+            # Gemini 的補救結果
+            self._finish_patient_list_stream(scan)
+            return
+        scan['done'] += 1
+        scan['dialog'].set_status(f"掃描中 {scan['done']}/{scan['total']} 列，已找到 {len(scan['rows'])} 位")
+        if scan['done'] < scan['total']:
+            return
+        if scan['gemini_model'] and patient_list_needs_ai(list(scan['rows'].values()), scan['segmented']):
+            # 本地解析的列數太少或格式不對：整張交給 Gemini
+            scan['dialog'].set_status("本地辨識結果不完整，改用 AI 辨識…")
+            future = get_ocr_executor().submit(gemini_recognize_patient_list, scan['gemini_model'], scan['screenshot'])
+            future.add_done_callback(lambda f: self._post_scan_rows(scan, scan['total'], f))
+            scan['futures'].append(future)
+            return
+        self._finish_patient_list_stream(scan)
+
+    def _finish_patient_list_stream(self, scan):
+        rows = [scan['rows'][position] for position in sorted(scan['rows'])]
+        ocr_result_cache.put(scan['cache_key'], json.dumps(rows, ensure_ascii=False))
+        print(format_ocr_timings(scan['capture_ms'], {"住院清單": (time.perf_counter() - scan['start']) * 1000}))
+        if scan['gemini_model']:
+            print(gemini_client.summary())
+        scan['dialog'].finish_stream(f"掃描完成，共 {len(rows)} 位" if rows else "掃描完成，未偵測到任何病人資料。")
+
+    def _stop_patient_list_stream(self, scan):
+        """停止剩下的辨識 (已開始的列會跑完，但結果會被丟棄)。"""
+        scan['stopped'] = True
+        for future in scan['futures']:
+            future.cancel()
+
+    @staticmethod
+    def _scanned_row_to_patient(row):
+        """把掃描結果 (含 PATIENT_LIST_ROW_FIELDS 的 dict) 轉成新增病人用的資料；沒有病歷號時回傳 None。"""
+        if not row.get('patient_id'):
+            print(f"缺少病歷號，略過：{row}")
+            return None
+        return {
+            'patient_id': row['patient_id'],
+            'patient_name': row['patient_name'],
+            'bed_number': "", # 批次掃描的病人，床號固定為空
+            'admission_date': row['admission_date'],
+            'attending_doctor': row['attending_doctor']
+        }
 
-        if not new_patients:
+    def _process_scanned_patients(self, rows):
+        """把已完成的掃描結果 (例如快取) 一次放進確認對話框。"""
+        new_patients = [patient for patient in map(self._scanned_row_to_patient, rows) if patient]
+        if not any(patient['patient_id'] not in self.all_patients_data for patient in new_patients):
             messagebox.showinfo("掃描完成", "未偵測到可新增的病人資料。", parent=self)
             return
 
         # 彈出確認對話框
-        dialog = BatchAddConfirmDialog(self, new_patients)
-        if dialog.result:
-            for patient_info in dialog.result:
+        dialog = BatchAddConfirmDialog(self, new_patients, existing_ids=self.all_patients_data,
+                                       similarity_index=self.patient_similarity_index)
+        self._add_patients_from_batch_result(dialog.result)
+
+    def _add_patients_from_batch_result(self, result):
+        if result:
+            for patient_info in result:
                 self._add_single_patient_from_batch(patient_info)
             
-            messagebox.showinfo("新增完成", f"成功新增 {len(dialog.result)} 位病人。", parent=self)
+            messagebox.showinfo("新增完成", f"成功新增 {len(result)} 位病人。", parent=self)
             self.update_patient_selector() # 刷新主列表
 
     def _add_single_patient_from_batch(self, patient_info):
@@ -1609,9 +3833,10 @@ class ChecklistWindow(tk.Toplevel):
             'attending_doctor': patient_info['attending_doctor'],
             'admission_date': patient_info['admission_date'],
             'items': default_tasks,
+            'daily_task_date': time.strftime("%Y-%m-%d"),
             'tags': []
         }
-        self.save_checklist()
+        self.save_checklist(changed=(patient_id,))
 
 class AddButtonWindow(tk.Toplevel):  # 新增按鈕視窗
     def __init__(self, app, category_path):
@@ -1655,7 +3880,9 @@ class AddButtonWindow(tk.Toplevel):  # 新增按鈕視窗
             messagebox.showwarning("錯誤", "重複的按鈕名稱", parent=self)
             return
 
-        button_list.append({'label': name, 'text': content})
+        btn_data = {'label': name, 'text': content}
+        button_list.append(btn_data)
+        self.app.snippet_index.add_button(self.category_path, btn_data)
         self.app.save()
         # --- 最終解決方案：新增任何項目後，都執行一次完整的 populate 來刷新UI ---
         self.app.populate()
@@ -1701,9 +3928,11 @@ class EditButtonWindow(tk.Toplevel):  # 編輯按鈕視窗
         if not new_name or not new_content:
             messagebox.showwarning("錯誤", "名稱與內容不可為空", parent=self)
             return
+        old_label = self.btn_frame.btn_data['label']
         self.btn_frame.btn_data['label'] = new_name
         self.btn_frame.btn_data['text'] = new_content
         self.btn_frame.main_button.config(text=new_name)
+        self.app.snippet_index.update_button(self.btn_frame.category_frame.path, old_label, self.btn_frame.btn_data)
         self.app.save()
         # --- 最終解決方案：修改任何項目後，都執行一次完整的 populate 來刷新UI ---
         self.app.populate()
@@ -1746,7 +3975,8 @@ class DragButtonFrame(tk.Frame):  # 自訂拖曳按鈕容器類別，用於單
         self._start_x = 0  # 按下點相對座標X
         self._start_y = 0  # 按下點相對座標Y
 
-    def replace_pronouns(self, text, gender, laterality):
+    @staticmethod
+    def replace_pronouns(text, gender, laterality):
         """一個更智能的函式，使用正規表示式來替換性別和左右側代名詞。"""
         
         # --- 性別替換 ---
@@ -1796,42 +4026,18 @@ class DragButtonFrame(tk.Frame):  # 自訂拖曳按鈕容器類別，用於單
     def on_click(self, event):
         if not self._dragging:
             pyperclip.copy(self.btn_data['text'])  # 單擊時將文字複製到剪貼簿
+            # 使用次數只在貼上時記錄：雙擊會先觸發一次單擊，在這裡記錄會重複計算
 
     def on_double_click(self, event):
         now = time.time()  # 目前時間
         if now - self.last_paste_time < 0.8:  # 避免過快重複貼上
             return
         self.last_paste_time = now
-        
-        # --- 新功能：彈出選項對話框 ---
-        dialog = PasteOptionsDialog(self.app, "貼上選項")
-        if dialog.result is None: # 如果使用者按了取消
-            return
-
-        original_text = self.btn_data['text']
-        modified_text = original_text
 
-        # --- 使用新的、更智能的替換函式 ---
-        modified_text = self.replace_pronouns(original_text, dialog.result.get("gender"), dialog.result.get("laterality"))
-        pyperclip.copy(modified_text)  # 複製修改後的文字
-
-        def paste_with_window_switch():  # 模擬切換視窗與貼上
-            # --- 最終解決方案：同樣在此處延遲載入 pyautogui ---
-            try:
-                import pyautogui
-            except ImportError:
-                messagebox.showerror("錯誤", "缺少 pyautogui 套件，無法進行自動貼上。", parent=self.app)
-                return
-            if sys.platform == 'darwin':  # MacOS
-                pyautogui.hotkey('command', 'tab')
-                time.sleep(0.3)
-                pyautogui.hotkey('command', 'v')
-            else:  # 其他系統 Windows 為主
-                pyautogui.hotkey('alt', 'tab')
-                time.sleep(0.3)
-                pyautogui.hotkey('ctrl', 'v')
+        if not self.app.paste_with_options([self.btn_data]): # 如果使用者按了取消
+            return
+        self.app.record_usage(self.category_frame.path, self.btn_data)
 
-        self.app.after(100, paste_with_window_switch)  # 延遲呼叫貼上
         self.main_button.config(bg='lightblue')  # 按鈕背景閃爍提示
         self.after(150, lambda: self.main_button.config(bg='#ffffff'))  # 恢復背景為白色
 
@@ -1891,6 +4097,7 @@ class DragButtonFrame(tk.Frame):  # 自訂拖曳按鈕容器類別，用於單
                     button_list.remove(self.btn_data)
             elif isinstance(container, list) and self.btn_data in container:
                 container.remove(self.btn_data)
+            self.app.snippet_index.remove_button(self.category_frame.path, self.btn_data['label'])
             self.app.save()  # 儲存資料
             self.category_frame.expand()  # 重新展開分類來刷新列表
             self.destroy()  # 銷毀此按鈕物件
@@ -2024,6 +4231,7 @@ class CategoryFrame(tk.Frame):  # 單一分類框架，含分類標題與所有
             container = self.app.get_container_by_path(self.path[:-1])
             if self.category_name in container:
                 del container[self.category_name]
+            self.app.snippet_index.remove_category(self.path)
             self.app.save()
             # self.app.save() # This was already here, but it's good practice to ensure it is.
             self.app.populate()  # 重新載入介面
@@ -2054,6 +4262,7 @@ class CategoryFrame(tk.Frame):  # 單一分類框架，含分類標題與所有
             container.clear()
             container.update(new_container)
 
+            self.app.snippet_index.move_category(self.path, tuple(self.path[:-1]) + (new_name,))
             self.app.save()
             self.app.populate()
     
@@ -2105,6 +4314,504 @@ class CategoryFrame(tk.Frame):  # 單一分類框架，含分類標題與所有
         self.app.move_category(self.path, +1)
 
 
+# --- 新功能：片語樣板，可代入待辦清單中目前選擇的病人資料 ---
+# 語法：{{欄位}} 或 {{欄位|預設值}}，例如 "{{姓名}} ({{床號}}) admitted on {{住院日期}}"
+# 無法辨識的欄位名稱會原樣保留。
+TEMPLATE_FIELD_ALIASES = {
+    '病歷號': 'patient_id', 'id': 'patient_id',
+    '姓名': 'patient_name', 'name': 'patient_name',
+    '床號': 'bed_number', 'bed': 'bed_number',
+    '住院日期': 'admission_date', 'admission_date': 'admission_date',
+    '主治醫師': 'attending_doctor', 'doctor': 'attending_doctor',
+}
+TEMPLATE_FIELD_PATTERN = re.compile(r'\{\{\s*([^{}|]+?)\s*(?:\|([^{}]*))?\}\}')
+
+
+def has_template_fields(text):
+    return '{{' in text and TEMPLATE_FIELD_PATTERN.search(text) is not None
+
+
+@functools.lru_cache(maxsize=512)
+def compile_snippet_template(text, gender=None, laterality=None):
+    """
+    將片語編譯成 (文字, 欄位鍵, 預設值) 的序列並快取。
+    代名詞替換在編譯時先對整段文字完成，之後每次代入病人只需串接字串。
+    """
+    text = DragButtonFrame.replace_pronouns(text, gender, laterality)
+    parts = []
+    last_end = 0
+    for match in TEMPLATE_FIELD_PATTERN.finditer(text):
+        field = TEMPLATE_FIELD_ALIASES.get(match.group(1))
+        if field is None:
+            continue # 不認得的欄位保留原文
+        parts.append((text[last_end:match.start()], field, match.group(2) or ''))
+        last_end = match.end()
+    parts.append((text[last_end:], None, ''))
+    return tuple(parts)
+
+
+def render_snippet_template(text, patient, gender=None, laterality=None):
+    """以病人資料代入編譯後的樣板；沒有選擇病人時使用預設值 (或留空)。"""
+    patient = patient or {}
+    out = []
+    for literal, field, default in compile_snippet_template(text, gender, laterality):
+        out.append(literal)
+        if field:
+            out.append(str(patient.get(field) or default))
+    return "".join(out)
+
+
+class SnippetSearchIndex:
+    """
+    --- 新功能：快速搜尋用的 n-gram 索引 ---
+    以 (分類路徑, 按鈕名稱) 作為每個片語的鍵，對名稱與內容分別建立單字元與雙字元的倒排索引。
+    啟動時在背景執行緒建立一次 (build)；之後本機的修改由 add_button / update_button / remove_button /
+    remove_category / move_category 只更新被修改的片語，遠端整批更新才用 sync() 比對差異。
+    建立完成前 (ready 為 False) 搜尋結果為空，期間的修改只記錄 stale，建立完成後補做一次 sync。
+    """
+    def __init__(self, ready=True):
+        self.docs = {}  # doc_id -> {'key', 'path', 'data', 'label', 'text', 'label_grams', 'text_grams'}
+        self.key_to_id = {}  # (path, label) -> doc_id
+        self.path_ids = {}  # path -> set(doc_id)，分類改名或刪除時只處理該分類底下的片語
+        self.label_postings = {}  # gram -> set(doc_id)，只含按鈕名稱
+        self.text_postings = {}  # gram -> set(doc_id)，只含貼文內容
+        self._next_id = 0
+        self.ready = ready
+        self.stale = False # 尚未建立完成時資料又有變動
+
+    @staticmethod
+    def iter_buttons(data, path=()):
+        """遞迴列出資料樹中所有按鈕，產生 (分類路徑, 按鈕資料)。"""
+        if isinstance(data, list):
+            for btn_data in data:
+                if isinstance(btn_data, dict) and 'label' in btn_data:
+                    yield path, btn_data
+        elif isinstance(data, dict):
+            for key, value in data.items():
+                if key == '_sort_order':
+                    continue
+                if key == '(按鈕)':
+                    yield from SnippetSearchIndex.iter_buttons(value, path)
+                elif isinstance(value, (dict, list)):
+                    yield from SnippetSearchIndex.iter_buttons(value, path + (key,))
+
+    @staticmethod
+    def _grams(text):
+        """取得字串中所有的單字元與雙字元 (略過空白)。"""
+        grams = {ch for ch in text if not ch.isspace()}
+        for i in range(len(text) - 1):
+            gram = text[i:i + 2]
+            if not gram[0].isspace() and not gram[1].isspace():
+                grams.add(gram)
+        return grams
+
+    @staticmethod
+    def _query_grams(token):
+        """單一字元的查詢使用單字元索引，其餘使用雙字元。"""
+        if len(token) == 1:
+            return {token}
+        return {token[i:i + 2] for i in range(len(token) - 1)}
+
+    @staticmethod
+    def _intersect(postings, grams):
+        """對多個 gram 的倒排集合取交集，從最小的集合開始以減少運算量。"""
+        posting_sets = sorted((postings.get(g, set()) for g in grams), key=len)
+        if not posting_sets:
+            return set()
+        result = set(posting_sets[0])
+        for posting in posting_sets[1:]:
+            if not result:
+                break
+            result &= posting
+        return result
+
+    @property
+    def postings_count(self):
+        return len(self.label_postings) + len(self.text_postings)
+
+    def rebuild(self, data):
+        """清空並重新建立整個索引。"""
+        self.docs.clear()
+        self.key_to_id.clear()
+        self.path_ids.clear()
+        self.label_postings.clear()
+        self.text_postings.clear()
+        self.build(self.iter_buttons(data))
+
+    def build(self, buttons):
+        """由 (分類路徑, 按鈕資料) 序列建立索引 (可在背景執行緒執行)；同一分類內名稱重複時只索引第一個。"""
+        for path, btn_data in buttons:
+            if (tuple(path), btn_data['label']) not in self.key_to_id:
+                self.add(path, btn_data)
+        self.ready = True
+
+    def sync(self, data):
+        """
+        將索引與資料樹同步：只對新增、刪除或內容有變的片語重新計算 n-gram，
+        其餘片語僅更新資料物件的參照 (遠端更新時字典物件會整批換新)。
+        """
+        if not self._editable():
+            return
+        seen = set()
+        for path, btn_data in self.iter_buttons(data):
+            key = (path, btn_data['label'])
+            if key in seen: # 同一分類內名稱重複時只索引第一個
+                continue
+            seen.add(key)
+            doc_id = self.key_to_id.get(key)
+            if doc_id is None:
+                self.add(path, btn_data)
+                continue
+            doc = self.docs[doc_id]
+            if doc['text'] != btn_data.get('text', '').lower():
+                self.remove(doc_id)
+                self.add(path, btn_data)
+            else:
+                doc['data'] = btn_data
+
+        for key in [k for k in self.key_to_id if k not in seen]:
+            self.remove(self.key_to_id[key])
+
+    def _editable(self):
+        """索引還在背景建立時不直接修改，只記下建立完成後需要再 sync 一次。"""
+        if not self.ready:
+            self.stale = True
+        return self.ready
+
+    def add_button(self, path, btn_data):
+        """新增一個片語。"""
+        if self._editable() and (tuple(path), btn_data['label']) not in self.key_to_id:
+            self.add(path, btn_data)
+
+    def remove_button(self, path, label):
+        """移除一個片語。"""
+        if self._editable():
+            doc_id = self.key_to_id.get((tuple(path), label))
+            if doc_id is not None:
+                self.remove(doc_id)
+
+    def update_button(self, path, old_label, btn_data):
+        """片語改名或修改內容：只重新計算這一個片語的 n-gram。"""
+        self.remove_button(path, old_label)
+        self.add_button(path, btn_data)
+
+    def _ids_under(self, path):
+        """列出分類 (含子分類) 底下所有片語的 (路徑, doc_id)。"""
+        path = tuple(path)
+        return [(doc_path, doc_id) for doc_path, ids in self.path_ids.items()
+                if doc_path[:len(path)] == path for doc_id in ids]
+
+    def remove_category(self, path):
+        """刪除分類時移除其底下所有片語。"""
+        if self._editable():
+            for _, doc_id in self._ids_under(path):
+                self.remove(doc_id)
+
+    def move_category(self, old_path, new_path):
+        """分類改名或搬移：片語內容不變，n-gram 不必重算，只更新路徑與鍵。"""
+        if not self._editable():
+            return
+        old_path, new_path = tuple(old_path), tuple(new_path)
+        for doc_path, doc_id in self._ids_under(old_path):
+            doc = self.docs[doc_id]
+            moved_path = new_path + doc_path[len(old_path):]
+            self.key_to_id.pop(doc['key'], None)
+            self._discard_path(doc_path, doc_id)
+            doc['path'] = moved_path
+            doc['key'] = (moved_path, doc['key'][1])
+            self.key_to_id[doc['key']] = doc_id
+            self.path_ids.setdefault(moved_path, set()).add(doc_id)
+
+    def _discard_path(self, path, doc_id):
+        ids = self.path_ids.get(path)
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self.path_ids[path]
+
+    def add(self, path, btn_data):
+        label = btn_data['label'].lower()
+        text = btn_data.get('text', '').lower()
+        doc_id = self._next_id
+        self._next_id += 1
+        key = (tuple(path), btn_data['label'])
+        doc = {'key': key, 'path': tuple(path), 'data': btn_data, 'label': label, 'text': text,
+               'label_grams': self._grams(label), 'text_grams': self._grams(text)}
+        self.docs[doc_id] = doc
+        self.key_to_id[key] = doc_id
+        self.path_ids.setdefault(key[0], set()).add(doc_id)
+        for gram in doc['label_grams']:
+            self.label_postings.setdefault(gram, set()).add(doc_id)
+        for gram in doc['text_grams']:
+            self.text_postings.setdefault(gram, set()).add(doc_id)
+        return doc_id
+
+    def remove(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if not doc:
+            return
+        self.key_to_id.pop(doc['key'], None)
+        self._discard_path(doc['path'], doc_id)
+        for postings, grams in ((self.label_postings, doc['label_grams']), (self.text_postings, doc['text_grams'])):
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is not None:
+                    posting.discard(doc_id)
+                    if not posting:
+                        del postings[gram]
+
+    def search(self, query, limit=20):
+        """
+        回傳最符合的 (分類路徑, 按鈕資料) 列表。
+        排序：名稱開頭符合 > 名稱包含所有關鍵字 > 內容包含所有關鍵字 > 名稱模糊符合 (n-gram 重疊率)。
+        名稱的結果已足夠時就不再查詢內容索引。
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        tokens = query.split()
+        query_grams = set()
+        for token in tokens:
+            query_grams |= self._query_grams(token)
+
+        ranked = []
+        matched = set()
+
+        # 1. 名稱：所有 gram 的倒排集合取交集，再確認關鍵字是連續出現
+        for doc_id in self._intersect(self.label_postings, query_grams):
+            label = self.docs[doc_id]['label']
+            if label.startswith(query):
+                ranked.append(((0, 0.0, len(label)), doc_id))
+            elif all(t in label for t in tokens):
+                ranked.append(((1, 0.0, len(label)), doc_id))
+            else:
+                continue
+            matched.add(doc_id)
+
+        # 2. 內容：名稱結果不足時才查詢
+        if len(ranked) < limit:
+            for doc_id in self._intersect(self.text_postings, query_grams):
+                if doc_id in matched:
+                    continue
+                doc = self.docs[doc_id]
+                if all(t in doc['text'] for t in tokens):
+                    ranked.append(((2, 0.0, len(doc['label'])), doc_id))
+                    matched.add(doc_id)
+
+        # 3. 模糊：仍不足時，以名稱的 gram 重疊率容忍錯字
+        if len(ranked) < limit and len(query_grams) > 1:
+            hits = {}
+            for gram in query_grams:
+                for doc_id in self.label_postings.get(gram, ()):
+                    if doc_id not in matched:
+                        hits[doc_id] = hits.get(doc_id, 0) + 1
+            threshold = max(2, int(len(query_grams) * 0.6))
+            for doc_id, count in hits.items():
+                if count >= threshold:
+                    ranked.append(((3, -count / len(query_grams), len(self.docs[doc_id]['label'])), doc_id))
+
+        best = heapq.nsmallest(limit, ranked)
+        return [(self.docs[doc_id]['path'], self.docs[doc_id]['data']) for _, doc_id in best]
+
+
+class UsageStats:
+    """
+    --- 新功能：片語使用頻率統計 ---
+    每個按鈕以 (分類路徑, 按鈕名稱) 為鍵，記錄 [衰減分數, 最後使用時間, 累計次數]。
+    分數以半衰期做指數衰減，最近常用的片語排在前面，久未使用的會自然下沉。
+    """
+    def __init__(self, path=USAGE_STATS_FILE, half_life_days=USAGE_HALF_LIFE_DAYS, max_entries=300):
+        self.path = path
+        self.half_life = half_life_days * 86400
+        self.max_entries = max_entries
+        self.items = {}  # key -> [score, last_used, count]
+
+    @staticmethod
+    def make_key(path, label):
+        return "\t".join(tuple(path) + (label,))
+
+    @staticmethod
+    def split_key(key):
+        parts = key.split("\t")
+        return tuple(parts[:-1]), parts[-1]
+
+    def decayed_score(self, entry, now=None):
+        score, last_used, _ = entry
+        now = time.time() if now is None else now
+        return score * 0.5 ** (max(0.0, now - last_used) / self.half_life)
+
+    def record(self, path, label, now=None):
+        now = time.time() if now is None else now
+        key = self.make_key(path, label)
+        entry = self.items.get(key)
+        if entry:
+            entry[0] = self.decayed_score(entry, now) + 1.0
+            entry[1] = now
+            entry[2] += 1
+        else:
+            self.items[key] = [1.0, now, 1]
+        if len(self.items) > self.max_entries:
+            self._prune(now)
+
+    def top(self, n, now=None):
+        """回傳分數最高的 n 個 (分類路徑, 按鈕名稱)。"""
+        now = time.time() if now is None else now
+        best = heapq.nlargest(n, self.items.items(), key=lambda kv: self.decayed_score(kv[1], now))
+        return [self.split_key(key) for key, _ in best]
+
+    def _prune(self, now):
+        keep = heapq.nlargest(self.max_entries, self.items.items(), key=lambda kv: self.decayed_score(kv[1], now))
+        self.items = dict(keep)
+
+    def merge(self, other_items):
+        """合併另一份統計 (例如伺服器上的)，同一個鍵以最後使用時間較新的為準。"""
+        for key, entry in other_items.items():
+            if not isinstance(entry, list) or len(entry) != 3:
+                continue
+            current = self.items.get(key)
+            if current is None or entry[1] > current[1]:
+                self.items[key] = list(entry)
+
+    def to_json(self):
+        # 分數與時間取整以縮小檔案
+        return {key: [round(score, 3), int(last_used), count] for key, (score, last_used, count) in self.items.items()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.merge(json.load(f))
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading usage stats: {e}")
+
+    def save(self):
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_json(), f, ensure_ascii=False, separators=(',', ':'))
+        except IOError as e:
+            print(f"Error saving usage stats: {e}")
+
+
+class FrequentSnippetsFrame(tk.Frame):
+    """
+    --- 新功能：釘選在面板最上方的「常用」區塊 ---
+    直接從使用統計與搜尋索引取得按鈕資料，不需要展開任何分類。
+    單擊複製、雙擊貼上，行為與 DragButtonFrame 相同。
+    """
+    def __init__(self, parent, app, max_items=6):
+        super().__init__(parent, bg="#2c3e50")
+        self.app = app
+        self.max_items = max_items
+        self.last_paste_time = 0
+        self.header = tk.Label(self, text="常用", anchor='w', bg="#2c3e50", fg="#f39c12", font=("Segoe UI", 9, "bold"))
+        self.body = tk.Frame(self, bg="#ffffff")
+
+    def refresh(self):
+        for widget in self.body.winfo_children():
+            widget.destroy()
+
+        entries = []
+        for path, label in self.app.usage_stats.top(self.max_items * 2):
+            doc_id = self.app.snippet_index.key_to_id.get((path, label))
+            if doc_id is not None: # 已被刪除或改名的按鈕不顯示
+                entries.append((path, self.app.snippet_index.docs[doc_id]['data']))
+            if len(entries) >= self.max_items:
+                break
+
+        if not entries:
+            self.header.pack_forget()
+            self.body.pack_forget()
+            return
+
+        self.header.pack(fill='x', padx=5)
+        self.body.pack(fill='x', padx=5, pady=(0, 5))
+        for path, btn_data in entries:
+            btn = tk.Button(self.body, text=btn_data['label'], anchor='w', relief='flat', bg='#ffffff', bd=0, activebackground='#e0e0e0', font=("Segoe UI", 10), justify='left', padx=5)
+            btn.pack(fill='x', padx=1, pady=1)
+            btn.bind('<Button-1>', lambda e, p=path, d=btn_data: self.on_click(p, d))
+            btn.bind('<Double-Button-1>', lambda e, p=path, d=btn_data, b=btn: self.on_double_click(p, d, b))
+
+    def on_click(self, path, btn_data):
+        pyperclip.copy(btn_data['text']) # 與按鈕相同，使用次數只在貼上時記錄
+
+    def on_double_click(self, path, btn_data, button):
+        now = time.time()
+        if now - self.last_paste_time < 0.8:  # 避免過快重複貼上
+            return
+        self.last_paste_time = now
+        if self.app.paste_with_options([btn_data]):
+            self.app.record_usage(path, btn_data)
+            button.config(bg='lightblue')
+            button.after(150, lambda: button.winfo_exists() and button.config(bg='#ffffff'))
+
+
+class SnippetSearchPalette(tk.Toplevel):
+    """
+    --- 新功能：鍵盤操作的快速搜尋面板 ---
+    輸入關鍵字即時列出符合的按鈕，上下鍵選擇，Enter 貼上，Esc 關閉。
+    """
+    def __init__(self, app):
+        super().__init__(app)
+        self.app = app
+        self.results = []
+        self.overrideredirect(True)
+        self.attributes('-topmost', True)
+        self.config(bg='#34495e', bd=2, relief='ridge')
+        self.geometry(f"{app.width}x240+{app.winfo_rootx()}+{app.winfo_rooty()}")
+
+        self.query_var = tk.StringVar()
+        self.entry = tk.Entry(self, textvariable=self.query_var, font=("Segoe UI", 11))
+        self.entry.pack(fill='x', padx=4, pady=4)
+        self.listbox = tk.Listbox(self, font=("Segoe UI", 10), activestyle='dotbox', selectmode='extended')
+        self.listbox.pack(fill='both', expand=True, padx=4, pady=(0, 4))
+
+        self.query_var.trace_add('write', lambda *args: self.refresh())
+        self.entry.bind('<Down>', lambda e: self.move_selection(1))
+        self.entry.bind('<Up>', lambda e: self.move_selection(-1))
+        self.entry.bind('<Return>', self.paste_selected)
+        self.listbox.bind('<Double-Button-1>', self.paste_selected)
+        self.listbox.bind('<Return>', self.paste_selected)
+        self.bind('<Escape>', lambda e: self.destroy())
+
+        self.entry.focus_force()
+
+    def refresh(self):
+        self.results = self.app.snippet_index.search(self.query_var.get())
+        self.listbox.delete(0, 'end')
+        if not self.app.snippet_index.ready:
+            self.listbox.insert('end', "搜尋索引建立中，請稍候…") # 建立完成後會自動重新整理
+            return
+        for path, btn_data in self.results:
+            self.listbox.insert('end', f"{btn_data['label']}  ({' / '.join(path)})")
+        if self.results:
+            self.listbox.selection_set(0)
+            self.listbox.activate(0)
+
+    def move_selection(self, step):
+        if not self.results:
+            return 'break'
+        selected = self.listbox.curselection()
+        index = (selected[0] if selected else 0) + step
+        index = max(0, min(index, len(self.results) - 1))
+        self.listbox.selection_clear(0, 'end')
+        self.listbox.selection_set(index)
+        self.listbox.activate(index)
+        self.listbox.see(index)
+        return 'break'
+
+    def paste_selected(self, event=None):
+        # 可用 Ctrl/Shift 多選，依列表順序合併成一次貼上
+        selected = [i for i in self.listbox.curselection() if i < len(self.results)]
+        if not selected:
+            return
+        chosen = [self.results[i] for i in selected]
+        self.destroy()
+        if self.app.paste_with_options([btn_data for _, btn_data in chosen]):
+            for path, btn_data in chosen:
+                self.app.record_usage(path, btn_data)
+
+
 class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
     def __init__(self):
         super().__init__()
@@ -2131,6 +4838,14 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         self.attributes('-topmost', True)
         self.config(bg="#2c3e50")  # Set main background color
         self.data = self.load()  # 載入資料
+        # --- 新功能：啟動時在背景建立搜尋索引，之後隨資料變動增量更新 ---
+        self.snippet_index = SnippetSearchIndex(ready=False)
+        self.build_snippet_index_async()
+        self.search_palette = None
+        # --- 新功能：片語使用頻率統計 ---
+        self.usage_stats = UsageStats()
+        self.usage_stats.load()
+        self._usage_save_timer = None
 
         # --- Custom Title Bar ---
         title_bar = tk.Frame(self, bg='#34495e', relief='raised', bd=0, height=25)
@@ -2153,6 +4868,13 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         top_frame = tk.Frame(self, bg="#2c3e50")
         top_frame.pack(fill='x', padx=5, pady=5)
         tk.Button(top_frame, text='新增分類', command=self.add_category, bg='#34495e', fg='#f39c12', relief='flat', activebackground='#4a6278', activeforeground='white', font=("Segoe UI", 9)).pack(side='left')
+        tk.Button(top_frame, text='搜尋', command=self.open_snippet_search, bg='#34495e', fg='#f39c12', relief='flat', activebackground='#4a6278', activeforeground='white', font=("Segoe UI", 9)).pack(side='left', padx=5)
+        self.bind('<Control-f>', self.open_snippet_search)
+
+        # --- 新功能：釘選的常用片語區塊，不隨分類列表滾動 ---
+        self.frequent_frame = FrequentSnippetsFrame(self, self)
+        self.frequent_frame.pack(fill='x')
+        self.frequent_frame.refresh()
 
         # 主內容容器改為包含Canvas與垂直捲軸，可滑動顯示過多的分類和按鈕
         self.container = tk.Frame(self)
@@ -2204,6 +4926,30 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
             if hasattr(self, 'checklist_window') and self.checklist_window:
                 self.checklist_window.after(0, self.checklist_window.handle_remote_update, data)
 
+        @self.sio.on('checklist_items_added')
+        def on_checklist_items_added(data):
+            print(f"收到每日任務更新 ({len(data.get('items', []))} 項)")
+            if hasattr(self, 'checklist_window') and self.checklist_window:
+                self.checklist_window.after(0, self.checklist_window.handle_remote_daily_tasks, data)
+
+        @self.sio.on('checklist_patients_updated')
+        def on_checklist_patients_updated(data):
+            print(f"收到病人更新 ({len(data.get('patients', {}))} 位，刪除 {len(data.get('deleted', []))} 位)")
+            if hasattr(self, 'checklist_window') and self.checklist_window:
+                self.checklist_window.after(0, self.checklist_window.handle_remote_patients_updated, data)
+
+        @self.sio.on('checklist_items_compacted')
+        def on_checklist_items_compacted(data):
+            print(f"收到待辦事項壓縮通知 ({len(data.get('patients', {}))} 位病人)")
+            if hasattr(self, 'checklist_window') and self.checklist_window:
+                self.checklist_window.after(0, self.checklist_window.handle_remote_compacted, data)
+
+        @self.sio.on('checklist_patients_archived')
+        def on_checklist_patients_archived(data):
+            print(f"收到病人封存通知 ({len(data.get('patient_ids', []))} 位)")
+            if hasattr(self, 'checklist_window') and self.checklist_window:
+                self.checklist_window.after(0, self.checklist_window.handle_remote_archived, data)
+
         @self.sio.on('doctors_updated')
         def on_doctors_updated(data):
             print("收到醫師列表更新，正在刷新...")
@@ -2211,6 +4957,8 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
                 self.checklist_window.after(0, self.checklist_window.handle_remote_doctors_update, data)
 
         self.connect_to_server()
+        if USAGE_SYNC_ENABLED:
+            self.pull_usage_stats()
 
         # --- 檢查更新 ---
         # 將檢查更新的邏輯移至UI初始化之後，以確保messagebox可以正常運作
@@ -2227,6 +4975,9 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         # 在主程式啟動時就建立實例，但預設是隱藏的。
         self.checklist_window = ChecklistWindow(self)
         self.checklist_window.sio = self.sio # 將 socketio 客戶端傳遞給 checklist 視窗
+        if OCR_ENABLED:
+            # --- 新功能：在背景預先載入 OCR 辨識器，第一次偵測就不必等待 ---
+            ocr_engine.warm_up_async({profile.engine_profile for profile in OCR_FIELD_PROFILES.values()})
         self.after(10, self.set_window_position)
 
     def set_window_position(self):
@@ -2237,10 +4988,33 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         y = screen_h - self.height - 40
         self.geometry(f"{self.width}x{self.height}+{x}+{y}")
 
+    def build_snippet_index_async(self):
+        """在背景執行緒建立搜尋索引 (上萬個片語需要數秒)，不拖慢啟動；完成後回到主執行緒啟用。"""
+        buttons = list(SnippetSearchIndex.iter_buttons(self.data)) # 在主執行緒取得片語列表，背景不走訪 self.data
+
+        def run():
+            index = SnippetSearchIndex(ready=False)
+            index.build(buttons)
+            try:
+                self.after(0, self._on_snippet_index_built, index)
+            except (RuntimeError, tk.TclError):
+                pass # 視窗已關閉
+
+        threading.Thread(target=run, name="snippet-index", daemon=True).start()
+
+    def _on_snippet_index_built(self, index):
+        if self.snippet_index.stale: # 建立期間資料有變動，補做一次差異同步
+            index.sync(self.data)
+        self.snippet_index = index
+        self.frequent_frame.refresh()
+        if self.search_palette is not None and self.search_palette.winfo_exists():
+            self.search_palette.refresh()
+
     def on_ui_update(self, data):
         """安全地在主執行緒中更新UI"""
         # 在更新UI前，也對從WebSocket收到的資料進行淨化
         self.data = self._sanitize_data(OrderedDict(data))
+        self.snippet_index.sync(self.data)
         self.populate()
 
     def setup_socketio_events(self):
@@ -2314,7 +5088,7 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
             return OrderedDict()
 
     def save(self):
-        """將目前資料儲存到伺服器"""
+        """將目前資料儲存到伺服器 (搜尋索引由各修改處以 add_button / update_button 等直接更新)"""
         try:
             requests.post(f"{SERVER_URL}/api/data", json=self.data, timeout=45)
         except requests.exceptions.RequestException as e:
@@ -2330,6 +5104,7 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         self.category_frames.clear()
         self.insertion_line = None  # The line widget is destroyed, so reset the reference
         self._populate_recursive(self.inner_frame, self.data, [], expanded_paths)
+        self.frequent_frame.refresh() # 按鈕可能被改名或刪除，同步刷新常用區塊
 
     def _populate_recursive(self, parent_widget, data_dict, current_path, expanded_paths):
         # 決定迭代順序：優先使用 _sort_order，否則使用原始鍵
@@ -2412,6 +5187,105 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
             ref = ref[step]
         return ref
 
+    def get_selected_patient(self):
+        """回傳待辦清單中目前選擇的病人資料，沒有則回傳 None。"""
+        checklist = getattr(self, 'checklist_window', None)
+        if not checklist or not checklist.current_patient_id:
+            return None
+        return checklist.all_patients_data.get(checklist.current_patient_id)
+
+    def paste_with_options(self, snippets):
+        """
+        彈出貼上選項，替換代名詞與病人欄位後切換視窗並貼上。
+        DragButtonFrame 的雙擊與快速搜尋面板都走這個流程。
+        多個片語會合併成一段文字，只複製與貼上一次。
+        回傳 False 表示使用者取消。
+        """
+        patient = None
+        if any(has_template_fields(btn_data['text']) for btn_data in snippets):
+            patient = self.get_selected_patient()
+
+        # --- 新功能：彈出選項對話框 ---
+        patient_label = None
+        if patient:
+            patient_label = f"{patient.get('patient_id', '')} {patient.get('patient_name', '')}"
+        dialog = PasteOptionsDialog(self, "貼上選項", patient_label=patient_label)
+        if dialog.result is None: # 如果使用者按了取消
+            return False
+
+        # --- 使用編譯快取的樣板：代名詞替換與病人欄位代入一次完成 ---
+        gender, laterality = dialog.result.get("gender"), dialog.result.get("laterality")
+        modified_text = "\n".join(render_snippet_template(btn_data['text'], patient, gender, laterality) for btn_data in snippets)
+        pyperclip.copy(modified_text)  # 複製修改後的文字
+
+        def paste_with_window_switch():  # 模擬切換視窗與貼上
+            # --- 最終解決方案：同樣在此處延遲載入 pyautogui ---
+            try:
+                import pyautogui
+            except ImportError:
+                messagebox.showerror("錯誤", "缺少 pyautogui 套件，無法進行自動貼上。", parent=self)
+                return
+            if sys.platform == 'darwin':  # MacOS
+                pyautogui.hotkey('command', 'tab')
+                time.sleep(0.3)
+                pyautogui.hotkey('command', 'v')
+            else:  # 其他系統 Windows 為主
+                pyautogui.hotkey('alt', 'tab')
+                time.sleep(0.3)
+                pyautogui.hotkey('ctrl', 'v')
+
+        self.after(100, paste_with_window_switch)  # 延遲呼叫貼上
+        return True
+
+    def record_usage(self, path, btn_data):
+        """記錄一次片語使用，並延遲儲存統計與刷新常用區塊。"""
+        self.usage_stats.record(path, btn_data['label'])
+        if self._usage_save_timer:
+            self.after_cancel(self._usage_save_timer)
+        self._usage_save_timer = self.after(1500, self._flush_usage_stats)
+
+    def _flush_usage_stats(self):
+        self._usage_save_timer = None
+        self.usage_stats.save()
+        self.frequent_frame.refresh()
+        if USAGE_SYNC_ENABLED:
+            self.push_usage_stats()
+
+    def pull_usage_stats(self):
+        """在背景執行緒中從伺服器取得使用統計並合併。"""
+        def run():
+            try:
+                response = requests.get(f"{SERVER_URL}/api/usage_stats", timeout=10)
+                response.raise_for_status()
+                remote = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"無法同步使用統計: {e}")
+                return
+            if isinstance(remote, dict):
+                self.after(0, self._on_usage_stats_pulled, remote)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _on_usage_stats_pulled(self, remote):
+        self.usage_stats.merge(remote)
+        self.frequent_frame.refresh()
+
+    def push_usage_stats(self):
+        """在背景執行緒中將使用統計上傳到伺服器 (伺服器端會逐項合併)。"""
+        payload = self.usage_stats.to_json()
+        def run():
+            try:
+                requests.post(f"{SERVER_URL}/api/usage_stats", json=payload, timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"無法上傳使用統計: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def open_snippet_search(self, event=None):
+        """開啟快速搜尋面板 (Ctrl+F)。"""
+        if self.search_palette and self.search_palette.winfo_exists():
+            self.search_palette.focus_force()
+            return
+        self.search_palette = SnippetSearchPalette(self)
+
     def paste_text(self, btn_data):
         pyperclip.copy(btn_data['text'])
         if sys.platform == 'darwin':
@@ -2535,6 +5409,9 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         else: # It's a list
             target_container.insert(insert_index, btn_data)
 
+        if tuple(widget.category_frame.path) != tuple(target_path):
+            self.snippet_index.remove_button(widget.category_frame.path, btn_data['label'])
+            self.snippet_index.add_button(target_path, btn_data)
         self.save()
         # Instead of a full populate, just refresh the affected categories
         self.category_frames[tuple(widget.category_frame.path)].expand()
@@ -2567,6 +5444,8 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
             target_container = parent_container[target_path[-1]]
         
         target_container.setdefault('(按鈕)', []).append(btn_data)
+        self.snippet_index.remove_button(source_path, btn_data['label'])
+        self.snippet_index.add_button(target_path, btn_data)
         self.save()
         self.populate()
 
@@ -2585,6 +5464,7 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
             target_container = grandparent_container[new_parent_path[-1]]
         
         target_container[source_name] = source_data
+        self.snippet_index.move_category(source_path, tuple(new_parent_path) + (source_name,))
         self.save()
         self.populate()
 
@@ -2701,6 +5581,8 @@ class AutoPasteApp(tk.Tk):  # 主視窗類別，介面核心
         # --- 最終解決方案：移除在關閉時的自動儲存，避免因意外關閉導致空資料覆蓋雲端存檔 ---
         print("正在關閉程式...")
         self.sio.disconnect()
+        if hasattr(self, 'usage_stats'):
+            self.usage_stats.save()
         # 確保 Checklist 視窗也被正確關閉
         if hasattr(self, 'checklist_window') and self.checklist_window:
             self.checklist_window.destroy()
@@ -0,0 +1,338 @@
+"""
+OCR 正確率與延遲測試：以本地合成、已知答案的 HIS 風格截圖 (病歷號、中文姓名、
+床號 ICUA-12 / 7B26-02 / 5A-3、多行住院備註、住院清單)，對每個欄位的辨識設定檔、
+各種前處理流程與 PSM 組合逐一辨識，輸出字元正確率、欄位完全相符率與 p50/p95 延遲 (JSON)。
+
+需要已安裝 Tesseract (含 chi_tra 語言包)；中文欄位另需 CJK 字型
+(Windows 的微軟正黑體 / 細明體、Linux 的 Noto Sans CJK 等，或以 --font 指定)，
+找不到時會略過中文欄位並記錄在輸出的 skipped 中。
+執行方式 (於專案根目錄)：
+    python benchmarks/bench_ocr_accuracy.py [--fixtures 10] [--fields 病歷號,床號] [--output result.json]
+    python benchmarks/bench_ocr_accuracy.py --render-only fixtures/   # 只輸出合成圖與答案，不辨識
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import autopaste  # noqa: E402
+from autopaste import OCR_FIELD_PROFILES, OcrFieldProfile, ocr_engine, pytesseract  # noqa: E402
+from PIL import Image, ImageDraw, ImageFilter, ImageFont  # noqa: E402
+
+CJK_FONT_CANDIDATES = [
+    r'C:\Windows\Fonts\msjh.ttc',
+    r'C:\Windows\Fonts\mingliu.ttc',
+    '/System/Library/Fonts/PingFang.ttc',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+]
+LATIN_FONT_CANDIDATES = [
+    r'C:\Windows\Fonts\segoeui.ttf',
+    r'C:\Windows\Fonts\arial.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    'DejaVuSans.ttf',
+]
+
+SURNAMES = "王李張陳林黃吳劉蔡楊許鄭謝郭洪曾邱廖賴周"
+GIVEN = "志明淑芬家豪怡君俊傑雅婷建宏美玲宗翰佩珊冠宇欣怡承恩"
+NOTE_PHRASES = ["CAD s/p PCI", "HTN, DM", "發燒三天", "咳嗽有痰", "r/o pneumonia", "胸悶", "CKD stage 3",
+                "右下腹痛", "post-op day 1", "待會診心臟科", "NPO", "血糖控制不佳"]
+
+# 要比較的前處理流程 (空 tuple 表示不處理)；"profile" 代表該欄位設定檔本身的流程
+PREPROCESS_CHAINS = [(), ('grayscale',), ('threshold',), ('otsu',), ('adaptive',), ('otsu', 'denoise'), ('otsu', 'denoise', 'deskew')]
+PSM_CHOICES = {
+    "病歷號": [7, 8, 13],
+    "姓名": [7, 8, 13],
+    "床號": [7, 8, 13],
+    "住院備註": [4, 6, 11],
+}
+
+
+def load_font(candidates, size, override=None):
+    for path in ([override] if override else []) + candidates:
+        try:
+            return ImageFont.truetype(path, size), path
+        except (OSError, IOError):
+            continue
+    return None, None
+
+
+# --- 合成圖 ---
+
+def random_id(rng):
+    if rng.random() < 0.5:
+        return "A" + str(rng.randint(10**6, 10**7 - 1))
+    return str(rng.randint(10**7, 10**8 - 1))
+
+
+def random_name(rng):
+    return rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN) for _ in range(rng.choice([1, 2, 2])))
+
+
+def random_bed(rng):
+    kind = rng.random()
+    if kind < 0.3:
+        return f"ICU{rng.choice('AB')}-{rng.randint(1, 20):02d}"
+    if kind < 0.8:
+        return f"{rng.randint(3, 9)}{rng.choice('ABC')}{rng.randint(10, 40)}-{rng.randint(1, 6):02d}"
+    return f"{rng.randint(3, 9)}{rng.choice('ABC')}-{rng.randint(1, 9)}"
+
+
+def random_notes(rng):
+    return '\n'.join(', '.join(rng.sample(NOTE_PHRASES, 2)) for _ in range(rng.choice([2, 3])))
+
+
+def render_field(text, font, rng, padding=6):
+    """畫出一個 HIS 欄位：淡色底、深色字，隨機加上低對比、模糊與雜點。"""
+    lines = text.split('\n')
+    probe = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    boxes = [probe.textbbox((0, 0), line or ' ', font=font) for line in lines]
+    line_h = max(b[3] - b[1] for b in boxes) + 4
+    width = max(b[2] - b[0] for b in boxes) + 2 * padding
+    height = line_h * len(lines) + 2 * padding
+    background = rng.choice([(255, 255, 255), (240, 244, 250), (232, 240, 232), (250, 246, 225)])
+    ink = rng.choice([(0, 0, 0), (30, 30, 60), (70, 70, 70)])
+    image = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((padding, padding + i * line_h), line, fill=ink, font=font)
+    if rng.random() < 0.3:
+        image = image.filter(ImageFilter.GaussianBlur(0.6))
+    if rng.random() < 0.3:
+        pixels = image.load()
+        for _ in range(width * height // 200):
+            x, y = rng.randrange(width), rng.randrange(height)
+            pixels[x, y] = (150, 150, 150)
+    return image
+
+
+def render_patient_list(rows, font, rng):
+    """畫出住院清單：標題列、交錯底色與格線。"""
+    columns = [10, 150, 280, 420]
+    row_h = font.size + 14
+    image = Image.new('RGB', (560, row_h * (len(rows) + 1) + 4), (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    for x, title in zip(columns, ["病歷號", "姓名", "住院日期", "主治醫師"]):
+        draw.text((x, 6), title, fill=(0, 0, 0), font=font)
+    draw.line((0, row_h, image.width, row_h), fill=(150, 150, 150))
+    for i, row in enumerate(rows, start=1):
+        if i % 2 == 0:
+            draw.rectangle((0, i * row_h + 1, image.width, (i + 1) * row_h), fill=(228, 236, 246))
+        values = [row['patient_id'], row['patient_name'], row['admission_date'], row['attending_doctor']]
+        for x, value in zip(columns, values):
+            draw.text((x, i * row_h + 7), value, fill=(20, 20, 40), font=font)
+    return image
+
+
+def build_fixtures(count, seed, latin_font, cjk_font):
+    """回傳 ({欄位: [(圖片, 答案), ...]}, 略過的欄位說明)。"""
+    rng = random.Random(seed)
+    fixtures = {}
+    skipped = []
+    generators = {
+        "病歷號": (random_id, False),
+        "姓名": (random_name, True),
+        "床號": (random_bed, False),
+        "住院備註": (random_notes, True),
+    }
+    for field, (generate, needs_cjk) in generators.items():
+        if needs_cjk and cjk_font is None:
+            skipped.append({'field': field, 'reason': 'no CJK font'})
+            continue
+        cases = []
+        for _ in range(count):
+            font = cjk_font if needs_cjk else latin_font
+            font = font.font_variant(size=rng.choice([13, 15, 18])) # HIS 常見字級
+            truth = generate(rng)
+            cases.append((render_field(truth, font, rng), truth))
+        fixtures[field] = cases
+
+    if cjk_font is None:
+        skipped.append({'field': "住院清單", 'reason': 'no CJK font'})
+    else:
+        cases = []
+        for _ in range(max(1, count // 5)):
+            rows = [{'patient_id': random_id(rng), 'patient_name': random_name(rng),
+                     'admission_date': f"114{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}",
+                     'attending_doctor': random_name(rng)} for _ in range(rng.randint(4, 10))]
+            cases.append((render_patient_list(rows, cjk_font.font_variant(size=15), rng), rows))
+        fixtures["住院清單"] = cases
+    return fixtures, skipped
+
+
+# --- 評分 ---
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def char_accuracy(predicted, truth):
+    return max(0.0, 1.0 - edit_distance(predicted, truth) / max(len(truth), 1))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def summarize(field, variant, profile, records):
+    latencies = [r['ms'] for r in records]
+    return {
+        'field': field,
+        'variant': variant,
+        'lang': profile.lang,
+        'psm': profile.psm,
+        'preprocess': list(profile.preprocess),
+        'scale': profile.scale,
+        'n': len(records),
+        'char_accuracy': round(sum(r['accuracy'] for r in records) / len(records), 4),
+        'exact_match': round(sum(r['exact'] for r in records) / len(records), 4),
+        'raw_exact_match': round(sum(r['raw_exact'] for r in records) / len(records), 4),
+        'p50_ms': round(percentile(latencies, 0.5), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+    }
+
+
+def field_variants(field):
+    """該欄位要測試的設定檔：目前的設定、舊版固定閾值 128，以及前處理 x PSM 的組合。"""
+    base = OCR_FIELD_PROFILES[field]
+
+    def derive(preprocess, psm, scale=None):
+        return OcrFieldProfile(lang=base.lang, psm=psm, oem=base.oem, whitelist=base.whitelist,
+                               scale=base.scale if scale is None else scale, min_height=base.min_height if scale is None else 0,
+                               preprocess=preprocess, normalize=base.normalize,
+                               variables={k: v for k, v in base.variables.items() if k != 'tessedit_char_whitelist'})
+
+    variants = [("profile", base), ("legacy-128", derive(('threshold',), base.psm, scale=1.0))]
+    for psm in PSM_CHOICES[field]:
+        for chain in PREPROCESS_CHAINS:
+            if psm == base.psm and chain == base.preprocess:
+                continue # 與 profile 相同
+            variants.append((f"psm{psm}:{'+'.join(chain) or 'none'}", derive(chain, psm)))
+    return variants
+
+
+def run_field(field, cases, variants):
+    results = []
+    for variant, profile in variants:
+        records = []
+        for image, truth in cases:
+            start = time.perf_counter()
+            processed = autopaste.preprocess_ocr_image(image, profile.preprocess, profile.scale, profile.min_height)
+            raw = ocr_engine.recognize(processed, lang=profile.lang, psm=profile.psm, oem=profile.oem, variables=profile.variables)
+            predicted = profile.postprocess(raw)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            records.append({'ms': elapsed_ms, 'accuracy': char_accuracy(predicted, truth),
+                            'exact': predicted == truth, 'raw_exact': raw.strip() == truth})
+        results.append(summarize(field, variant, profile, records))
+        print(f"{field:6} {variant:28} 字元 {results[-1]['char_accuracy']:.3f} 相符 {results[-1]['exact_match']:.2f} "
+              f"p50 {results[-1]['p50_ms']:.0f} ms", file=sys.stderr)
+    return results
+
+
+def run_patient_list(cases):
+    """住院清單：切割成列、平行辨識，以每列 (病歷號 姓名 日期 醫師) 串成的文字評分。"""
+    records = []
+    for image, rows in cases:
+        start = time.perf_counter()
+        predicted = autopaste.recognize_patient_list_locally(image)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        as_text = lambda items: '\n'.join(' '.join(row[f] for f in autopaste.PATIENT_LIST_ROW_FIELDS) for row in items)
+        truth_rows = {row['patient_id']: row for row in rows}
+        exact = sum(1 for row in predicted if truth_rows.get(row['patient_id']) == row)
+        records.append({'ms': elapsed_ms, 'accuracy': char_accuracy(as_text(predicted), as_text(rows)),
+                        'exact': exact / len(rows), 'raw_exact': len(predicted) == len(rows)})
+    latencies = [r['ms'] for r in records]
+    return {
+        'field': "住院清單",
+        'variant': "segmented-rows",
+        'n': len(records),
+        'rows': sum(len(rows) for _, rows in cases),
+        'char_accuracy': round(sum(r['accuracy'] for r in records) / len(records), 4),
+        'exact_match': round(sum(r['exact'] for r in records) / len(records), 4), # 完全正確的列比例
+        'row_count_match': round(sum(r['raw_exact'] for r in records) / len(records), 4),
+        'p50_ms': round(percentile(latencies, 0.5), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', type=int, default=10, help="每個欄位的合成圖數量")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fields', default=None, help="只測試這些欄位 (以逗號分隔)")
+    parser.add_argument('--font', default=None, help="CJK 字型路徑")
+    parser.add_argument('--output', default=None, help="JSON 輸出檔 (預設寫到 stdout)")
+    parser.add_argument('--render-only', metavar='DIR', default=None, help="只輸出合成圖與 ground_truth.json")
+    args = parser.parse_args()
+
+    latin_font, latin_path = load_font(LATIN_FONT_CANDIDATES, 15)
+    if latin_font is None:
+        latin_font, latin_path = ImageFont.load_default(), 'default'
+    cjk_font, cjk_path = load_font(CJK_FONT_CANDIDATES, 15, args.font)
+    fixtures, skipped = build_fixtures(args.fixtures, args.seed, latin_font, cjk_font)
+    if args.fields:
+        wanted = set(args.fields.split(','))
+        fixtures = {field: cases for field, cases in fixtures.items() if field in wanted}
+
+    if args.render_only:
+        os.makedirs(args.render_only, exist_ok=True)
+        truth = {}
+        for field, cases in fixtures.items():
+            for i, (image, answer) in enumerate(cases):
+                name = f"{field}_{i:03d}.png"
+                image.save(os.path.join(args.render_only, name))
+                truth[name] = answer
+        with open(os.path.join(args.render_only, 'ground_truth.json'), 'w', encoding='utf-8') as f:
+            json.dump({'fixtures': truth, 'skipped': skipped}, f, ensure_ascii=False, indent=2)
+        print(f"已輸出 {len(truth)} 張合成圖到 {args.render_only}", file=sys.stderr)
+        return
+
+    if not os.path.exists(pytesseract.pytesseract.tesseract_cmd) and shutil.which('tesseract'):
+        pytesseract.pytesseract.tesseract_cmd = shutil.which('tesseract')
+    try:
+        tesseract_version = str(pytesseract.get_tesseract_version())
+    except Exception as e:
+        print(f"找不到 Tesseract，無法執行辨識：{e}", file=sys.stderr)
+        sys.exit(2)
+
+    results = []
+    for field, cases in fixtures.items():
+        if field == "住院清單":
+            results.append(run_patient_list(cases))
+        else:
+            results.extend(run_field(field, cases, field_variants(field)))
+
+    report = {
+        'meta': {
+            'backend': ocr_engine.backend,
+            'tesseract': tesseract_version,
+            'fixtures_per_field': args.fixtures,
+            'seed': args.seed,
+            'latin_font': latin_path,
+            'cjk_font': cjk_path,
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+OCR 引擎效能測試：比較每次呼叫都啟動 tesseract 子程序 (pytesseract)
+與常駐辨識器 (OcrEngine + tesserocr) 的單次辨識延遲。
+
+需要已安裝 Tesseract (含 chi_tra 語言包)；常駐模式另需 tesserocr。
+執行方式 (於專案根目錄)：
+    python benchmarks/bench_ocr_engine.py [次數]
+"""
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import autopaste  # noqa: E402
+from autopaste import OcrEngine, pytesseract  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+
+def render_line(text, scale=3):
+    """以 Pillow 內建字型畫出單行文字，放大後模擬 HIS 畫面上的病歷號欄位。"""
+    image = Image.new('L', (8 * len(text) + 20, 24), 255)
+    ImageDraw.Draw(image).text((10, 6), text, fill=0)
+    return image.resize((image.width * scale, image.height * scale), Image.LANCZOS).convert('RGB')
+
+
+def time_calls(fn, image, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(image)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if not os.path.exists(pytesseract.pytesseract.tesseract_cmd) and shutil.which('tesseract'):
+        pytesseract.pytesseract.tesseract_cmd = shutil.which('tesseract')
+
+    image = render_line("A123456789")
+
+    subprocess_engine = OcrEngine()
+    subprocess_engine.backend = 'pytesseract'
+    p50, p95 = time_calls(lambda img: subprocess_engine.recognize(img, psm=7), image, runs)
+    print(f"pytesseract 子程序：p50 {p50:.1f} ms，p95 {p95:.1f} ms")
+
+    if autopaste.tesserocr is None:
+        print("未安裝 tesserocr，略過常駐辨識器測試。")
+        return
+
+    engine = OcrEngine(tessdata_dir=autopaste.ocr_engine.tessdata_dir)
+    start = time.perf_counter()
+    engine.warm_up([OcrEngine.make_profile(psm=7)])
+    print(f"tesserocr 預熱 (載入 traineddata)：{(time.perf_counter() - start) * 1000:.1f} ms")
+    p50, p95 = time_calls(lambda img: engine.recognize(img, psm=7), image, runs)
+    print(f"tesserocr 常駐辨識器：p50 {p50:.1f} ms，p95 {p95:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
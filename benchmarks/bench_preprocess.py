@@ -0,0 +1,62 @@
+"""
+OCR 前處理效能測試：比較舊版 convert('L').point(lambda ...) 固定閾值
+與 NumPy 向量化流程 (灰階 / Otsu / 區域閾值 / 去雜點 / 校正傾斜) 的耗時。
+
+執行方式 (於專案根目錄)：
+    python benchmarks/bench_preprocess.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import autopaste  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+
+def render_screen(width, height, lines, seed=0):
+    """畫出類似 HIS 畫面的合成圖：淺色底、深色文字、交錯的列底色。"""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (245, 245, 250))
+    draw = ImageDraw.Draw(image)
+    row_h = max(1, height // max(1, lines))
+    for i in range(lines):
+        if i % 2:
+            draw.rectangle((0, i * row_h, width, (i + 1) * row_h), fill=(225, 232, 240))
+        text = f"A{rng.randint(10**8, 10**9 - 1)}  7B{rng.randint(10, 99)}-{rng.randint(1, 40):02d}  1140{rng.randint(101, 928)}"
+        draw.text((8, i * row_h + row_h // 3), text, fill=(20, 20, 40))
+    return image
+
+
+def legacy(image):
+    return image.convert('L').point(lambda p: 0 if p < 128 else 255, '1')
+
+
+def bench(name, fn, arg, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"  {name:<34} p50 {timings[len(timings) // 2]:7.2f} ms   p95 {timings[int(len(timings) * 0.95)]:7.2f} ms")
+
+
+def main():
+    runs = 30
+    for label, (w, h, lines) in {"單行欄位 240x28": (240, 28, 1),
+                                 "住院備註 600x160": (600, 160, 5),
+                                 "住院清單 1400x600": (1400, 600, 20)}.items():
+        image = render_screen(w, h, lines)
+        pixels = autopaste.np.asarray(image)  # 與 ScreenFrame.crop 相同的陣列視圖
+        print(label)
+        bench("舊版 point(lambda) 固定 128", legacy, image, runs)
+        bench("NumPy 灰階 + 固定 128", lambda px: autopaste.preprocess_ocr_image(px, ('threshold',)), pixels, runs)
+        bench("NumPy 灰階 + Otsu", lambda px: autopaste.preprocess_ocr_image(px, ('otsu',)), pixels, runs)
+        bench("NumPy 區域閾值", lambda px: autopaste.preprocess_ocr_image(px, ('adaptive',)), pixels, runs)
+        bench("NumPy Otsu + 去雜點 + 校正傾斜", lambda px: autopaste.preprocess_ocr_image(px, ('otsu', 'denoise', 'deskew')), pixels, runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+快速搜尋索引效能測試：以合成的 10k 片語資料樹量測建立索引與查詢時間。
+
+執行方式 (於專案根目錄)：
+    python benchmarks/bench_snippet_search.py
+"""
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autopaste import SnippetSearchIndex  # noqa: E402
+
+MEDICAL_WORDS = ["Physical", "examination", "Progress", "note", "history", "fracture", "femur", "hip", "knee",
+                 "理學檢查", "過去病史", "術後", "傷口", "換藥", "骨折", "髖關節", "膝關節", "出院", "診斷書", "疼痛"]
+SYLLABLES = ["ba", "co", "de", "fi", "gu", "ha", "jo", "ki", "lu", "me", "no", "pa", "qui", "ro", "si", "tu", "ve", "xa", "yo", "ze"]
+CJK_CHARS = "骨關節術後傷口換藥疼痛腫脹檢查治療復健固定石膏鋼板螺釘感染發燒出血麻醉病房門診手術開刀換膝置換"
+
+
+def build_vocabulary(rng, size=600):
+    """合成字彙：常用醫療詞彙加上隨機拼音詞與中文詞，避免字彙過少造成不真實的倒排集合。"""
+    words = list(MEDICAL_WORDS)
+    while len(words) < size:
+        if rng.random() < 0.5:
+            words.append("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        else:
+            words.append("".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(2, 4))))
+    return words
+
+
+def build_tree(n_snippets=10000, n_categories=50, seed=0):
+    """產生與 data.json 結構相同的合成資料樹 (分類 -> 子分類 -> 按鈕)。"""
+    rng = random.Random(seed)
+    words = build_vocabulary(rng)
+    data = OrderedDict()
+    per_category = n_snippets // n_categories
+    for c in range(n_categories):
+        category = OrderedDict()
+        for s in range(4):
+            category[f"子分類{s}"] = []
+        category['_sort_order'] = list(category.keys())
+        for i in range(per_category):
+            label = " ".join(rng.choice(words) for _ in range(3)) + f" {c}-{i}"
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+            category[f"子分類{i % 4}"].append({'label': label, 'text': text})
+        data[f"分類{c}"] = category
+    return data
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    data = build_tree()
+    index = SnippetSearchIndex()
+
+    start = time.perf_counter()
+    index.rebuild(data)
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"建立索引：{len(index.docs)} 個片語，{index.postings_count} 個 gram，{build_ms:.1f} ms")
+
+    # 模擬逐字輸入，每次按鍵都查詢一次
+    queries = []
+    for word in ["physical exam", "理學檢查", "progress note", "髖關節 骨折", "fractur", "examinatoin"]:
+        queries.extend(word[:i] for i in range(1, len(word) + 1))
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"查詢 {len(queries)} 次：p50 {percentile(timings, 0.5):.2f} ms，"
+          f"p95 {percentile(timings, 0.95):.2f} ms，max {max(timings):.2f} ms")
+
+    # 本機修改：只更新被修改的片語
+    path, btn = next(SnippetSearchIndex.iter_buttons(data))
+    old_label = btn['label']
+    btn['label'] += " renamed"
+    btn['text'] += " edited"
+    start = time.perf_counter()
+    index.update_button(path, old_label, btn)
+    print(f"增量更新 (修改 1 個片語)：{(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    index.move_category(path[:1], ("改名分類",))
+    print(f"分類改名 ({len(index.path_ids)} 個分類中的 1 個)：{(time.perf_counter() - start) * 1000:.2f} ms")
+
+    # 遠端整批更新：走訪整棵資料樹比對差異
+    btn['text'] += " again"
+    data["改名分類"] = data.pop(path[0])
+    start = time.perf_counter()
+    index.sync(data)
+    print(f"遠端更新 sync (1 個片語變動)：{(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,10 @@ from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, emit
 import json
 import os
+import re
 from collections import OrderedDict
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
 # --- 新增：PostgreSQL 整合 ---
 import psycopg2
 from psycopg2.extras import Json
@@ -38,10 +41,11 @@ def init_db():
                 value JSONB
             );
         ''')
+        cur.execute(ARCHIVE_TABLE_SQL)
         conn.commit()
         cur.close()
         conn.close()
-        print("資料庫資料表 'storage' 已確認存在。")
+        print("資料庫資料表 'storage'、'patient_archive' 已確認存在。")
     except Exception as e:
         print(f"資料庫初始化失敗: {e}")
 
@@ -183,13 +187,190 @@ def handle_socket_update_data(new_data):
     emit('data_updated', new_data, broadcast=True)
 
 # --- 待辦清單 API ---
+# --- 新功能：篩選、分頁與欄位投影 ---
+# 沒有任何查詢參數時維持原本的行為 (回傳整份清單)；有參數時在資料庫端以 jsonb_each 逐位病人篩選，
+# 依 patient_id 排序並以 cursor 分頁，回傳 {'patients': [...], 'next_cursor': ..., 'meta': {...}}。
+# daily_task_date 讓只有摘要的客戶端判斷每日任務是否已計入，重複收到廣播時不會重複累加
+SUMMARY_FIELDS = ('patient_id', 'patient_name', 'bed_number', 'attending_doctor', 'admission_date', 'tags',
+                  'daily_task_date', 'unchecked', 'item_count')
+COMPUTED_FIELDS = {
+    # 不必傳送 items 就能顯示「●」與項目數
+    'unchecked': "(SELECT count(*) FROM jsonb_array_elements(COALESCE(p.value->'items', '[]'::jsonb)) item "
+                 "WHERE NOT COALESCE((item->>'checked')::boolean, false))",
+    'item_count': "jsonb_array_length(COALESCE(p.value->'items', '[]'::jsonb))",
+}
+
+def minguo_today():
+    now = datetime.now(DAILY_TASK_TIMEZONE)
+    return f"{now.year - 1911}{now.month:02d}{now.day:02d}"
+
+def load_checklist_meta():
+    """只讀取待辦清單中以 __ 開頭的設定鍵 (目前病人、排程日期等)，不載入病人資料。"""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT jsonb_object_agg(p.key, p.value) FROM storage, jsonb_each(storage.value) AS p(key, value) "
+                    "WHERE storage.key = %s AND jsonb_typeof(storage.value) = 'object' AND left(p.key, 2) = '__';",
+                    ("checklist_data",))
+        result = cur.fetchone()
+        cur.close()
+        conn.close()
+        return result[0] if result and result[0] else {}
+    except Exception as e:
+        print(f"讀取待辦清單設定失敗: {e}")
+        return {}
+
+def query_checklist_patients(args):
+    """依查詢參數組出 SQL 並回傳 (病人清單, next_cursor)；參數錯誤時丟出 ValueError。"""
+    conditions, params = [], []
+    if args.get('attending_doctor'):
+        conditions.append("p.value->>'attending_doctor' = %s")
+        params.append(args['attending_doctor'])
+    if args.get('tag'):
+        conditions.append("COALESCE(p.value->'tags', '[]'::jsonb) ? %s")
+        params.append(args['tag'])
+    for name, operator in (('admitted_from', '>='), ('admitted_to', '<=')):
+        if args.get(name):
+            if not re.fullmatch(r'\d{6,7}', args[name]):
+                raise ValueError(f"{name} 必須是民國年日期 (YYYMMDD)")
+            conditions.append(f"COALESCE(p.value->>'admission_date', '') <> '' AND p.value->>'admission_date' {operator} %s")
+            params.append(args[name])
+    # 與客戶端選擇器相同的定義：有床號或住院日期已到為住院中，沒有床號且住院日期在未來為尚未住院
+    status = args.get('status')
+    if status == 'inpatient':
+        conditions.append("(COALESCE(p.value->>'bed_number', '') <> '' OR "
+                          "(COALESCE(p.value->>'admission_date', '') <> '' AND p.value->>'admission_date' <= %s))")
+        params.append(minguo_today())
+    elif status == 'outpatient':
+        conditions.append("COALESCE(p.value->>'bed_number', '') = '' AND COALESCE(p.value->>'admission_date', '') > %s")
+        params.append(minguo_today())
+    elif status:
+        raise ValueError("status 只能是 inpatient 或 outpatient")
+    if args.get('cursor'):
+        conditions.append("p.key > %s")
+        params.append(args['cursor'])
+    limit = max(1, min(int(args.get('limit', 100)), 500))
+
+    fields = args.get('fields', 'full')
+    if fields == 'full':
+        projection, projection_params = "p.value", []
+    else:
+        names = SUMMARY_FIELDS if fields == 'summary' else [f.strip() for f in fields.split(',') if f.strip()]
+        if not names:
+            raise ValueError("fields 不可為空")
+        parts, projection_params = [], []
+        for name in names:
+            parts.append(f"%s, {COMPUTED_FIELDS[name]}" if name in COMPUTED_FIELDS else "%s, p.value->%s")
+            projection_params += [name] if name in COMPUTED_FIELDS else [name, name]
+        projection = f"jsonb_build_object({', '.join(parts)})"
+
+    where = "".join(f" AND {condition}" for condition in conditions)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT p.key, {projection} FROM storage, jsonb_each(storage.value) AS p(key, value) "
+        f"WHERE storage.key = %s AND jsonb_typeof(storage.value) = 'object' AND left(p.key, 2) <> '__' "
+        f"AND jsonb_typeof(p.value) = 'object'{where} ORDER BY p.key LIMIT %s;",
+        (*projection_params, "checklist_data", *params, limit + 1))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [dict(value, patient_id=key) for key, value in rows[:limit]], next_cursor
+
 @app.route('/api/checklist', methods=['GET'])
 def get_checklist():
-    # 使用新的讀取函式，如果檔案不存在或為空，則回傳一個空字典
-    data = load_generic_data("checklist_data", lambda: {})
-    if not isinstance(data, dict): # 保險措施：如果讀到的不是字典，也回傳空字典
-        return jsonify({})
-    return jsonify(data)
+    """
+    查詢參數 (都可省略)：attending_doctor、tag、admitted_from / admitted_to (民國年 YYYMMDD)、
+    status (inpatient / outpatient)、fields (full / summary / 以逗號分隔的欄位)、limit、cursor。
+    """
+    today = daily_task_today()
+    if not request.args:
+        # 使用新的讀取函式，如果檔案不存在或為空，則回傳一個空字典
+        data = load_generic_data("checklist_data", lambda: {})
+        if not isinstance(data, dict): # 保險措施：如果讀到的不是字典，也回傳空字典
+            return jsonify({})
+        # 伺服器休眠期間錯過排程時，在第一次讀取前補跑封存與每日任務
+        if run_scheduled_jobs(data, today):
+            data = load_generic_data("checklist_data", lambda: {})
+        return jsonify(data)
+
+    meta = load_checklist_meta()
+    if not request.args.get('cursor') and run_scheduled_jobs(meta, today):
+        meta = load_checklist_meta()
+    try:
+        patients, next_cursor = query_checklist_patients(request.args)
+    except (ValueError, KeyError) as e:
+        return jsonify({"error": f"Invalid query parameters: {e}"}), 400
+    except Exception as e:
+        print(f"查詢待辦清單失敗: {e}")
+        return jsonify({"error": "Checklist query failed"}), 500
+    return jsonify({'patients': patients, 'next_cursor': next_cursor, 'meta': meta})
+
+@app.route('/api/checklist/<patient_id>', methods=['GET'])
+def get_checklist_patient(patient_id):
+    """取得單一病人的完整資料 (含待辦事項)。"""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT value->%s FROM storage WHERE key = %s;", (patient_id, "checklist_data"))
+        result = cur.fetchone()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"讀取病人 '{patient_id}' 失敗: {e}")
+        return jsonify({"error": "Checklist query failed"}), 500
+    if patient_id.startswith("__") or not result or not isinstance(result[0], dict):
+        return jsonify({"error": "Patient not found"}), 404
+    return jsonify(result[0])
+
+@app.route('/api/checklist/patients', methods=['POST'])
+def update_checklist_patients():
+    """
+    只更新有變動的病人：{'patients': {patient_id: 完整資料}, 'deleted': [patient_id], 'current_patient_id': ...}。
+    直接在資料庫中以 jsonb 運算合併，不必讀出整份清單；廣播的也只有這些病人。
+    已封存 (且不在清單中) 的病人不能再寫回，回傳 409 與這些病人 ID，需要時請走還原 API。
+    """
+    body = request.json
+    if not isinstance(body, dict):
+        return jsonify({"error": "Invalid checklist patch provided"}), 400
+    patients = body.get('patients') or {}
+    deleted = [pid for pid in body.get('deleted') or [] if isinstance(pid, str) and not pid.startswith("__")]
+    if not isinstance(patients, dict) or any(pid.startswith("__") or not isinstance(p, dict) for pid, p in patients.items()):
+        return jsonify({"error": "Invalid checklist patch provided"}), 400
+    patch = dict(patients)
+    if 'current_patient_id' in body:
+        patch["__current_patient_id__"] = body['current_patient_id']
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            # 與封存使用同一把鎖：封存搬移病人時，客戶端舊的儲存不會在中途把病人寫回清單
+            cur.execute("SELECT 1 FROM storage WHERE key = %s FOR UPDATE;", ("checklist_data",))
+            if patients:
+                cur.execute('''
+                    SELECT DISTINCT a.patient_id FROM patient_archive a
+                    WHERE a.patient_id = ANY(%s) AND NOT EXISTS (
+                        SELECT 1 FROM storage s WHERE s.key = %s AND s.value ? a.patient_id);
+                ''', (list(patients), "checklist_data"))
+                archived = sorted(row[0] for row in cur.fetchall())
+                if archived:
+                    conn.rollback()
+                    return jsonify({"error": "Patients are archived", "archived": archived}), 409
+            cur.execute('''
+                INSERT INTO storage (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = (storage.value - %s::text[]) || EXCLUDED.value;
+            ''', ("checklist_data", Json(patch), deleted))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"儲存病人資料失敗: {e}")
+        return jsonify({"error": "Checklist update failed"}), 500
+    if patients or deleted:
+        socketio.emit('checklist_patients_updated', {'patients': patients, 'deleted': deleted})
+    return jsonify({"success": True})
 
 @app.route('/api/checklist', methods=['POST'])
 def update_checklist():
@@ -203,6 +384,427 @@ def update_checklist():
     socketio.emit('checklist_updated', new_data)
     return jsonify({"success": True})
 
+# --- 新功能：伺服器端的每日任務排程 ---
+# 原本每台客戶端啟動時都會為所有病人加入 'Progress note' 並上傳整份清單，多台電腦同時開機就會互相覆蓋。
+# 現在改由伺服器每天執行一次 (__last_daily_task_date__)，
+# 每位病人另外記錄 daily_task_date，已經加過的不會重複加入；完成後只廣播新增的項目。
+DAILY_TASK_TEXT = "Progress note"
+DAILY_TASK_TIMEZONE = ZoneInfo(os.environ.get('DAILY_TASK_TIMEZONE', 'Asia/Taipei'))
+DAILY_TASK_CHECK_SECONDS = 300 # 排程檢查間隔；伺服器休眠醒來後由 GET /api/checklist 補跑
+
+def daily_task_today():
+    return datetime.now(DAILY_TASK_TIMEZONE).strftime("%Y-%m-%d")
+
+def daily_tasks_done(data, today):
+    """不鎖定資料表的快速檢查：今天的每日任務是否已經跑過。"""
+    return isinstance(data, dict) and data.get("__last_daily_task_date__") == today
+
+def run_daily_tasks(today=None):
+    """
+    為今天尚未加入每日任務的病人加入 'Progress note'，回傳新增的項目清單。
+    在同一個交易中以 SELECT ... FOR UPDATE 鎖住待辦清單，排程與 API 同時觸發也只會執行一次。
+    """
+    today = today or daily_task_today()
+    added = []
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM storage WHERE key = %s FOR UPDATE;", ("checklist_data",))
+            result = cur.fetchone()
+            data = result[0] if result else None
+            if not isinstance(data, dict) or daily_tasks_done(data, today):
+                conn.rollback()
+                return added
+
+            for pid, pdata in data.items():
+                if pid.startswith("__") or not isinstance(pdata, dict):
+                    continue
+                if pdata.get('daily_task_date') == today:
+                    continue
+                item = {'text': DAILY_TASK_TEXT, 'checked': False, 'note': '', 'added': today}
+                pdata.setdefault('items', []).append(item)
+                pdata['daily_task_date'] = today
+                added.append({'patient_id': pid, 'item': item})
+
+            data.pop("__daily_task_runs__", None) # 舊版依病房記錄的執行紀錄，已不再使用
+            data["__last_daily_task_date__"] = today
+            cur.execute("UPDATE storage SET value = %s WHERE key = %s;", (Json(data), "checklist_data"))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"每日任務執行失敗: {e}")
+        return []
+
+    print(f"[每日任務] {today}：為 {len(added)} 位病人加入 '{DAILY_TASK_TEXT}'")
+    if added:
+        # 只廣播新增的項目，客戶端就地合併，不必重新下載整份清單
+        socketio.emit('checklist_items_added', {'date': today, 'items': added})
+    return added
+
+# --- 新功能：出院 / 過期病人封存 (冷資料表) ---
+# 待辦清單文件每次儲存與廣播都是整份傳送，所以只保留目前在院的病人；
+# 出院或過期的病人連同所有待辦事項搬到 patient_archive 資料表，需要時可以查詢或還原。
+ARCHIVE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS patient_archive (
+        id SERIAL PRIMARY KEY,
+        patient_id TEXT NOT NULL,
+        patient_name TEXT,
+        attending_doctor TEXT,
+        reason TEXT,
+        archived_on DATE NOT NULL DEFAULT CURRENT_DATE,
+        value JSONB
+    );
+    CREATE INDEX IF NOT EXISTS patient_archive_patient_id ON patient_archive (patient_id);
+'''
+ARCHIVE_SUMMARY_COLUMNS = "id, patient_id, patient_name, attending_doctor, reason, archived_on"
+
+def default_archive_policy():
+    """
+    封存規則 (天數)，可用環境變數設定，也可以透過 POST /api/archive/policy 覆寫：
+    - discharge_days：標記出院幾天後封存 (待辦事項都完成才封存)
+    - stale_days：出院標記超過幾天、或沒有床號且住院日期已過幾天 (且待辦都完成) 視為過期，一律封存
+    - retention_days：封存資料保留幾天，0 表示永久保留
+    """
+    return {
+        'discharge_days': int(os.environ.get('ARCHIVE_DISCHARGE_DAYS', 1)),
+        'stale_days': int(os.environ.get('ARCHIVE_STALE_DAYS', 14)),
+        'retention_days': int(os.environ.get('ARCHIVE_RETENTION_DAYS', 365)),
+    }
+
+def load_archive_policy():
+    policy = default_archive_policy()
+    stored = load_generic_data("archive_policy", lambda: {})
+    if isinstance(stored, dict):
+        policy.update({k: int(v) for k, v in stored.items() if k in policy})
+    return policy
+
+def parse_minguo_date(text):
+    """民國年日期字串 (YYYMMDD) 轉為 date，格式不對時回傳 None。"""
+    text = (text or '').strip()
+    if not re.fullmatch(r'\d{6,7}', text):
+        return None
+    try:
+        return date(int(text[:-4]) + 1911, int(text[-4:-2]), int(text[-2:]))
+    except ValueError:
+        return None
+
+def archive_reason(pdata, today, policy):
+    """依封存規則判斷病人是否該封存，回傳原因或 None。"""
+    all_done = all(item.get('checked', False) for item in pdata.get('items', []))
+    if 'discharge' in pdata.get('tags', []):
+        try:
+            days = (today - date.fromisoformat(pdata.get('discharge_date', ''))).days
+        except ValueError:
+            return None # 還沒有出院日期，由 run_archival 補上
+        if days >= policy['stale_days'] or (days >= policy['discharge_days'] and all_done):
+            return "discharged"
+        return None
+    admitted = parse_minguo_date(pdata.get('admission_date'))
+    if not pdata.get('bed_number') and admitted and (today - admitted).days >= policy['stale_days'] and all_done:
+        return "stale"
+    return None
+
+def archival_done(data, today):
+    return isinstance(data, dict) and data.get("__last_archive_date__") == today
+
+def run_archival(today=None, force=False):
+    """
+    把符合封存規則的病人從待辦清單文件搬到 patient_archive，回傳被封存的病人 ID。
+    與每日任務相同，在同一個交易中鎖住待辦清單，搬移與刪除要嘛都成功、要嘛都不做。
+    """
+    today = today or daily_task_today()
+    policy = load_archive_policy()
+    today_date = date.fromisoformat(today)
+    archived = []
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(ARCHIVE_TABLE_SQL)
+            cur.execute("SELECT value FROM storage WHERE key = %s FOR UPDATE;", ("checklist_data",))
+            result = cur.fetchone()
+            data = result[0] if result else None
+            if not isinstance(data, dict) or (archival_done(data, today) and not force):
+                conn.rollback()
+                return archived
+
+            current_patient_id = data.get("__current_patient_id__")
+            for pid, pdata in list(data.items()):
+                if pid.startswith("__") or not isinstance(pdata, dict) or pid == current_patient_id:
+                    continue
+                if 'discharge' in pdata.get('tags', []) and not pdata.get('discharge_date'):
+                    pdata['discharge_date'] = today # 舊資料沒有出院日期，從今天開始計算
+                reason = archive_reason(pdata, today_date, policy)
+                if reason is None:
+                    continue
+                cur.execute(
+                    "INSERT INTO patient_archive (patient_id, patient_name, attending_doctor, reason, archived_on, value) "
+                    "VALUES (%s, %s, %s, %s, %s, %s);",
+                    (pid, pdata.get('patient_name', ''), pdata.get('attending_doctor', '未指派'), reason, today_date, Json(pdata)))
+                del data[pid]
+                archived.append(pid)
+
+            if policy['retention_days'] > 0:
+                cur.execute("DELETE FROM patient_archive WHERE archived_on < %s;",
+                            (today_date - timedelta(days=policy['retention_days']),))
+            data["__last_archive_date__"] = today
+            cur.execute("UPDATE storage SET value = %s WHERE key = %s;", (Json(data), "checklist_data"))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"病人封存失敗: {e}")
+        return []
+
+    print(f"[封存] {today}：封存 {len(archived)} 位病人")
+    if archived:
+        socketio.emit('checklist_patients_archived', {'date': today, 'patient_ids': archived})
+    return archived
+
+# --- 新功能：已完成的重複任務壓縮 ---
+# 每天的 'Progress note' 會一直累積在 items 中，住得越久清單越長。
+# 壓縮時把「已完成且不是今天加入」的重複任務併入病人的 history 紀錄 (次數、最後日期與備註)，
+# items 只保留未完成與今天的項目。
+RECURRING_TASK_TEXTS = (DAILY_TASK_TEXT,)
+
+def compact_patient_items(pdata, today):
+    """壓縮單一病人的已完成重複任務，回傳被移除的項目數。"""
+    items = pdata.get('items', [])
+    kept, folded = [], []
+    for item in items:
+        if item.get('text') in RECURRING_TASK_TEXTS and item.get('checked', False) and item.get('added') != today:
+            folded.append(item)
+        else:
+            kept.append(item)
+    if not folded:
+        return 0
+
+    history = pdata.setdefault('history', {})
+    for item in folded:
+        record = history.setdefault(item['text'], {'count': 0, 'last': None, 'notes': []})
+        record['count'] += 1
+        if item.get('added') and (record['last'] is None or item['added'] > record['last']):
+            record['last'] = item['added']
+        if item.get('note'):
+            record['notes'].append({'date': item.get('added'), 'note': item['note']})
+    pdata['items'] = kept
+    return len(folded)
+
+def compaction_done(data, today):
+    return isinstance(data, dict) and data.get("__last_compaction_date__") == today
+
+def run_compaction(today=None, force=False):
+    """
+    壓縮所有病人的已完成重複任務，回傳 {patient_id: {'before': 項目數, 'after': 項目數}} (只含有變動的病人)。
+    只廣播有變動病人的 items 與 history，客戶端直接替換。
+    """
+    today = today or daily_task_today()
+    report, changed = {}, {}
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM storage WHERE key = %s FOR UPDATE;", ("checklist_data",))
+            result = cur.fetchone()
+            data = result[0] if result else None
+            if not isinstance(data, dict) or (compaction_done(data, today) and not force):
+                conn.rollback()
+                return report
+
+            for pid, pdata in data.items():
+                if pid.startswith("__") or not isinstance(pdata, dict):
+                    continue
+                before = len(pdata.get('items', []))
+                if compact_patient_items(pdata, today):
+                    report[pid] = {'before': before, 'after': len(pdata['items'])}
+                    changed[pid] = {'items': pdata['items'], 'history': pdata['history']}
+            data["__last_compaction_date__"] = today
+            cur.execute("UPDATE storage SET value = %s WHERE key = %s;", (Json(data), "checklist_data"))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"待辦事項壓縮失敗: {e}")
+        return {}
+
+    before = sum(entry['before'] for entry in report.values())
+    after = sum(entry['after'] for entry in report.values())
+    print(f"[壓縮] {today}：{len(report)} 位病人，待辦事項 {before} -> {after}")
+    for pid, entry in report.items():
+        print(f"  {pid}: {entry['before']} -> {entry['after']}")
+    if changed:
+        socketio.emit('checklist_items_compacted', {'date': today, 'patients': changed})
+    return report
+
+def run_scheduled_jobs(data, today):
+    """
+    依序執行今天尚未執行的排程工作，回傳資料是否有變動：
+    先封存 (出院的病人就不會再被加入每日任務)，再壓縮昨天以前完成的重複任務，最後加入今天的每日任務。
+    """
+    changed = False
+    if not archival_done(data, today):
+        changed = bool(run_archival(today)) or changed
+    if not compaction_done(data, today):
+        changed = bool(run_compaction(today)) or changed
+    if not daily_tasks_done(data, today):
+        changed = bool(run_daily_tasks(today)) or changed
+    return changed
+
+def daily_task_scheduler():
+    """背景排程：定期檢查日期，跨日後執行一次封存與每日任務。"""
+    while True:
+        run_scheduled_jobs(load_generic_data("checklist_data", lambda: {}), daily_task_today())
+        socketio.sleep(DAILY_TASK_CHECK_SECONDS)
+
+if DATABASE_URL and os.environ.get('DAILY_TASK_SCHEDULER', '1') == '1':
+    socketio.start_background_task(daily_task_scheduler)
+
+# --- 封存 API ---
+def archive_summary(row):
+    return {
+        'archive_id': row[0], 'patient_id': row[1], 'patient_name': row[2],
+        'attending_doctor': row[3], 'reason': row[4], 'archived_on': row[5].isoformat(),
+    }
+
+@app.route('/api/archive', methods=['GET'])
+def query_archive():
+    """
+    查詢封存的病人 (只回傳摘要，依封存順序由新到舊)。
+    參數：q (病歷號或姓名的部分字串)、attending_doctor、since / until (封存日期 YYYY-MM-DD)、
+    limit、cursor (上一頁回傳的 next_cursor)。
+    """
+    conditions, params = [], []
+    if request.args.get('q'):
+        conditions.append("(patient_id ILIKE %s OR patient_name ILIKE %s)")
+        params += [f"%{request.args['q']}%"] * 2
+    if request.args.get('attending_doctor'):
+        conditions.append("attending_doctor = %s")
+        params.append(request.args['attending_doctor'])
+    try:
+        if request.args.get('since'):
+            conditions.append("archived_on >= %s")
+            params.append(date.fromisoformat(request.args['since']))
+        if request.args.get('until'):
+            conditions.append("archived_on <= %s")
+            params.append(date.fromisoformat(request.args['until']))
+        if request.args.get('cursor'):
+            conditions.append("id < %s")
+            params.append(int(request.args['cursor']))
+        limit = max(1, min(int(request.args.get('limit', 50)), 200))
+    except ValueError:
+        return jsonify({"error": "Invalid query parameters"}), 400
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(ARCHIVE_TABLE_SQL)
+        cur.execute(f"SELECT {ARCHIVE_SUMMARY_COLUMNS} FROM patient_archive {where} ORDER BY id DESC LIMIT %s;", (*params, limit + 1))
+        rows = cur.fetchall()
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"查詢封存資料失敗: {e}")
+        return jsonify({"error": "Archive query failed"}), 500
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return jsonify({'patients': [archive_summary(row) for row in rows[:limit]], 'next_cursor': next_cursor})
+
+@app.route('/api/archive/<int:archive_id>', methods=['GET'])
+def get_archived_patient(archive_id):
+    """取得單筆封存病人的完整資料 (含待辦事項)。"""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f"SELECT {ARCHIVE_SUMMARY_COLUMNS}, value FROM patient_archive WHERE id = %s;", (archive_id,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"讀取封存資料失敗: {e}")
+        return jsonify({"error": "Archive query failed"}), 500
+    if not row:
+        return jsonify({"error": "Archived patient not found"}), 404
+    return jsonify(dict(archive_summary(row), patient=row[6]))
+
+@app.route('/api/archive/<int:archive_id>/restore', methods=['POST'])
+def restore_archived_patient(archive_id):
+    """把封存的病人搬回待辦清單 (移除出院標記，避免隔天又被封存)。"""
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM storage WHERE key = %s FOR UPDATE;", ("checklist_data",))
+            result = cur.fetchone()
+            data = result[0] if result and isinstance(result[0], dict) else {}
+            cur.execute("SELECT patient_id, value FROM patient_archive WHERE id = %s;", (archive_id,))
+            row = cur.fetchone()
+            if not row:
+                conn.rollback()
+                return jsonify({"error": "Archived patient not found"}), 404
+            patient_id, pdata = row
+            if patient_id in data:
+                conn.rollback()
+                return jsonify({"error": "Patient ID already exists in the checklist"}), 409
+
+            pdata['tags'] = [tag for tag in pdata.get('tags', []) if tag != 'discharge']
+            pdata.pop('discharge_date', None)
+            data[patient_id] = pdata
+            if result:
+                cur.execute("UPDATE storage SET value = %s WHERE key = %s;", (Json(data), "checklist_data"))
+            else:
+                cur.execute("INSERT INTO storage (key, value) VALUES (%s, %s);", ("checklist_data", Json(data)))
+            cur.execute("DELETE FROM patient_archive WHERE id = %s;", (archive_id,))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"還原封存病人失敗: {e}")
+        return jsonify({"error": "Restore failed"}), 500
+    # 只廣播被還原的病人，其他客戶端就地加入，不必重新下載整份清單
+    socketio.emit('checklist_patients_updated', {'patients': {patient_id: pdata}, 'deleted': []})
+    return jsonify({"success": True, "patient_id": patient_id})
+
+@app.route('/api/archive/run', methods=['POST'])
+def run_archive_now():
+    """立即依目前的規則執行一次封存 (不論今天是否已執行過)。"""
+    return jsonify({"archived": run_archival(force=True)})
+
+@app.route('/api/checklist/compact', methods=['POST'])
+def compact_checklist_now():
+    """立即壓縮已完成的重複任務，回傳每位病人壓縮前後的項目數。"""
+    report = run_compaction(force=True)
+    return jsonify({
+        'patients': report,
+        'before': sum(entry['before'] for entry in report.values()),
+        'after': sum(entry['after'] for entry in report.values()),
+    })
+
+@app.route('/api/archive/policy', methods=['GET'])
+def get_archive_policy():
+    return jsonify(load_archive_policy())
+
+@app.route('/api/archive/policy', methods=['POST'])
+def update_archive_policy():
+    new_policy = request.json
+    if not isinstance(new_policy, dict):
+        return jsonify({"error": "Invalid archive policy provided"}), 400
+    policy = load_archive_policy()
+    try:
+        for key in policy:
+            if key in new_policy:
+                policy[key] = max(0, int(new_policy[key]))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Archive policy values must be integers"}), 400
+    save_generic_data("archive_policy", policy)
+    return jsonify(policy)
+
 # --- 醫師資料 API ---
 @app.route('/api/doctors', methods=['GET'])
 def get_doctors():
@@ -227,6 +829,47 @@ def update_doctors():
     socketio.emit('doctors_updated', new_data)
     return jsonify({"success": True})
 
+# --- 片語使用統計 API ---
+@app.route('/api/usage_stats', methods=['GET'])
+def get_usage_stats():
+    data = load_generic_data("usage_stats", lambda: {})
+    if not isinstance(data, dict):
+        return jsonify({})
+    return jsonify(data)
+
+@app.route('/api/usage_stats', methods=['POST'])
+def update_usage_stats():
+    new_data = request.json
+    if not isinstance(new_data, dict):
+        return jsonify({"error": "Invalid usage stats data provided"}), 400
+    # 逐項合併：每個鍵 [分數, 最後使用時間, 次數] 以最後使用時間較新的為準
+    # 讀取與寫回在同一個交易中以 SELECT ... FOR UPDATE 鎖住，多台電腦同時上傳時不會互相蓋掉
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO storage (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING;",
+                        ("usage_stats", Json({})))
+            cur.execute("SELECT value FROM storage WHERE key = %s FOR UPDATE;", ("usage_stats",))
+            data = cur.fetchone()[0]
+            if not isinstance(data, dict):
+                data = {}
+            for key, entry in new_data.items():
+                if not isinstance(entry, list) or len(entry) != 3:
+                    continue
+                current = data.get(key)
+                if current is None or entry[1] > current[1]:
+                    data[key] = entry
+            cur.execute("UPDATE storage SET value = %s WHERE key = %s;", (Json(data), "usage_stats"))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"儲存資料 'usage_stats' 失敗: {e}")
+        return jsonify({"error": "Usage stats update failed"}), 500
+    return jsonify({"success": True})
+
 
 if __name__ == '__main__':
     print("開發伺服器正在啟動...")
@@ -0,0 +1,102 @@
+"""GeminiClient 的重試、期限與同時請求數限制 (使用本地替身模型，不需要金鑰或網路)。"""
+import threading
+import time
+import unittest
+
+from autopaste import GeminiClient
+
+
+class RateLimitError(Exception):
+    code = 429
+
+
+class StubModel:
+    """依序回傳 / 拋出 outcomes 中的結果，並記錄同時進行的請求數。"""
+    def __init__(self, outcomes=(), delay=0.0):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        try:
+            time.sleep(self.delay)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def make_client(model, **kwargs):
+    options = {'backoff_base': 0.01, 'backoff_max': 0.05, 'deadline_seconds': 5.0}
+    options.update(kwargs)
+    return GeminiClient(model_factory=lambda: model, **options)
+
+
+class GeminiClientTest(unittest.TestCase):
+    def test_retries_rate_limits_with_backoff(self):
+        model = StubModel([RateLimitError("429"), RateLimitError("429"), "done"])
+        client = make_client(model, max_retries=3)
+        self.assertEqual(client.generate_content(["prompt"]), "done")
+        stats = client.stats()
+        self.assertEqual(model.calls, 3)
+        self.assertEqual((stats['rate_limited'], stats['retries'], stats['ok']), (2, 2, 1))
+
+    def test_gives_up_after_max_retries(self):
+        model = StubModel([RateLimitError("429")] * 5)
+        client = make_client(model, max_retries=2)
+        with self.assertRaises(RateLimitError):
+            client.generate_content(["prompt"])
+        self.assertEqual(model.calls, 3)
+        self.assertEqual(client.stats()['failed'], 1)
+
+    def test_other_errors_are_not_retried(self):
+        model = StubModel([ValueError("bad request")])
+        client = make_client(model)
+        with self.assertRaises(ValueError):
+            client.generate_content(["prompt"])
+        self.assertEqual(model.calls, 1)
+
+    def test_deadline_cuts_off_backoff(self):
+        model = StubModel([RateLimitError("429")] * 10)
+        client = make_client(model, backoff_base=10.0, backoff_max=10.0, max_retries=10)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            client.generate_content(["prompt"], deadline=0.3)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(client.stats()['timeouts'], 1)
+
+    def test_deadline_applies_while_queued(self):
+        model = StubModel(delay=0.5)
+        client = make_client(model, max_in_flight=1)
+        worker = threading.Thread(target=client.generate_content, args=(["slow"],))
+        worker.start()
+        time.sleep(0.05)
+        with self.assertRaises(TimeoutError):
+            client.generate_content(["queued"], deadline=0.1)
+        worker.join()
+
+    def test_limits_requests_in_flight(self):
+        model = StubModel(delay=0.05)
+        client = make_client(model, max_in_flight=2)
+        workers = [threading.Thread(target=client.generate_content, args=([f"p{i}"],)) for i in range(6)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(model.calls, 6)
+        self.assertEqual(model.peak, 2)
+        self.assertEqual(client.stats()['peak_in_flight'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()